@@ -0,0 +1,192 @@
+#     run: Benchmarks of the pipeline stages (Spark local mode) and of the alignment and taxonomy functions
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmark import synthetic
+from sparkseqreducer import reducer, stretcher
+from sparkseqreducer.phylogenetic_map import generate_dict
+from sparkseqreducer.taxonomy import build_taxonomy
+
+# synthetic data sets, the keyword arguments of synthetic.generate
+scales = {
+    "small": dict(n_families=2, genera_per_family=3, species_per_genus=4, genome_length=5000, max_group_size=10),
+    "medium": dict(n_families=4, genera_per_family=5, species_per_genus=5, genome_length=10000, max_group_size=40),
+    "large": dict(n_families=8, genera_per_family=8, species_per_genus=8, genome_length=20000, max_group_size=200,
+                  skew=1.2),
+}
+
+
+def timed(function, repeat=1):
+    """ call function repeat times
+        :return: the best time in seconds and the result of the last call
+    """
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def micro_benchmarks(data, seed=1, repeat=3):
+    """ time the alignment, the window scan and the taxonomy parsing without spark
+        :return: a dictionary benchmark name -> seconds
+    """
+    rnd = random.Random(seed)
+    seq_a = synthetic.random_sequence(rnd, 5000)
+    seq_b = synthetic.mutate(rnd, seq_a, 0.02)
+    aligned_a, aligned_b = stretcher.align(seq_a, seq_b, reducer._cmp_mat_file)
+    windows = [(aligned_a[i:i + 100], aligned_b[i:i + 100]) for i in range(0, len(aligned_a), 100)]
+
+    results = {}
+    results["stretcher.align 5kb"], _ = timed(lambda: stretcher.align(seq_a, seq_b, reducer._cmp_mat_file), repeat)
+    results["anchor_align.align 5kb"], _ = timed(
+        lambda: reducer.aligners["anchor"](seq_a, seq_b, reducer._cmp_mat_file), repeat)
+    results["string_similarity 5kb"], _ = timed(
+        lambda: [reducer.string_similarity(a, b) for a, b in windows], repeat)
+    results["find_diff_regions 5kb"], _ = timed(lambda: reducer.find_diff_regions(aligned_a, aligned_b), repeat)
+    results["align_reduce 5kb"], _ = timed(
+        lambda: reducer.align_reduce([(seq_a, ">a")], (seq_a, ">a"), (seq_b, ">b")), repeat)
+    results["generate_dict"], _ = timed(lambda: generate_dict(data["nodes"], data["names"]), repeat)
+    results["build_taxonomy"], _ = timed(lambda: build_taxonomy(data["nodes"], data["names"]), repeat)
+    return results
+
+
+def spark_benchmarks(data, out_dir, cores=2):
+    """ time every stage of the pipeline in spark local mode, every stage is persisted and counted
+        so it is timed alone
+        :return: a dictionary stage -> seconds and a dictionary with the reduction ratio,
+         None, None if pyspark is not installed
+    """
+    try:
+        from pyspark import SparkConf, StorageLevel
+        from pyspark.sql import SparkSession
+    except ImportError:
+        return None, None
+    from sparkseqreducer.phylogenetic_map import map_phylogenetic_info, map_rank_taxid
+    from sparkseqreducer.sequence_io import fasta_to_rdd, rdd_to_fasta_stream
+    from sparkseqreducer.taxid_map import map_accession_to_taxid
+
+    # the python workers import the package from the repository
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.environ["PYTHONPATH"] = os.pathsep.join([root] + [p for p in [os.environ.get("PYTHONPATH")] if p])
+    conf = SparkConf().setMaster("local[%d]" % cores).setAppName("Spark Sequence Reducer benchmark") \
+        .set("spark.ui.enabled", "false").set("spark.driver.host", "127.0.0.1")
+    spark = SparkSession.builder.config(conf=conf).getOrCreate()
+    sc = spark.sparkContext
+    level = StorageLevel.MEMORY_ONLY
+    stages = {}
+    try:
+        fasta_rdd = fasta_to_rdd(data["fasta"], sc).persist(level)
+        stages["fasta_to_rdd"], n_input = timed(fasta_rdd.count)
+        seq_rdd = map_accession_to_taxid(fasta_rdd, db_file=data["db"]).filter(lambda x: x[1][0] != "None") \
+            .persist(level)
+        stages["map_accession_to_taxid (db)"], _ = timed(seq_rdd.count)
+        stages["map_accession_to_taxid (index)"], _ = timed(
+            map_accession_to_taxid(fasta_rdd, index_file=data["index"]).count)
+        stages["map_phylogenetic_info"], _ = timed(
+            map_phylogenetic_info(seq_rdd, data["nodes"], data["names"], sc).count)
+        rank_rdd = map_rank_taxid(seq_rdd, data["nodes"], data["names"], sc, "species", data["taxonomy"]) \
+            .filter(lambda x: x[0] >= 0).persist(level)
+        stages["map_rank_taxid"], _ = timed(rank_rdd.count)
+        reduced_rdd = reducer.reduce(rank_rdd, "species", projected=True).persist(level)
+        stages["reduce"], n_groups = timed(reduced_rdd.count)
+        stages["output"], _ = timed(lambda: rdd_to_fasta_stream(reduced_rdd, os.path.join(out_dir, "reduced")))
+
+        input_bases = fasta_rdd.map(lambda x: len(x[1][1])).sum()
+        output = reduced_rdd.map(lambda x: (len(x[1]), sum(len(seq) for seq, _ in x[1]))) \
+            .reduce(lambda a, b: (a[0] + b[0], a[1] + b[1]))
+        reduction = {"input_sequences": n_input, "input_bases": input_bases, "groups": n_groups,
+                     "output_sequences": output[0], "output_bases": output[1],
+                     "ratio": output[1] / float(input_bases)}
+    finally:
+        spark.stop()
+    return stages, reduction
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, results):
+    """ print the ratio of every time to the baseline
+    """
+    for section in ["micro", "stages"]:
+        for name, seconds in sorted((results.get(section) or {}).items()):
+            old = (baseline.get(section) or {}).get(name)
+            if old:
+                print("%-40s %10.4f s %10.4f s %7.2fx" % (name, old, seconds, old / seconds if seconds else 0.0))
+    old_ratio = (baseline.get("reduction") or {}).get("ratio")
+    new_ratio = (results.get("reduction") or {}).get("ratio")
+    if old_ratio is not None and new_ratio is not None and abs(old_ratio - new_ratio) > 1e-9:
+        print("The reduction ratio changed from %.6f to %.6f" % (old_ratio, new_ratio))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Spark Sequence Reducer benchmarks on synthetic data.")
+    parser.add_argument("--scale", choices=sorted(scales), default="small", help="The size of the synthetic data")
+    parser.add_argument("--seed", type=int, default=1, help="The seed of the synthetic data")
+    parser.add_argument("--cores", type=int, default=2, help="The number of cores of spark local mode")
+    parser.add_argument("--repeat", type=int, default=3, help="The number of runs of every micro benchmark")
+    parser.add_argument("--data-dir", default=None, help="Directory of the synthetic data (default: temporary)")
+    parser.add_argument("--no-spark", action="store_true", help="Only run the micro benchmarks")
+    parser.add_argument("--compare", default=None, help="Results of a previous run to compare with")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="Path of the JSON results")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="ssr_benchmark_") as tmp:
+        data_dir = args.data_dir or tmp
+        print("Generating the", args.scale, "synthetic data in", data_dir)
+        data = synthetic.generate(data_dir, seed=args.seed, **scales[args.scale])
+        results = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(),
+                   "python": sys.version.split()[0], "platform": platform.platform(),
+                   "config": dict(vars(args), **scales[args.scale]),
+                   "data": {"species": data["n_species"], "sequences": data["n_sequences"]}}
+        print("Running the micro benchmarks...")
+        results["micro"] = micro_benchmarks(data, args.seed, args.repeat)
+        if not args.no_spark:
+            print("Running the pipeline stages in local[%d]..." % args.cores)
+            results["stages"], results["reduction"] = spark_benchmarks(data, data_dir, args.cores)
+            if results["stages"] is None:
+                print("pyspark is not installed, the pipeline stages have been skipped")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    for section in ["micro", "stages", "reduction"]:
+        for name, value in sorted((results.get(section) or {}).items()):
+            print("%-40s %s" % (name, value))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    print("The results have been saved to", args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#     synthetic: Generation of a synthetic taxonomy, accession database and genome families for the benchmarks
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import gzip
+import os
+import random
+
+from sparkseqreducer.accession_index import build_accession_index
+from sparkseqreducer.taxid_map import bulk_create_accession2taxid_db, close_connection, create_connection
+from sparkseqreducer.taxonomy import build_taxonomy
+
+# a lineage above the families: root, superkingdom, phylum, class, order
+_upper_lineage = [(1, 1, "no rank", "root"), (2, 1, "superkingdom", "Synthetica"), (3, 2, "phylum", "Synthphyla"),
+                  (4, 3, "class", "Synthclass"), (5, 4, "order", "Synthorder")]
+
+
+def write_taxonomy(out_dir, n_families=2, genera_per_family=3, species_per_genus=4):
+    """ write nodes.dmp and names.dmp files of a synthetic taxonomy
+        :return: a list of (species taxid, genus taxid)
+    """
+    nodes = list(_upper_lineage)
+    species = []
+    for f in range(n_families):
+        family = 10 + f
+        nodes.append((family, 5, "family", "Family%d" % f))
+        for g in range(genera_per_family):
+            genus = 1000 + f * genera_per_family + g
+            nodes.append((genus, family, "genus", "Genus%d" % (genus - 1000)))
+            for s in range(species_per_genus):
+                taxid = 100000 + (genus - 1000) * species_per_genus + s
+                nodes.append((taxid, genus, "species", "Genus%d species%d" % (genus - 1000, s)))
+                species.append((taxid, genus))
+    with open(os.path.join(out_dir, "nodes.dmp"), "w") as f:
+        for taxid, parent, rank, _ in nodes:
+            f.write("%d\t|\t%d\t|\t%s\t|\t\t|\n" % (taxid, parent, rank))
+    with open(os.path.join(out_dir, "names.dmp"), "w") as f:
+        for taxid, _, _, name in nodes:
+            f.write("%d\t|\t%s\t|\t\t|\tscientific name\t|\n" % (taxid, name))
+    return species
+
+
+def random_sequence(rnd, length):
+    return "".join(rnd.choice("ACGT") for _ in range(length))
+
+
+def mutate(rnd, seq, divergence):
+    """ apply substitutions (90%) and short insertions and deletions (10%) at the given rate per base
+    """
+    out = []
+    i = 0
+    while i < len(seq):
+        if rnd.random() >= divergence:
+            out.append(seq[i])
+        elif rnd.random() < 0.9:
+            out.append(rnd.choice("ACGT".replace(seq[i], "")))
+        elif rnd.random() < 0.5:
+            out.append(seq[i] + random_sequence(rnd, rnd.randint(1, 5)))
+        else:
+            i += rnd.randint(1, 5)
+            continue
+        i += 1
+    return "".join(out)
+
+
+def group_sizes(n_groups, max_size, skew):
+    """ the number of sequences of every group, Zipf like: the i-th group has max_size / i ** skew sequences
+    """
+    return [max(1, int(round(max_size / float(i + 1) ** skew))) for i in range(n_groups)]
+
+
+def write_genomes(filename, species, rnd, genome_length=5000, species_divergence=0.1, divergence=0.01,
+                  max_group_size=20, skew=1.0):
+    """ write a fasta file of genome families, every genus has a random ancestor genome, the species genomes
+        diverge from it by species_divergence and the sequences of a species diverge from the species
+        genome by divergence
+        :return: a list of (accession.version, taxid)
+    """
+    accessions = []
+    ancestors = {}
+    sizes = group_sizes(len(species), max_group_size, skew)
+    rnd.shuffle(sizes)
+    with open(filename, "w") as f:
+        for (taxid, genus), size in zip(species, sizes):
+            if genus not in ancestors:
+                ancestors[genus] = random_sequence(rnd, int(genome_length * rnd.uniform(0.8, 1.2)))
+            species_genome = mutate(rnd, ancestors[genus], species_divergence)
+            for member in range(size):
+                accession = "SYN%07d.1" % (len(accessions) + 1)
+                seq = mutate(rnd, species_genome, divergence)
+                # some sequences are partial
+                if rnd.random() < 0.3:
+                    start = rnd.randint(0, len(seq) // 3)
+                    seq = seq[start:start + rnd.randint(len(seq) // 3, len(seq) - start)]
+                f.write(">%s Synthetic taxid %d member %d\n" % (accession, taxid, member))
+                for j in range(0, len(seq), 70):
+                    f.write(seq[j:j + 70] + "\n")
+                accessions.append((accession, taxid))
+    return accessions
+
+
+def write_accession2taxid(filename, accessions):
+    # same layout as nucl_gb.accession2taxid.gz
+    with gzip.open(filename, "wt") as f:
+        f.write("accession\taccession.version\ttaxid\tgi\n")
+        for i, (accession, taxid) in enumerate(accessions):
+            f.write("%s\t%s\t%d\t%d\n" % (accession.split(".")[0], accession, taxid, i))
+
+
+def generate(out_dir, seed=1, n_families=2, genera_per_family=3, species_per_genus=4, genome_length=5000,
+             species_divergence=0.1, divergence=0.01, max_group_size=20, skew=1.0):
+    """ create the data of a benchmark in out_dir: nodes.dmp, names.dmp, taxonomy, input.fasta,
+        nucl_gb.accession2taxid.gz, gb.db and gb.idx
+        :return: a dictionary with the paths and the size of the data
+    """
+    rnd = random.Random(seed)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    paths = dict((name, os.path.join(out_dir, filename)) for name, filename in
+                 [("nodes", "nodes.dmp"), ("names", "names.dmp"), ("taxonomy", "taxonomy"),
+                  ("fasta", "input.fasta"), ("accession2taxid", "nucl_gb.accession2taxid.gz"), ("db", "gb.db"),
+                  ("index", "gb.idx")])
+    species = write_taxonomy(out_dir, n_families, genera_per_family, species_per_genus)
+    build_taxonomy(paths["nodes"], paths["names"]).save(paths["taxonomy"])
+    accessions = write_genomes(paths["fasta"], species, rnd, genome_length, species_divergence, divergence,
+                               max_group_size, skew)
+    write_accession2taxid(paths["accession2taxid"], accessions)
+    if os.path.isfile(paths["db"]):
+        os.remove(paths["db"])
+    conn = create_connection(paths["db"])
+    bulk_create_accession2taxid_db(conn, paths["accession2taxid"])
+    close_connection(conn)
+    build_accession_index(paths["accession2taxid"], paths["index"])
+    return dict(paths, n_species=len(species), n_sequences=len(accessions))
@@ -15,17 +15,30 @@
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import argparse
 import os
+from functools import partial
 
-from pyspark import SparkContext, SparkConf
-from sparkseqreducer.phylogenetic_map import map_phylogenetic_info
-from sparkseqreducer.reducer import reduce
-from sparkseqreducer.sequence_io import fasta_to_rdd, rdd_to_fasta_local
-from sparkseqreducer.taxid_map import map_accession_to_taxid
+from sparkseqreducer.align_cache import AlignmentCache
+from sparkseqreducer.incremental import build_manifest, incremental_reduce, member_digests, read_manifest, \
+    record_representatives, write_manifest
+from sparkseqreducer.local_engine import run_local
+from sparkseqreducer.partitioner import DictAccumulatorParam, create_partition_stats, format_partition_costs
+from sparkseqreducer.pipeline import count_records, create_pipeline_stats, filter_records, format_stats, persist, \
+    storage_levels, unpersist
+from sparkseqreducer.phylogenetic_map import map_phylogenetic_info, map_rank_taxid
+from sparkseqreducer.profiler import create_profile, format_profile, write_profile_report
+from sparkseqreducer.reducer import create_prefilter_stats, format_prefilter_stats, hierarchical_reduce, \
+    pairwise_reduction_merge_sequence, reduce
+from sparkseqreducer.segment_align import segmented_aligner
+from sparkseqreducer.sequence_io import fasta_to_rdd, merge_fasta_parts, rdd_to_fasta_local, rdd_to_fasta_parts, \
+    rdd_to_fasta_stream
+from sparkseqreducer.taxid_map import map_accession_to_taxid, table_map_accession_to_taxid
 
 
-def check_config_files():
+def check_config_files(taxid_table=None):
     config = True
-    db_path = os.path.isfile(os.path.join(os.path.abspath(os.path.dirname(__file__)), "data", "gb.db"))
+    db_path = os.path.isfile(os.path.join(os.path.abspath(os.path.dirname(__file__)), "data", "gb.db")) or \
+        os.path.isfile(os.path.join(os.path.abspath(os.path.dirname(__file__)), "data", "gb.idx")) or \
+        taxid_table is not None
     nodes_path = os.path.isfile(os.path.join(os.path.abspath(os.path.dirname(__file__)), "data", "nodes.dmp"))
     names_path = os.path.isfile(os.path.join(os.path.abspath(os.path.dirname(__file__)), "data", "names.dmp"))
     if not db_path:
@@ -40,54 +53,224 @@ def check_config_files():
     return config
 
 
-def get_params():
+def save_reduced(redseq_rdd, outfile, params):
+    """ save the reduced sequences with the output method and compression of the parameters
+        :return: the path of the output
+    """
+    compression = None if params["compression"] == "none" else params["compression"]
+    if params["output"] == "collect":
+        return rdd_to_fasta_local(redseq_rdd, outfile)
+    if params["output"] == "parts":
+        part_files = rdd_to_fasta_parts(redseq_rdd, outfile, compression)
+        print(len(part_files), "part files have been written to", outfile)
+        if params["merge"]:
+            output = merge_fasta_parts(part_files, outfile, compression)
+            print("Merged to", output)
+            return output
+        return outfile
+    return rdd_to_fasta_stream(redseq_rdd, outfile, compression)
+
+
+std_ranks = ['species', 'genus', 'family', 'order', 'class', 'phylum', 'superkingdom']
+
+
+def rank_list(value):
+    # --rank takes a single value, several ranks are separated by commas
+    ranks = value.split(",")
+    for rank in ranks:
+        if rank not in std_ranks:
+            raise argparse.ArgumentTypeError("invalid rank: %r (choose from %s)" % (rank, ", ".join(std_ranks)))
+    return ranks
+
+
+def get_params(args=None):
 
     parser = argparse.ArgumentParser(description='Spark Sequence Reducer.')
     parser.add_argument("infile",
                         help="Path to the input file containing the sequences to reduce.")
     parser.add_argument("outfile",
                         help="Path to the output file to save the resulting reduced sequences.")
-    parser.add_argument("-r", "--rank", required=False, default="species", const="species", nargs="?",
-                        choices=['species', 'genus', 'family', 'order', 'class', 'phylum', 'superkingdom'],
-                        help="The taxonomic rank to use for the reduction.\nMust be one of the following: "
-                             "species, genus, family, order, class, phylum or superkingdom")
-    args = parser.parse_args()
+    parser.add_argument("-r", "--rank", required=False, default=["species"], const=["species"], nargs="?",
+                        type=rank_list,
+                        help="The taxonomic rank(s) to use for the reduction.\nMust be one of the following: "
+                             "species, genus, family, order, class, phylum or superkingdom. Several ranks are "
+                             "separated by commas (species,genus), the reduction is then hierarchical, the result "
+                             "of a rank is reduced to the next rank, and every rank is saved to outfile.rank")
+    parser.add_argument("--engine", choices=["spark", "local"], default="spark",
+                        help="spark runs the pipeline with spark, local runs it on this machine with a pool of "
+                             "processes and without spark, for small and medium reference sets. The local engine "
+                             "always streams the output and does not support the incremental reduction")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="The number of processes of the local engine (default: the number of cores)")
+    parser.add_argument("--local-memory", type=int, default=4096,
+                        help="The MB of sequences of a rank the local engine holds in memory, the groups of a "
+                             "larger rank are spilled to temporary files in buckets reduced one at a time "
+                             "(default 4096)")
+    parser.add_argument("-t", "--threshold", required=False, default=0.95, type=float,
+                        help="The minimum identity (0-1) of an aligned window to be considered redundant")
+    parser.add_argument("-s", "--stride", required=False, default=100, type=int,
+                        help="The size of the aligned windows compared during the reduction")
+    parser.add_argument("--aligner", required=False, default="stretcher", choices=["stretcher", "anchor"],
+                        help="The alignment backend. anchor aligns only the regions between exact k-mer "
+                             "matches, much faster for highly similar sequences, and falls back to "
+                             "stretcher when the sequences share few k-mers")
+    parser.add_argument("--prefilter", action="store_true",
+                        help="Skip the alignment of duplicated and contained sequences, and of the sequences "
+                             "whose k-mers are all k-mers of the representative of their rank")
+    parser.add_argument("--strand", action="store_true",
+                        help="Detect the strand of every sequence compared to the representative of its rank with "
+                             "their shared k-mers, the sequences deposited on the other strand are reverse "
+                             "complemented before the alignment, and the strand is added to the header of the "
+                             "unique regions (strand=+ or strand=-)")
+    parser.add_argument("--segment-threshold", type=int, default=0,
+                        help="Align the pairs whose shortest sequence is at least this long in collinear segments "
+                             "cut at exact k-mer anchors, the segments are aligned in parallel by threads of the "
+                             "task and joined before the windows are compared (default 0, disabled)")
+    parser.add_argument("--segment-length", type=int, default=100000,
+                        help="The maximum length of the segments, it bounds the memory of every segment "
+                             "alignment (default 100000)")
+    parser.add_argument("--segment-threads", type=int, default=4,
+                        help="The number of threads aligning the segments of a pair, set spark.task.cpus to the "
+                             "same number (default 4)")
+    parser.add_argument("--reduction", choices=["combine", "fanout", "cluster"], default="combine",
+                        help="combine reduces the sequences of a rank one after the other, fanout aligns "
+                             "every sequence against the longest one of its rank and spreads large ranks "
+                             "over many tasks, cluster keeps several centroids per rank: every sequence is "
+                             "aligned against the nearest centroid only, or becomes a new centroid when no "
+                             "centroid is close enough, and every centroid is saved as a representative "
+                             "with its unique regions")
+    parser.add_argument("--cluster-identity", type=float, default=0.9,
+                        help="The minimum identity (0-1) of a sequence to the nearest centroid of the cluster "
+                             "reduction, estimated with k-mer sketches (default 0.9)")
+    parser.add_argument("--salt", type=int, default=0,
+                        help="The maximum number of tasks that align the sequences of a single rank with "
+                             "the fanout reduction (default: the default parallelism)")
+    parser.add_argument("--partitions", type=int, default=0,
+                        help="The number of partitions of the reduction, the ranks are assigned to them by "
+                             "estimated alignment cost (default: the default parallelism)")
+    parser.add_argument("--output", choices=["stream", "collect", "parts"], default="stream",
+                        help="stream writes outfile from the driver one partition at a time, collect writes it "
+                             "after collecting all the sequences to the driver, parts makes every executor "
+                             "write the part files of its partitions to the outfile directory, that must be "
+                             "on shared storage")
+    parser.add_argument("--compression", choices=["none", "gzip", "bgzf"], default="none",
+                        help="The compression of the output files, not available with collect")
+    parser.add_argument("--merge", action="store_true",
+                        help="Concatenate the part files into a single file with --output parts")
+    parser.add_argument("--packed", action="store_true",
+                        help="Keep the sequences packed 4 bases per byte through the pipeline, reduces the "
+                             "memory and shuffle size of large reference sets. The sequences are upper cased "
+                             "when they are read, with or without this option, so the output is the same")
+    parser.add_argument("--full-lineage", action="store_true",
+                        help="Key every sequence by its full lineage dictionary instead of the TaxID of the "
+                             "chosen rank (slower, kept for compatibility)")
+    parser.add_argument("--storage-level", choices=storage_levels, default="MEMORY_AND_DISK",
+                        help="The storage level of the sequences before the reduction, they are read by the "
+                             "planning of the reduction and by the reduction (default MEMORY_AND_DISK), NONE "
+                             "computes them again and disables the counts of every stage")
+    parser.add_argument("--checkpoint-dir", default=None,
+                        help="Checkpoint the sequences before the reduction to this directory on shared storage")
+    parser.add_argument("--no-stats", action="store_true",
+                        help="Do not count the sequences of every stage")
+    parser.add_argument("--manifest", action="store_true",
+                        help="Write the manifest of the reduction to outfile.manifest.json, it is needed to "
+                             "reduce a later release incrementally")
+    parser.add_argument("--previous", default=None,
+                        help="Path to the manifest of a previous reduction of an older release of infile. "
+                             "Only the ranks with new, changed or removed sequences are reduced, the other "
+                             "ranks are copied from the previous reduction. A new manifest is written.")
+    parser.add_argument("--align-cache", default=None,
+                        help="Directory of the alignment cache on a local filesystem of every executor (not "
+                             "a network filesystem). The cache keeps the alignments between runs, so runs with "
+                             "another threshold or stride do not align again")
+    parser.add_argument("--align-cache-size", type=int, default=1024,
+                        help="The maximum size of the alignment cache in MiB, the least recently used "
+                             "alignments are removed (default 1024)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Profile the TaxID lookups, the lineage walks and the alignments, and write the "
+                             "time, calls, bases aligned and alignment cells of every function and the costs "
+                             "and the kept and dropped bases of every rank TaxID to outfile.profile.json and "
+                             "outfile.profile.csv")
+    parser.add_argument("--profile-top", type=int, default=20,
+                        help="The number of most expensive rank TaxIDs in outfile.profile.json (default 20)")
+    parser.add_argument("--taxid-table", required=False, default=None,
+                        help="Path to a parquet accession to taxid table on shared storage (created with "
+                             "configure --parquet). The table is joined with the sequences so no local "
+                             "database is needed on the worker nodes.")
+    args = parser.parse_args(args)
     return vars(args)
 
 
 if __name__ == "__main__":
 
     # Get all arguments
-    std_ranks = ['species', 'genus', 'family', 'order', 'class', 'phylum', 'superkingdom']
     params = get_params()
 
-    if not check_config_files():
+    # the ranks from the lowest to the highest
+    ranks = sorted(set(params["rank"]), key=std_ranks.index)
+    rank = ranks[0]
+    if len(ranks) > 1 and (params["manifest"] or params["previous"]):
+        print("The incremental reduction and the manifest support a single rank, exiting...")
+        exit(1)
+    if params["reduction"] == "cluster" and (params["manifest"] or params["previous"]):
+        print("The incremental reduction and the manifest support a single representative per rank, exiting...")
+        exit(1)
+
+    if not check_config_files(params["taxid_table"]):
         print("Spark Sequence Reducer has not been configured, exiting...")
         exit(1)
 
+    if params["engine"] == "local":
+        if params["manifest"] or params["previous"] or params["taxid_table"]:
+            print("The local engine does not support the manifest, the incremental reduction and the parquet "
+                  "TaxID table, exiting...")
+            exit(1)
+        run_local(params, ranks, os.path.join(os.path.dirname(__file__), "data"))
+        print("The reduced sequence database has been generated and saved, exiting")
+        exit(0)
+
+    # pyspark is only needed by the spark engine
+    from pyspark import SparkConf
+    from pyspark.sql import SparkSession
+
     conf = SparkConf().setAppName("Pyspark Sequence Reducer")
-    sc = SparkContext(conf=conf)
+    spark = SparkSession.builder.config(conf=conf).getOrCreate()
+    sc = spark.sparkContext
 
-    print(sc.defaultParallelism)
+    if params["checkpoint_dir"]:
+        sc.setCheckpointDir(params["checkpoint_dir"])
+    # The statistics of every stage are counted while the output is written, so every stage
+    # (and every alignment) is computed once
+    if params["storage_level"] == "NONE" and not params["no_stats"]:
+        # the stages are computed again by every action that reads them, the accumulators would over-count
+        print("Warning: the stages are not persisted with --storage-level NONE, the sequences of every stage "
+              "are not counted")
+        params["no_stats"] = True
+    stats = None if params["no_stats"] else create_pipeline_stats(sc, ranks)
+    profile = create_profile(sc) if params["profile"] else None
 
     print("Loading sequence files...")
     # Create a rdd from the fasta file indicated by a path
-    fasta_rdd = fasta_to_rdd(params["infile"], sc)
+    fasta_rdd = fasta_to_rdd(params["infile"], sc, packed=params["packed"])
     # fasta_rdd is a rdd(accession.version, [header, sequence])
-    original_n_seq = fasta_rdd.count()
-    print(original_n_seq, " sequences have been loaded in ", fasta_rdd.getNumPartitions(), "partitions")
-    print("Done")
+    fasta_rdd = count_records(fasta_rdd, stats and stats["loaded"])
+    print("The sequences will be loaded in", fasta_rdd.getNumPartitions(), "partitions")
 
     print("Getting sequence TaxIDs")
     # Map every sequence in the rdd with a TaxID
-    seq_rdd = map_accession_to_taxid(fasta_rdd)
+    lookup_hits = sc.accumulator(0) if stats else None
+    lookup_misses = sc.accumulator(0) if stats else None
+    if params["taxid_table"]:
+        # the sequences are counted to choose the join strategy
+        fasta_rdd = persist(fasta_rdd, params["storage_level"])
+        seq_rdd = table_map_accession_to_taxid(fasta_rdd, spark, params["taxid_table"],
+                                               hits=lookup_hits, misses=lookup_misses)
+    else:
+        seq_rdd = map_accession_to_taxid(fasta_rdd, hits=lookup_hits, misses=lookup_misses, profile=profile)
     # seq_rdd = rdd((key=accession_version, v=[tax_id, header, sequence]))
     # Filter Sequences without assigned TaxID
-    seq_rdd = seq_rdd.filter(lambda x: x[1][0] != "None")
-    taxid_mapped_n_seq = seq_rdd.count()
-    print(taxid_mapped_n_seq, " sequences have been mapped to their TaxID, ",
-          original_n_seq - taxid_mapped_n_seq, " not mapped and will be filtered out.")
-    print("Done")
+    seq_rdd = filter_records(seq_rdd, lambda x: x[1][0] != "None", stats and stats["mapped"],
+                             stats and stats["unmapped"])
 
     print("Getting sequence phylogenetic information...")
     # Use the TaxID from each sequence to create the phylogenetic information
@@ -95,33 +278,111 @@ if __name__ == "__main__":
     # The respective ranks of the sequence are returned as a dictionary:
     # phylo_dict={'superkingdom': (tax_id, name), 'no rank': (tax_id, name), 'genus': (tax_id, name),
     # 'species': (tax_id, name) 'family': (tax_id, name)}
-    use_broadcast = True
-    phylo_rdd = map_phylogenetic_info(seq_rdd,
-                                      os.path.join(os.path.dirname(__file__), "data", "nodes.dmp"),
-                                      os.path.join(os.path.dirname(__file__), "data", "names.dmp"),
-                                      sc, broadcast=use_broadcast)
-    # phylo_rdd = rdd((key=phylo_dict, v=[tax_id, header, sequence]))
-    # filter not assigned
-    phylo_rdd = phylo_rdd.filter(lambda x: "unknown" not in x[0])
-    phylo_mapped_n_seq = phylo_rdd.count()
-    print("The phylogenetic information of", phylo_mapped_n_seq, " sequences has been mapped")
-    print("Done")
+    nodes_dmp = os.path.join(os.path.dirname(__file__), "data", "nodes.dmp")
+    names_dmp = os.path.join(os.path.dirname(__file__), "data", "names.dmp")
+    taxonomy_file = os.path.join(os.path.dirname(__file__), "data", "taxonomy")
+    if params["full_lineage"]:
+        use_broadcast = True
+        phylo_rdd = map_phylogenetic_info(seq_rdd, nodes_dmp, names_dmp, sc, broadcast=use_broadcast,
+                                          taxonomy_file=taxonomy_file, profile=profile)
+        # phylo_rdd = rdd((key=phylo_dict, v=[tax_id, header, sequence]))
+        # filter not assigned
+        phylo_rdd = filter_records(phylo_rdd, lambda x: "unknown" not in x[0] and any(r in x[0] for r in ranks),
+                                   stats and stats["lineage"], stats and stats["unknown_lineage"])
+        if len(ranks) > 1:
+            # key = (tax_id of every rank, -1 when unknown)
+            phylo_rdd = phylo_rdd.map(lambda x: (tuple(x[0][r][0] if r in x[0] else -1 for r in ranks), x[1]))
+    else:
+        # Resolve every distinct TaxID once to the TaxID of the chosen rank(s)
+        # (map_rank_taxid collects the distinct TaxIDs, the mapped sequences are persisted for it)
+        seq_rdd = persist(seq_rdd, params["storage_level"])
+        phylo_rdd = map_rank_taxid(seq_rdd, nodes_dmp, names_dmp, sc, rank if len(ranks) == 1 else ranks,
+                                   taxonomy_file, profile)
+        # phylo_rdd = rdd((key=rank_tax_id or (tax_id of every rank), v=[tax_id, header, sequence]))
+        # filter not assigned
+        phylo_rdd = filter_records(phylo_rdd, lambda x: max(x[0]) >= 0 if len(ranks) > 1 else x[0] >= 0,
+                                   stats and stats["lineage"], stats and stats["unknown_lineage"])
+    # The reduction plans its partitions with a first pass over the sequences
+    phylo_rdd = persist(phylo_rdd, params["storage_level"], checkpoint=params["checkpoint_dir"] is not None)
 
     print("Starting Reduction algorithm...")
     # Reduce the sequences to the given rank
-    redseq_rdd = reduce(phylo_rdd, params["rank"])
-    print("The sequences have benn reduced to ", redseq_rdd.count(), " ranks")
-    print("Done")
-
-    print("Saving results...")
-    # Persist the generated reduced sequences
-    local = True
-    if local:
-        rdd_to_fasta_local(redseq_rdd, params["outfile"])
+    prefilter_stats = create_prefilter_stats(sc) if params["prefilter"] else None
+    # the partitions of every rank are planned apart
+    partition_stats = dict((level_rank, create_partition_stats(sc)) for level_rank in ranks) if stats else None
+    align_cache = AlignmentCache(params["align_cache"], params["align_cache_size"] << 20) \
+        if params["align_cache"] else None
+    reduce_options = dict(aligner=params["aligner"], threshold=params["threshold"], stride=params["stride"],
+                          prefilter=prefilter_stats, reduction=params["reduction"], salt=params["salt"],
+                          n_partitions=params["partitions"],
+                          align_cache=align_cache, profile=profile, strand=params["strand"],
+                          segments=segmented_aligner(params), cluster_identity=params["cluster_identity"],
+                          persisted=[])
+    write_manifest_file = params["manifest"] or params["previous"] is not None
+    if write_manifest_file:
+        # key = rank tax_id, value = [tax_id, header, sequence]
+        keyed_rdd = phylo_rdd.map(lambda x: (x[0][rank][0], x[1])) if params["full_lineage"] \
+            else phylo_rdd
+    if params["previous"]:
+        manifest = read_manifest(params["previous"], params)
+        # the previous reduction is read while the new one is written
+        if manifest["output"] in [os.path.abspath(params["outfile"] + suffix)
+                                  for suffix in ["", ".fasta", ".fasta.gz"]]:
+            print("The output would overwrite the previous reduction, choose another outfile, exiting...")
+            exit(1)
+        # the fanout representative is the longest sequence of the whole group, a grown group is reduced again
+        merge_sequence = None if params["reduction"] == "fanout" else \
+            partial(pairwise_reduction_merge_sequence, threshold=params["threshold"], stride=params["stride"],
+                    aligner=params["aligner"], prefilter=prefilter_stats, align_cache=align_cache, profile=profile,
+                    strand=params["strand"], segments=segmented_aligner(params))
+        redseq_rdd = incremental_reduce(keyed_rdd, manifest, sc,
+                                        partial(reduce, rank=rank, projected=True,
+                                                partition_stats=partition_stats and partition_stats[rank],
+                                                **reduce_options),
+                                        merge_sequence)
+    elif len(ranks) > 1:
+        # every rank is saved when it is reduced, the reduced sequences are persisted for the next rank
+        for level_rank, redseq_rdd in hierarchical_reduce(phylo_rdd, ranks,
+                                                          partial(persist, storage_level=params["storage_level"]),
+                                                          partition_stats, **reduce_options):
+            print("Saving the", level_rank, "results...")
+            redseq_rdd = count_records(redseq_rdd, stats and stats["groups"][level_rank])
+            save_reduced(redseq_rdd, params["outfile"] + "." + level_rank, params)
+            # the next rank reads the persisted reduced sequences, not the input of this rank
+            unpersist(reduce_options["persisted"])
     else:
-        # For future saves methods
-        pass
+        redseq_rdd = reduce(phylo_rdd, rank, projected=not params["full_lineage"],
+                            partition_stats=partition_stats and partition_stats[rank], **reduce_options)
+    if len(ranks) == 1:
+        redseq_rdd = count_records(redseq_rdd, stats and stats["groups"][rank])
+        if write_manifest_file:
+            representatives = sc.accumulator({}, DictAccumulatorParam())
+            redseq_rdd = record_representatives(redseq_rdd, representatives)
+
+        print("Saving results...")
+        # Persist the generated reduced sequences, the only action that computes the reduction
+        output = save_reduced(redseq_rdd, params["outfile"], params)
+        unpersist(reduce_options["persisted"])
+    if write_manifest_file:
+        manifest = build_manifest(member_digests(keyed_rdd).collect(), representatives.value, params,
+                                  os.path.abspath(output))
+        write_manifest(manifest, params["outfile"] + ".manifest.json")
     print("Done")
 
-    sc.stop()
+    if stats:
+        print(format_stats(stats))
+        print("TaxID lookups: ", lookup_hits.value, " hits, ", lookup_misses.value, " misses")
+    for level_rank in ranks:
+        if partition_stats and partition_stats[level_rank]["estimated"]:
+            print("Estimated and actual cost of the", level_rank, "reduction partitions:")
+            print(format_partition_costs(partition_stats[level_rank]))
+    if prefilter_stats is not None:
+        print(format_prefilter_stats(prefilter_stats))
+
+    if profile is not None:
+        print(format_profile(profile))
+        print("The profile has been saved to",
+              " and ".join(write_profile_report(profile, params["outfile"], params["profile_top"])))
+
+    spark.stop()
     print("The reduced sequence database has been generated and saved, exiting")
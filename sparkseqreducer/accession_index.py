@@ -0,0 +1,223 @@
+#     accession_index: A compact memory-mapped index that maps accession numbers to taxonomic ids
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import gzip
+import heapq
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+# File layout (little endian):
+#   header   64 bytes: magic, key width, number of keys, offset of the keys, offset of the taxids
+#   keys     n * key width bytes, sorted accession.version strings padded with null bytes
+#   taxids   n * int32, taxids[i] is the taxid of keys[i]
+_MAGIC = b"SSRAIDX1"
+_HEADER = struct.Struct("<8sIIQQQ")
+_HEADER_SIZE = 64
+
+_open_indexes = {}
+
+
+class AccessionIndex(object):
+    """ Read-only view of an accession index file, the file is memory mapped so
+    pages are loaded on demand and the index can be shared by every task of a worker
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            magic, key_width, _, count, keys_offset, taxids_offset = _HEADER.unpack(f.read(_HEADER.size))
+        if magic != _MAGIC:
+            raise ValueError(filename + " is not an accession index file")
+        self.key_width = key_width
+        self.count = count
+        if count:
+            self.keys = np.memmap(filename, dtype="S%d" % key_width, mode="r", offset=keys_offset, shape=(count,))
+            self.taxids = np.memmap(filename, dtype="<i4", mode="r", offset=taxids_offset, shape=(count,))
+        else:
+            self.keys = np.empty(0, dtype="S%d" % key_width)
+            self.taxids = np.empty(0, dtype="<i4")
+
+    def __len__(self):
+        return self.count
+
+    def lookup(self, accession):
+        """ get the taxid of a single accession using binary search
+            :param accession: the accession.version string
+            :return: the taxid or None if the accession is not in the index
+        """
+        key = accession.encode("ascii") if not isinstance(accession, bytes) else accession
+        if len(key) > self.key_width or not self.count:
+            return None
+        pos = int(self.keys.searchsorted(key))
+        if pos < self.count and self.keys[pos] == key:
+            return int(self.taxids[pos])
+        return None
+
+    def lookup_batch(self, accessions):
+        """ get the taxids of many accessions with a single vectorized binary search
+            :param accessions: a sequence of accession.version strings
+            :return: a numpy int32 array with the taxids, -1 where the accession is not in the index
+        """
+        result = np.full(len(accessions), -1, dtype=np.int32)
+        if not self.count or not len(accessions):
+            return result
+        # longer keys can not be in the index, truncating them would create false matches
+        queries = np.array([a.encode("ascii") if len(a) <= self.key_width else b"" for a in accessions],
+                           dtype="S%d" % self.key_width)
+        # searching the queries in order keeps consecutive probes on nearby pages
+        order = np.argsort(queries, kind="stable")
+        queries = queries[order]
+        positions = self.keys.searchsorted(queries)
+        found = (positions < self.count) & (queries != b"")
+        found[found] = self.keys[positions[found]] == queries[found]
+        result[order[found]] = self.taxids[positions[found]]
+        return result
+
+
+def open_accession_index(filename):
+    """ open an accession index once per python process and reuse it
+        :param filename: the path to the index file
+        :return: an AccessionIndex
+    """
+    index = _open_indexes.get(filename)
+    if index is None:
+        index = AccessionIndex(filename)
+        _open_indexes[filename] = index
+    return index
+
+
+def _parse_block(lines):
+    # the accession.version and taxid columns of a block of lines as numpy arrays
+    rows = [line.split(b"\t", 3) for line in lines]
+    return np.array([row[1] for row in rows]), np.array([row[2] for row in rows]).astype("<i4")
+
+
+def _read_accession2taxid_chunks(filepath, chunk_bytes, block_lines=100000):
+    # yields (keys, taxids) numpy arrays of about chunk_bytes parsed from a nucl_*.accession2taxid.gz file,
+    # only a block of lines is held as python objects at a time
+    block_lines = max(1, min(block_lines, chunk_bytes // 64))
+    with gzip.open(filepath, "rb") as f:
+        next(f)  # skip the header line
+        blocks = []
+        n_bytes = 0
+        lines = []
+        for line in f:
+            lines.append(line)
+            if len(lines) < block_lines:
+                continue
+            blocks.append(_parse_block(lines))
+            lines = []
+            n_bytes += blocks[-1][0].nbytes + blocks[-1][1].nbytes
+            if n_bytes >= chunk_bytes:
+                yield np.concatenate([b[0] for b in blocks]), np.concatenate([b[1] for b in blocks])
+                blocks = []
+                n_bytes = 0
+        if lines:
+            blocks.append(_parse_block(lines))
+        if blocks:
+            yield np.concatenate([b[0] for b in blocks]), np.concatenate([b[1] for b in blocks])
+
+
+def _sort_run(keys, taxids, run_file):
+    # the run is saved as two .npy files so it can be memory mapped by the merge
+    order = np.argsort(keys, kind="stable")
+    np.save(run_file + ".keys.npy", keys[order])
+    np.save(run_file + ".taxids.npy", taxids[order])
+    return keys.dtype.itemsize
+
+
+def _iter_run(run_file, block_size=65536):
+    # the run is memory mapped, only a block of it is loaded at a time
+    keys = np.load(run_file + ".keys.npy", mmap_mode="r")
+    taxids = np.load(run_file + ".taxids.npy", mmap_mode="r")
+    for i in range(0, len(keys), block_size):
+        for key, taxid in zip(keys[i:i + block_size].tolist(), taxids[i:i + block_size].tolist()):
+            yield key, taxid
+
+
+def build_accession_index(filepath, index_file, chunk_bytes=512 * 1024 * 1024, tmp_dir=None):
+    """ create an accession index file using a compressed accession2taxid file,
+        the input is sorted in chunks that are merged into the final file
+        :param filepath: the path to the compressed file
+        :param index_file: the path to the index file to create
+        :param chunk_bytes: the size in bytes of the keys and taxids sorted in memory at a time
+        :param tmp_dir: the directory for the sorted runs, defaults to the index directory
+        :return: the number of accessions in the index
+    """
+    work_dir = tempfile.mkdtemp(prefix="accession_index_", dir=tmp_dir or os.path.dirname(os.path.abspath(index_file)))
+    try:
+        runs = []
+        key_width = 1
+        n_rows = 0
+        for keys, taxids in _read_accession2taxid_chunks(filepath, chunk_bytes):
+            run_file = os.path.join(work_dir, "run%05d" % len(runs))
+            key_width = max(key_width, _sort_run(keys, taxids, run_file))
+            runs.append(run_file)
+            n_rows += len(keys)
+            print("Sorted", n_rows, "rows")
+
+        taxids_file = os.path.join(work_dir, "taxids.bin")
+        count = 0
+        with open(index_file + ".tmp", "wb") as out, open(taxids_file, "wb") as taxids_out:
+            out.write(b"\0" * _HEADER_SIZE)
+            keys_offset = _HEADER_SIZE
+            keys_buf = []
+            taxids_buf = []
+            last_key = None
+            for key, taxid in heapq.merge(*[_iter_run(run) for run in runs]):
+                if key == last_key:  # keep a single mapping of duplicated accessions
+                    continue
+                last_key = key
+                keys_buf.append(key)
+                taxids_buf.append(taxid)
+                if len(keys_buf) >= 1000000:
+                    out.write(np.array(keys_buf, dtype="S%d" % key_width).tobytes())
+                    taxids_out.write(np.array(taxids_buf, dtype="<i4").tobytes())
+                    count += len(keys_buf)
+                    keys_buf = []
+                    taxids_buf = []
+            if keys_buf:
+                out.write(np.array(keys_buf, dtype="S%d" % key_width).tobytes())
+                taxids_out.write(np.array(taxids_buf, dtype="<i4").tobytes())
+                count += len(keys_buf)
+            # align the taxid array to 8 bytes
+            taxids_offset = keys_offset + count * key_width
+            padding = (-taxids_offset) % 8
+            out.write(b"\0" * padding)
+            taxids_offset += padding
+            taxids_out.close()
+            with open(taxids_file, "rb") as taxids_in:
+                shutil.copyfileobj(taxids_in, out)
+            out.seek(0)
+            out.write(_HEADER.pack(_MAGIC, key_width, 0, count, keys_offset, taxids_offset))
+        os.replace(index_file + ".tmp", index_file)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create an accession to taxid index file.")
+    parser.add_argument("infile", help="Path to nucl_gb.accession2taxid.gz")
+    parser.add_argument("outfile", help="Path to the index file to create (data/gb.idx)")
+    args = parser.parse_args()
+    print("Creating an index using", args.infile, "...")
+    n = build_accession_index(args.infile, args.outfile)
+    print("The index has been created with", n, "accessions")
@@ -0,0 +1,193 @@
+#     align_cache: A persistent cache of pairwise alignments stored as edit transcripts
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
+import os
+import re
+import sqlite3
+import time
+
+import numpy as np
+
+from sparkseqreducer.packed import sequence_bytes
+
+_gap = ord("-")
+_transcript_re = re.compile(b"([0-9]+)([MID])")
+
+# per process connections and matrix digests, a cache is opened once by every python worker
+_connections = {}
+_matrix_digests = {}
+# the caches that failed in this process, they are skipped and the pairs are aligned
+_failed = set()
+
+
+def encode_transcript(seq_a_aligned, seq_b_aligned):
+    """ the edit transcript of an alignment as run length encoded operations:
+        M both sequences have a character, I only seq_a has a character, D only seq_b has a character
+        :return: the transcript as bytes, None if a column has a gap in both sequences
+    """
+    a = np.frombuffer(seq_a_aligned.encode("latin-1"), dtype=np.uint8)
+    b = np.frombuffer(seq_b_aligned.encode("latin-1"), dtype=np.uint8)
+    if len(a) != len(b) or ((a == _gap) & (b == _gap)).any():
+        return None
+    if not len(a):
+        return b""
+    ops = np.where(a == _gap, 2, np.where(b == _gap, 1, 0)).astype(np.int8)
+    starts = np.concatenate(([0], np.nonzero(np.diff(ops))[0] + 1))
+    lengths = np.diff(np.concatenate((starts, [len(ops)])))
+    return b"".join(b"%d%s" % (length, b"MID"[op:op + 1]) for length, op in zip(lengths.tolist(),
+                                                                               ops[starts].tolist()))
+
+
+def apply_transcript(seq_a, seq_b, transcript):
+    """ rebuild the aligned sequences from the sequences and the edit transcript
+    """
+    a = sequence_bytes(seq_a)
+    b = sequence_bytes(seq_b)
+    pieces_a = []
+    pieces_b = []
+    i = j = 0
+    for length, op in _transcript_re.findall(transcript):
+        length = int(length)
+        if op == b"M":
+            pieces_a.append(a[i:i + length])
+            pieces_b.append(b[j:j + length])
+            i += length
+            j += length
+        elif op == b"I":
+            pieces_a.append(a[i:i + length])
+            pieces_b.append(b"-" * length)
+            i += length
+        else:
+            pieces_a.append(b"-" * length)
+            pieces_b.append(b[j:j + length])
+            j += length
+    return b"".join(pieces_a).decode("latin-1"), b"".join(pieces_b).decode("latin-1")
+
+
+def _matrix_digest(cmp_mat_file):
+    digest = _matrix_digests.get(cmp_mat_file)
+    if digest is None:
+        with open(cmp_mat_file, "rb") as f:
+            digest = hashlib.blake2b(f.read(), digest_size=8).hexdigest()
+        _matrix_digests[cmp_mat_file] = digest
+    return digest
+
+
+class AlignmentCache(object):
+    """ A SQLite file of alignment transcripts keyed by the content of both sequences, the aligner,
+    the comparison matrix and the gap penalties. The least recently used alignments are removed
+    when the transcripts use more than max_bytes. Only the directory and the size limit are pickled,
+    every python worker opens its own connection. The file uses a WAL journal, so the directory must
+    be on a local filesystem of every executor, not on a network filesystem. A cache that fails
+    (lock timeout, corrupt file) is skipped by the process and the pairs are aligned.
+    """
+
+    def __init__(self, directory, max_bytes=1 << 30, check_every=1000):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.check_every = check_every
+
+    @property
+    def filename(self):
+        return os.path.join(self.directory, "alignments.db")
+
+    def _connection(self):
+        key = (self.filename, os.getpid())
+        state = _connections.get(key)
+        if state is None:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory, exist_ok=True)
+            conn = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL;")
+            conn.execute("PRAGMA synchronous = OFF;")
+            conn.execute("CREATE TABLE IF NOT EXISTS alignments (key BLOB PRIMARY KEY, transcript BLOB NOT NULL, "
+                         "last_used REAL NOT NULL) WITHOUT ROWID;")
+            conn.execute("CREATE INDEX IF NOT EXISTS alignments_last_used ON alignments (last_used);")
+            state = [conn, 0]
+            _connections[key] = state
+        return state
+
+    def key(self, seq_a, seq_b, aligner, cmp_mat_file, gap_open=16, gap_extend=4):
+        params = "%s %s %d %d" % (aligner, _matrix_digest(cmp_mat_file), gap_open, gap_extend)
+        h = hashlib.blake2b(params.encode("ascii"), digest_size=20)
+        h.update(b"\0" + sequence_bytes(seq_a) + b"\0" + sequence_bytes(seq_b))
+        return h.digest()
+
+    def _skip(self, error):
+        # the alignments are still done without the cache
+        if self.filename not in _failed:
+            print("The alignment cache", self.filename, "failed and is skipped:", error)
+            _failed.add(self.filename)
+
+    def get(self, key):
+        if self.filename in _failed:
+            return None
+        try:
+            conn = self._connection()[0]
+            row = conn.execute("SELECT transcript FROM alignments WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE alignments SET last_used = ? WHERE key = ?", (time.time(), key))
+            return bytes(row[0])
+        except (sqlite3.Error, OSError) as e:
+            self._skip(e)
+            return None
+
+    def put(self, key, transcript):
+        if self.filename in _failed:
+            return
+        try:
+            state = self._connection()
+            state[0].execute("INSERT OR REPLACE INTO alignments VALUES (?, ?, ?)", (key, transcript, time.time()))
+            state[1] += 1
+            if state[1] % self.check_every == 0:
+                self.evict()
+        except (sqlite3.Error, OSError) as e:
+            self._skip(e)
+
+    def evict(self):
+        """ remove the least recently used alignments until the transcripts fit in max_bytes
+        """
+        conn = self._connection()[0]
+        size = conn.execute("SELECT COALESCE(SUM(LENGTH(transcript)), 0) FROM alignments").fetchone()[0]
+        while size > self.max_bytes:
+            rows = conn.execute("SELECT key, LENGTH(transcript) FROM alignments ORDER BY last_used LIMIT 1000") \
+                .fetchall()
+            if not rows:
+                break
+            conn.executemany("DELETE FROM alignments WHERE key = ?", [(row[0],) for row in rows])
+            size -= sum(row[1] for row in rows)
+
+    def align(self, seq_a, seq_b, align, aligner, cmp_mat_file, gap_open=16, gap_extend=4):
+        """ get the alignment of two sequences from the cache, align them and store the alignment on a miss
+            :param align: the alignment function, it returns the longest sequence first
+            :param aligner: the name of the alignment function
+            :param gap_open: the gap opening penalty, passed to align
+            :param gap_extend: the gap extension penalty, passed to align
+            :return: the two aligned sequences, the longest one first
+        """
+        if len(seq_a) < len(seq_b):
+            seq_a, seq_b = seq_b, seq_a
+        key = self.key(seq_a, seq_b, aligner, cmp_mat_file, gap_open, gap_extend)
+        transcript = self.get(key)
+        if transcript is not None:
+            return apply_transcript(seq_a, seq_b, transcript)
+        seq_a_aligned, seq_b_aligned = align(seq_a, seq_b, cmp_mat_file, gap_open=gap_open, gap_extend=gap_extend)
+        transcript = encode_transcript(seq_a_aligned, seq_b_aligned)
+        # only the transcripts that rebuild the same alignment are stored (gaps in the input, case changes)
+        if transcript is not None and apply_transcript(seq_a, seq_b, transcript) == (seq_a_aligned, seq_b_aligned):
+            self.put(key, transcript)
+        return seq_a_aligned, seq_b_aligned
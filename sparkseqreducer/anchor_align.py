@@ -0,0 +1,174 @@
+#     anchor_align: Anchor based global alignment of highly similar sequences
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from bisect import bisect_left
+
+import numpy as np
+
+from sparkseqreducer import stretcher
+from sparkseqreducer.packed import unpack
+from sparkseqreducer.sketch import encode, kmers
+
+
+def _unique_kmers(values, valid):
+    # positions of the k-mers that appear exactly once in the sequence
+    positions = np.nonzero(valid)[0]
+    uniq, first, counts = np.unique(values[positions], return_index=True, return_counts=True)
+    once = counts == 1
+    return uniq[once], positions[first[once]]
+
+
+def find_anchors(seq_a, seq_b, k=21):
+    """ find the exact k-mer matches between two sequences, only k-mers that are unique in both
+        sequences are used so every match is unambiguous
+        :return: two arrays with the positions of the matches in seq_a and seq_b, sorted by position in seq_a
+    """
+    kmers_a, pos_a = _unique_kmers(*kmers(encode(seq_a), k))
+    kmers_b, pos_b = _unique_kmers(*kmers(encode(seq_b), k))
+    common, idx_a, idx_b = np.intersect1d(kmers_a, kmers_b, assume_unique=True, return_indices=True)
+    anchors_a = pos_a[idx_a]
+    anchors_b = pos_b[idx_b]
+    order = np.argsort(anchors_a)
+    return anchors_a[order], anchors_b[order]
+
+
+def _merge_runs(anchors_a, anchors_b, k):
+    # merge the anchors that continue each other on the same diagonal into exact match runs
+    if not len(anchors_a):
+        return []
+    breaks = np.nonzero((np.diff(anchors_a) != 1) | (np.diff(anchors_b) != 1))[0] + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(anchors_a)]))
+    return [(int(anchors_a[s]), int(anchors_b[s]), int(e - s) + k - 1) for s, e in zip(starts, ends)]
+
+
+def chain_anchors(runs):
+    """ select the longest collinear chain of exact match runs (increasing in both sequences)
+        and trim the overlaps between consecutive runs
+        :param runs: a list of (pos_a, pos_b, length) sorted by pos_a
+        :return: a list of non overlapping (pos_a, pos_b, length)
+    """
+    # longest increasing subsequence on pos_b
+    tails = []
+    tails_idx = []
+    previous = [-1] * len(runs)
+    for i, run in enumerate(runs):
+        j = bisect_left(tails, run[1])
+        if j > 0:
+            previous[i] = tails_idx[j - 1]
+        if j == len(tails):
+            tails.append(run[1])
+            tails_idx.append(i)
+        else:
+            tails[j] = run[1]
+            tails_idx[j] = i
+    chain = []
+    i = tails_idx[-1] if tails_idx else -1
+    while i >= 0:
+        chain.append(runs[i])
+        i = previous[i]
+    chain.reverse()
+
+    trimmed = []
+    end_a = end_b = 0
+    for pos_a, pos_b, length in chain:
+        shift = max(end_a - pos_a, end_b - pos_b, 0)
+        if length - shift <= 0:
+            continue
+        trimmed.append((pos_a + shift, pos_b + shift, length - shift))
+        end_a = pos_a + length
+        end_b = pos_b + length
+    return trimmed
+
+
+def collinear_runs(seq_a, seq_b, k=21):
+    """ the longest collinear chain of exact match runs of unique k-mers between two sequences
+        :return: a list of non overlapping (pos_a, pos_b, length) sorted by position
+    """
+    return chain_anchors(_merge_runs(*find_anchors(seq_a, seq_b, k), k=k))
+
+
+def _align_gap(aligner, gap_a, gap_b):
+    # global alignment of the unanchored region between two anchors, keeps the order of the sequences
+    if not gap_a and not gap_b:
+        return "", ""
+    if not gap_a:
+        return "-" * len(gap_b), gap_b
+    if not gap_b:
+        return gap_a, "-" * len(gap_a)
+    if len(gap_a) >= len(gap_b):
+        return aligner.align(gap_a, gap_b)
+    aligned_b, aligned_a = aligner.align(gap_a, gap_b)
+    return aligned_a, aligned_b
+
+
+def _align_anchored(aligner, seq_a, seq_b, chain, k, min_k, max_gap_cells):
+    # join the anchors of the chain and the alignments of the regions between them
+    pieces_a = []
+    pieces_b = []
+    end_a = end_b = 0
+    for pos_a, pos_b, length in chain + [(len(seq_a), len(seq_b), 0)]:
+        gap_a, gap_b = _align_region(aligner, seq_a[end_a:pos_a], seq_b[end_b:pos_b], k, min_k, max_gap_cells)
+        pieces_a.append(gap_a)
+        pieces_b.append(gap_b)
+        pieces_a.append(seq_a[pos_a:pos_a + length])
+        pieces_b.append(seq_b[pos_b:pos_b + length])
+        end_a = pos_a + length
+        end_b = pos_b + length
+    return "".join(pieces_a), "".join(pieces_b)
+
+
+def _align_region(aligner, gap_a, gap_b, k, min_k, max_gap_cells):
+    # a region between two anchors larger than max_gap_cells is split again at the k-mers that are
+    # unique within the region, with a smaller k at every level, the small regions are aligned with stretcher
+    if len(gap_a) * len(gap_b) > max_gap_cells and k > min_k:
+        k = max(min_k, k - 4)
+        chain = collinear_runs(gap_a, gap_b, k)
+        if chain:
+            return _align_anchored(aligner, gap_a, gap_b, chain, k, min_k, max_gap_cells)
+        return _align_region(aligner, gap_a, gap_b, k, min_k, max_gap_cells)
+    return _align_gap(aligner, gap_a, gap_b)
+
+
+def align(seq_a, seq_b, cmp_mat_file, k=21, min_coverage=0.5, gap_open=16, gap_extend=4, min_k=11,
+          max_gap_cells=1 << 24):
+    """ global alignment using exact k-mer anchors, only the regions between the chained anchors
+        are aligned with stretcher. The regions larger than max_gap_cells (the product of their lengths)
+        are anchored again with the k-mers unique within the region, with a k smaller by 4 at every level
+        down to min_k, so a large unanchored region is only aligned whole when it has no anchors left.
+        Same contract as stretcher.align, the longest sequence is returned first.
+        :param seq_a: a sequence string or PackedSequence
+        :param seq_b: a sequence string or PackedSequence
+        :param cmp_mat_file: the path to the comparison matrix
+        :param k: the anchor k-mer length
+        :param min_coverage: the minimum fraction of the shortest sequence covered by anchors,
+         below it the pair is too divergent for the anchors and the full stretcher alignment is used
+        :param gap_open: the gap opening penalty
+        :param gap_extend: the gap extension penalty
+        :param min_k: the smallest k-mer length of the anchors of the large regions
+        :param max_gap_cells: the largest region aligned with stretcher while it can be anchored again
+        :return: the two aligned sequences (with gaps) as strings of the same length
+    """
+    if len(seq_a) < len(seq_b):
+        seq_a, seq_b = seq_b, seq_a
+    aligner = stretcher.get_aligner(cmp_mat_file, gap_open, gap_extend)
+    seq_a = unpack(seq_a).upper()
+    seq_b = unpack(seq_b).upper()
+
+    chain = collinear_runs(seq_a, seq_b, k)
+    covered = sum(length for _, _, length in chain)
+    if not seq_b or covered < min_coverage * len(seq_b):
+        return aligner.align(seq_a, seq_b)
+    return _align_anchored(aligner, seq_a, seq_b, chain, k, min_k, max_gap_cells)
@@ -0,0 +1,112 @@
+#     bgzf: Blocked gzip (BGZF) files, gzip files made of independent blocks of at most 64 KiB
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import struct
+import zlib
+
+# Every block is a gzip member with a "BC" extra field holding the size of the block minus one
+#   header   18 bytes: gzip magic, deflate, FEXTRA flag, mtime, xfl, os, xlen = 6, "BC", 2, block size - 1
+#   data     raw deflate data
+#   footer   8 bytes: crc32 and size of the uncompressed data
+_BLOCK_HEADER = struct.Struct("<4BI2BH2BHH")
+_BLOCK_FOOTER = struct.Struct("<II")
+# the same block size as htslib, so a block always fits in 64 KiB even if the data is not compressible
+MAX_BLOCK_DATA = 0xff00
+# the empty block that ends a BGZF file
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def compress_block(data):
+    """ compress at most MAX_BLOCK_DATA bytes to a BGZF block
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    block_size = _BLOCK_HEADER.size + len(compressed) + _BLOCK_FOOTER.size
+    return _BLOCK_HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord("B"), ord("C"), 2, block_size - 1) + \
+        compressed + _BLOCK_FOOTER.pack(zlib.crc32(data) & 0xffffffff, len(data))
+
+
+class BgzfWriter(object):
+    """ Binary file object that writes a BGZF file, readable by any gzip reader
+    """
+
+    def __init__(self, filename, eof=True):
+        self._file = open(filename, "wb")
+        self._buffer = bytearray()
+        self._eof = eof
+
+    def write(self, data):
+        self._buffer.extend(data)
+        while len(self._buffer) >= MAX_BLOCK_DATA:
+            self._file.write(compress_block(bytes(self._buffer[:MAX_BLOCK_DATA])))
+            del self._buffer[:MAX_BLOCK_DATA]
+        return len(data)
+
+    def close(self):
+        if self._file is None:
+            return
+        if self._buffer:
+            self._file.write(compress_block(bytes(self._buffer)))
+            self._buffer = bytearray()
+        if self._eof:
+            self._file.write(EOF_BLOCK)
+        self._file.close()
+        self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def is_bgzf(filename):
+    """ check if a file starts with a BGZF block
+    """
+    with open(filename, "rb") as f:
+        header = f.read(_BLOCK_HEADER.size)
+    return len(header) == _BLOCK_HEADER.size and header[:4] == b"\x1f\x8b\x08\x04" and header[12:14] == b"BC"
+
+
+def block_offsets(filename):
+    """ get the offset of every block of a BGZF file reading only the block headers
+    """
+    offsets = []
+    with open(filename, "rb") as f:
+        offset = 0
+        while True:
+            header = f.read(_BLOCK_HEADER.size)
+            if len(header) < _BLOCK_HEADER.size:
+                break
+            offsets.append(offset)
+            offset += _BLOCK_HEADER.unpack(header)[-1] + 1
+            f.seek(offset)
+    return offsets
+
+
+def read_blocks(filename, offset=0):
+    """ decompress the blocks of a BGZF file starting at the block at the given offset
+        :return: an iterator of (block offset, uncompressed data)
+    """
+    with open(filename, "rb") as f:
+        f.seek(offset)
+        while True:
+            header = f.read(_BLOCK_HEADER.size)
+            if len(header) < _BLOCK_HEADER.size:
+                break
+            block_size = _BLOCK_HEADER.unpack(header)[-1] + 1
+            data = f.read(block_size - _BLOCK_HEADER.size)
+            yield offset, zlib.decompress(data[:-_BLOCK_FOOTER.size], -15)
+            offset += block_size
@@ -13,18 +13,87 @@
 #
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import os
+
 from sparkseqreducer import taxid_map
+from sparkseqreducer.accession_index import build_accession_index
+from sparkseqreducer.taxonomy import build_taxonomy
+
+_data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+
 
+def configure_db(nucl_data_file, db_file=os.path.join(_data_dir, "gb.db"), bulk=True, batch_size=100000,
+                 resume=False):
+    """ create the accession to taxid database using a compressed accession2taxid file
+        :param nucl_data_file: the path to nucl_gb.accession2taxid.gz
+        :param db_file: the path to the database to create
+        :param bulk: use the fast bulk loader, otherwise use the original row by row loader
+        :param batch_size: the number of rows per insert batch of the bulk loader
+        :param resume: continue an interrupted bulk load
+        :return: 0 on success, -1 on error
+    """
+    conn = taxid_map.create_connection(db_file)
+    if conn is None:
+        return -1
+    if bulk:
+        res = taxid_map.bulk_create_accession2taxid_db(conn, nucl_data_file, batch_size, resume)
+    else:
+        res = taxid_map.create_accession2taxid_db(conn, nucl_data_file)
+    taxid_map.close_connection(conn)
+    return res
 
-def configure_db(nucl_data_file):
-    conn = taxid_map.create_connection("../data/gb.db")
-    if conn is not None:
-        taxid_map.create_accession2taxid_db(conn, nucl_data_file)
-        taxid_map.close_connection(conn)
-    return 0
+
+def get_params():
+    parser = argparse.ArgumentParser(description="Spark Sequence Reducer configuration.")
+    parser.add_argument("--accession2taxid", default=os.path.join(_data_dir, "nucl_gb.accession2taxid.gz"),
+                        help="Path to nucl_gb.accession2taxid.gz")
+    parser.add_argument("--db", default=os.path.join(_data_dir, "gb.db"),
+                        help="Path to the accession to taxid database to create")
+    parser.add_argument("--index", default=None,
+                        help="Also create a memory-mapped accession index at this path (e.g. data/gb.idx)")
+    parser.add_argument("--batch-size", type=int, default=100000,
+                        help="Number of rows per insert batch")
+    parser.add_argument("--resume", action="store_true",
+                        help="Resume an interrupted database load, the database must pass an integrity check")
+    parser.add_argument("--legacy", action="store_true",
+                        help="Use the original row by row loader and table layout")
+    parser.add_argument("--parquet", default=None,
+                        help="Also write the accession to taxid table as a parquet dataset at this path "
+                             "(shared storage, requires spark-submit)")
+    parser.add_argument("--no-db", action="store_true",
+                        help="Do not create the accession to taxid database")
+    parser.add_argument("--nodes", default=os.path.join(_data_dir, "nodes.dmp"),
+                        help="Path to nodes.dmp")
+    parser.add_argument("--names", default=os.path.join(_data_dir, "names.dmp"),
+                        help="Path to names.dmp")
+    parser.add_argument("--taxonomy", default=None,
+                        help="Also create the taxonomy cache at this path directory (e.g. data/taxonomy)")
+    return vars(parser.parse_args())
 
 
 if __name__ == "__main__":
-    print("Creating a database using nucl_gb.accession2taxid.gz ...")
-    configure_db("../data/nucl_gb.accession2taxid.gz")
-    print("The database has been created")
+    params = get_params()
+    if not params["no_db"]:
+        print("Creating a database using", params["accession2taxid"], "...")
+        if configure_db(params["accession2taxid"], params["db"], not params["legacy"], params["batch_size"],
+                        params["resume"]) != 0:
+            print("The database could not be created")
+            exit(1)
+        print("The database has been created")
+    if params["index"]:
+        print("Creating an accession index using", params["accession2taxid"], "...")
+        n = build_accession_index(params["accession2taxid"], params["index"])
+        print("The index has been created with", n, "accessions")
+    if params["taxonomy"]:
+        print("Creating the taxonomy cache using", params["nodes"], "and", params["names"], "...")
+        build_taxonomy(params["nodes"], params["names"]).save(params["taxonomy"])
+        print("The taxonomy cache has been created")
+    if params["parquet"]:
+        from pyspark.sql import SparkSession
+
+        print("Creating a parquet table using", params["accession2taxid"], "...")
+        spark = SparkSession.builder.appName("Pyspark Sequence Reducer configuration").getOrCreate()
+        taxid_map.accession2taxid_to_parquet(spark, params["accession2taxid"], params["parquet"])
+        spark.stop()
+        print("The parquet table has been created")
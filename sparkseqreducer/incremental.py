@@ -0,0 +1,200 @@
+#     incremental: Incremental reduction of new sequences against a previously reduced database
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import json
+
+from sparkseqreducer.sequence_io import fasta_to_rdd, header_accession
+from sparkseqreducer.sketch import content_hash
+
+# The manifest of a reduced database (JSON):
+#   params   the parameters of the reduction that change its output, an incremental run must use the same
+#   output   the path of the reduced fasta file (or directory of part files)
+#   groups   rank TaxID -> {"representative": accession, "members": {accession: sequence digest}}
+manifest_params = ["rank", "threshold", "stride", "aligner", "reduction", "prefilter", "strand", "segment_threshold",
+                   "segment_length", "packed"]
+
+
+def sequence_digest(seq):
+    return content_hash(seq).hex()
+
+
+def member_digests(keyed_rdd):
+    """ get the accession and the digest of the sequence of every member of a rank
+        :param keyed_rdd: a rdd with key = rank tax_id, value = [tax_id, header, sequence]
+        :return: a rdd with key = rank tax_id, value = (accession, digest)
+    """
+    return keyed_rdd.mapValues(lambda x: (header_accession(x[1]), sequence_digest(x[2])))
+
+
+def _record_representatives(records, representatives):
+    found = {}
+    for taxid, seqs in records:
+        found[str(taxid)] = header_accession(seqs[0][1])
+        yield taxid, seqs
+    representatives.add(found)
+
+
+def record_representatives(reduced_rdd, representatives):
+    """ add the accession of the representative of every rank to a dictionary accumulator
+        when the reduced rdd is computed
+    """
+    return reduced_rdd.mapPartitions(lambda records: _record_representatives(records, representatives),
+                                     preservesPartitioning=True)
+
+
+def build_manifest(members, representatives, params, output):
+    """ create the manifest of a reduced database
+        :param members: a list of (rank tax_id, (accession, digest))
+        :param representatives: a dictionary str(rank tax_id) -> accession of the representative
+        :param params: the parameters of the reduction
+        :param output: the path of the reduced database
+    """
+    groups = {}
+    for taxid, (accession, digest) in members:
+        groups.setdefault(str(taxid), {"representative": representatives.get(str(taxid)), "members": {}})
+        groups[str(taxid)]["members"][accession] = digest
+    return {"params": dict((name, params[name]) for name in manifest_params), "output": output, "groups": groups}
+
+
+def write_manifest(manifest, filename):
+    with open(filename, "w") as f:
+        json.dump(manifest, f)
+
+
+def read_manifest(filename, params):
+    """ read the manifest of a previous reduction and check that it used the same parameters
+        :raises ValueError: if a parameter of the previous reduction is different or was not recorded
+    """
+    with open(filename) as f:
+        manifest = json.load(f)
+    for name in manifest_params:
+        if name not in manifest["params"]:
+            raise ValueError("The manifest of the previous reduction does not record %s, reduce the previous "
+                             "release again with --manifest" % name)
+        if manifest["params"][name] != params[name]:
+            raise ValueError("The previous reduction used %s = %s, an incremental reduction must use the same "
+                             "value" % (name, manifest["params"][name]))
+    return manifest
+
+
+def known_accessions(manifest):
+    # accession -> (rank tax_id, digest)
+    return dict((accession, (int(taxid), digest)) for taxid, group in manifest["groups"].items()
+                for accession, digest in group["members"].items())
+
+
+def classify_member(taxid, accession, digest, known):
+    """ compare a sequence with the previous reduction
+        :return: a list of (rank tax_id, "new" or "changed"), empty if the sequence did not change
+    """
+    previous = known.get(accession)
+    if previous is None:
+        return [(taxid, "new")]
+    if previous == (taxid, digest):
+        return []
+    # the sequence or its rank changed, both the old and the new rank are affected
+    return [(taxid, "changed"), (previous[0], "changed")]
+
+
+def plan_groups(changes, removed_taxids, previous_taxids):
+    """ choose what to do with the groups affected by the changes
+        :param changes: a list of (rank tax_id, "new" or "changed")
+        :param removed_taxids: the ranks of the accessions that are no longer in the input
+        :param previous_taxids: the ranks of the previous reduction
+        :return: the set of ranks to reduce again from their sequences and the set of ranks that
+         only have new sequences, to align against the previous reduction
+    """
+    recompute = set(removed_taxids)
+    grown = set()
+    for taxid, change in changes:
+        if change == "changed" or taxid not in previous_taxids:
+            recompute.add(taxid)
+        else:
+            grown.add(taxid)
+    return recompute, grown - recompute
+
+
+def parse_reduced_header(header):
+    """ get the original header and the position in its group of a record of a reduced database
+        :return: (header, 0 for the representative or i for the i-th unique region)
+    """
+    header, tag = header.rsplit(", ", 1)
+    if tag.startswith("Representative"):
+        return header, 0
+    return header, int(tag[len("Unique"):])
+
+
+def read_reduced(file_loc, sc, taxids):
+    """ read the groups of a reduced database
+        :param file_loc: the path of the reduced database
+        :param sc: the spark context
+        :param taxids: a broadcast variable with the dictionary accession -> rank tax_id of the previous reduction
+        :return: a rdd with key = rank tax_id, value = [representative, (region, fastaHeader), ...]
+    """
+    def key_record(record):
+        header, position = parse_reduced_header(record[1][0])
+        return taxids.value.get(record[0]), (position, (record[1][1], header))
+
+    return fasta_to_rdd(file_loc, sc).map(key_record).filter(lambda x: x[0] is not None) \
+        .groupByKey().mapValues(lambda records: [record[1] for record in sorted(records, key=lambda r: r[0])])
+
+
+def fold_new_sequences(sequences, new_sequences, merge_sequence):
+    """ reduce new sequences into a previously reduced group, in header order
+        :param sequences: the previous group, [representative, (region, fastaHeader), ...]
+        :param new_sequences: the new (sequence, fastaHeader)
+        :param merge_sequence: the mergeValue function of the reduction
+    """
+    sequences = list(sequences)
+    for seq in sorted(new_sequences, key=lambda s: s[1]):
+        sequences = merge_sequence(sequences, seq)
+    return sequences
+
+
+def incremental_reduce(keyed_rdd, manifest, sc, reduce_groups, merge_sequence):
+    """ reduce the sequences using a previous reduction, the groups without changes are copied,
+        the groups that only have new sequences align them against the previous representative,
+        the groups with changed or removed sequences and the new groups are reduced again
+        :param keyed_rdd: a rdd with key = rank tax_id, value = [tax_id, header, sequence]
+        :param manifest: the manifest of the previous reduction
+        :param sc: the spark context
+        :param reduce_groups: a function that reduces a rdd like keyed_rdd
+        :param merge_sequence: the mergeValue function of the reduction, None when the new sequences can not be
+         folded into a previous group (fanout reduction), the groups with new sequences are then reduced again
+        :return: a rdd with key = rank tax_id, value = [representative, (region, fastaHeader), ...]
+    """
+    known = known_accessions(manifest)
+    known_bc = sc.broadcast(known)
+    digests = member_digests(keyed_rdd)
+    changes = digests.flatMap(lambda x: classify_member(x[0], x[1][0], x[1][1], known_bc.value)).distinct().collect()
+    removed = sc.parallelize(list(known)).subtract(digests.map(lambda x: x[1][0])).collect()
+    recompute, grown = plan_groups(changes, [known[accession][0] for accession in removed],
+                                   set(int(taxid) for taxid in manifest["groups"]))
+    if merge_sequence is None:
+        recompute, grown = recompute | grown, set()
+    print(len(recompute), "ranks will be reduced again,", len(grown), "ranks have new sequences only")
+    recompute_bc = sc.broadcast(recompute)
+    grown_bc = sc.broadcast(grown)
+
+    previous = read_reduced(manifest["output"], sc, sc.broadcast(dict((a, t[0]) for a, t in known.items()))) \
+        .filter(lambda x: x[0] not in recompute_bc.value)
+    copied = previous.filter(lambda x: x[0] not in grown_bc.value)
+    new_sequences = keyed_rdd.filter(lambda x: x[0] in grown_bc.value and header_accession(x[1][1]) not in
+                                     known_bc.value) \
+        .mapValues(lambda x: (x[2], x[1]))
+    folded = previous.filter(lambda x: x[0] in grown_bc.value).cogroup(new_sequences) \
+        .flatMapValues(lambda groups: [fold_new_sequences(group, groups[1], merge_sequence) for group in groups[0]])
+    reduced = reduce_groups(keyed_rdd.filter(lambda x: x[0] in recompute_bc.value))
+    return copied.union(folded).union(reduced)
@@ -0,0 +1,403 @@
+#     local_engine: Runs the reduction pipeline on a single machine with a process pool, without Spark
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import gzip
+import os
+import pickle
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import partial, reduce
+
+from sparkseqreducer import partitioner, profiler, reducer
+from sparkseqreducer.align_cache import AlignmentCache
+from sparkseqreducer.phylogenetic_map import generate_dict, get_rank_taxids
+from sparkseqreducer.pipeline import create_pipeline_stats, format_stats
+from sparkseqreducer.segment_align import segmented_aligner
+from sparkseqreducer.sequence_io import parse_fasta_records, write_fasta_stream
+from sparkseqreducer.taxid_map import default_db_path, default_index_path, map_partition_accession_to_taxid, \
+    map_partition_accession_to_taxid_index
+from sparkseqreducer.taxonomy import is_taxonomy, load_taxonomy
+
+
+class LocalAccumulator(object):
+    """ The local counterpart of a spark accumulator. The copies sent to the worker processes start from zero,
+    the values of their copies are added back by the main process.
+    """
+
+    def __init__(self, value, accum_param=None):
+        self.value = value
+        self.accum_param = accum_param
+
+    def add(self, term):
+        if self.accum_param is None:
+            self.value += term
+        else:
+            self.value = self.accum_param.addInPlace(self.value, term)
+
+    def zero(self):
+        return type(self.value)() if self.accum_param is None else self.accum_param.zero(self.value)
+
+    def __reduce__(self):
+        return LocalAccumulator, (self.zero(), self.accum_param)
+
+
+class LocalContext(object):
+    """ The parts of the spark context used to create the statistics of the pipeline
+    """
+
+    def __init__(self, workers=None):
+        self.defaultParallelism = workers or os.cpu_count() or 1
+
+    def accumulator(self, value, accum_param=None):
+        return LocalAccumulator(value, accum_param)
+
+
+class SpilledGroups(object):
+    """ The sequences of a rank grouped by key. They are kept in memory up to memory_bytes bases, then
+    they are appended to bucket files by the hash of their key, so a bucket holds whole groups and the
+    sequences of a group stay in arrival order. The buckets are read back one at a time.
+    """
+
+    def __init__(self, memory_bytes=4 << 30, n_buckets=64, tmp_dir=None):
+        self.memory_bytes = memory_bytes
+        self.n_buckets = n_buckets
+        self.tmp_dir = tmp_dir
+        self.work_dir = None
+        self.groups = {}
+        self.size = 0
+
+    def add(self, key, value):
+        # value = [tax_id, header, sequence]
+        self.groups.setdefault(key, []).append(value)
+        self.size += len(value[2])
+        if self.size > self.memory_bytes:
+            self.spill()
+
+    def spill(self):
+        # append the groups in memory to the bucket files
+        if self.work_dir is None:
+            self.work_dir = tempfile.mkdtemp(prefix="local_groups_", dir=self.tmp_dir)
+        buckets = {}
+        for key, values in self.groups.items():
+            buckets.setdefault(hash(key) % self.n_buckets, []).append((key, values))
+        for bucket, groups in buckets.items():
+            with open(os.path.join(self.work_dir, "bucket%03d" % bucket), "ab") as f:
+                for group in groups:
+                    pickle.dump(group, f, pickle.HIGHEST_PROTOCOL)
+        self.groups = {}
+        self.size = 0
+
+    def buckets(self):
+        """ the groups bucket by bucket, the bucket files are removed once they are read
+            :return: an iterator of dictionaries key -> [[tax_id, header, sequence], ...]
+        """
+        if self.work_dir is None:
+            groups, self.groups = self.groups, {}
+            yield groups
+            return
+        self.spill()
+        try:
+            for name in sorted(os.listdir(self.work_dir)):
+                groups = {}
+                with open(os.path.join(self.work_dir, name), "rb") as f:
+                    while True:
+                        try:
+                            key, values = pickle.load(f)
+                        except EOFError:
+                            break
+                        groups.setdefault(key, []).extend(values)
+                os.remove(os.path.join(self.work_dir, name))
+                yield groups
+        finally:
+            shutil.rmtree(self.work_dir, ignore_errors=True)
+
+
+def accumulator_values(stats):
+    # the values of the accumulators of a statistics dictionary, None when there are no statistics
+    if stats is None:
+        return None
+    return dict((name, acc.value) for name, acc in stats.items() if isinstance(acc, LocalAccumulator))
+
+
+def add_accumulator_values(stats, values):
+    # add the values returned by a worker process to the accumulators of the main process
+    if stats is not None:
+        for name, value in values.items():
+            stats[name].add(value)
+
+
+def input_files(file_loc):
+    """ the fasta files of a path, the files of a directory are read in name order
+    """
+    if not os.path.isdir(file_loc):
+        return [file_loc]
+    return [os.path.join(file_loc, name) for name in sorted(os.listdir(file_loc))
+            if not name.startswith((".", "_")) and os.path.isfile(os.path.join(file_loc, name))]
+
+
+def read_fasta_records(filename):
+    """ stream the fasta records of a plain, gzip or BGZF file, a record is a header line followed by the
+        sequence lines, the same records fasta_to_rdd splits with its delimiter
+    """
+    with open(filename, "rb") as f:
+        compressed = f.read(2) == b"\x1f\x8b"
+    with (gzip.open(filename, "rt", encoding="latin-1") if compressed
+          else open(filename, "r", encoding="latin-1")) as f:
+        record = []
+        for line in f:
+            if line.startswith(">") and record:
+                yield "".join(record)
+                record = []
+            record.append(line)
+        if record:
+            yield "".join(record)
+
+
+def read_fasta(file_loc, packed=False):
+    """ stream the sequences of a fasta file or directory
+        :return: an iterator of (accession.version, [header, sequence])
+    """
+    for filename in input_files(file_loc):
+        for record in parse_fasta_records(read_fasta_records(filename), packed):
+            yield record
+
+
+def count_records(records, counter):
+    for record in records:
+        counter.add(1)
+        yield record
+
+
+def map_taxids(records, db_file=None, index_file=None, batch_size=500, hits=None, misses=None, profile=None):
+    """ look the TaxID of the sequences up in batches, with the accession index when it exists
+        :return: an iterator of (accession_version, [tax_id, header, sequence]), tax_id is "None" when not found
+    """
+    index_file = index_file or default_index_path()
+    if os.path.isfile(index_file):
+        return map_partition_accession_to_taxid_index(0, records, index_file, max(batch_size, 10000), hits, misses,
+                                                      profile)
+    return map_partition_accession_to_taxid(0, records, db_file or default_db_path(), batch_size, hits, misses,
+                                            profile)
+
+
+def map_rank_keys(records, tax_tree, ranks, stats=None, profile=None):
+    """ key the sequences by the TaxID of every rank, every distinct TaxID is resolved once,
+        the sequences without a TaxID or without a TaxID of any of the ranks are dropped
+        :return: an iterator of ((tax_id of every rank, -1 when unknown), [tax_id, header, sequence])
+    """
+    get_projection = profiler.profiled(profile, "lineage", get_rank_taxids)
+    projection = {}
+    for accession, value in records:
+        if value[0] == "None":
+            if stats:
+                stats["unmapped"].add(1)
+            continue
+        if stats:
+            stats["mapped"].add(1)
+        key = projection.get(value[0])
+        if key is None:
+            key = projection[value[0]] = get_projection(tax_tree, value[0], ranks)
+        if max(key) < 0:
+            if stats:
+                stats["unknown_lineage"].add(1)
+            continue
+        if stats:
+            stats["lineage"].add(1)
+        yield key, value
+
+
+def reduce_group(key, values, rank, threshold=0.95, stride=100, aligner="stretcher", prefilter=None,
+                 reduction="combine", align_cache=None, profile=None, strand=False, segments=None,
+                 cluster_identity=0.9):
+    """ reduce the sequences of a rank TaxID in input order, the first one with seq_to_list and the next ones with
+        pairwise_reduction_merge_sequence (add_to_clusters for the cluster reduction), like reducer.reduce does when
+        all of them arrive in a single partition in that order
+        :param key: the key of the group
+        :param values: a list of (seq, fastaHeader)
+        :param rank: the name of the rank in the profile
+        :return: the key, the reduced groups [[representative, (region, fastaHeader), ...], ...], a single one
+         unless the reduction is "cluster", and the values of the prefilter and profile accumulators of this group
+    """
+    if profile is not None:
+        values = [value for _, value in profiler.count_bases([(key, value) for value in values], profile, rank,
+                                                             "input_bases")]
+        reduced = profiler.profiled_taxon(profile, rank, key, _reduce_values, values, threshold, stride, aligner,
+                                          prefilter, reduction, align_cache, profile, strand, segments,
+                                          cluster_identity, key)
+        list(profiler.count_bases([(key, group) for group in reduced], profile, rank, "kept_bases"))
+    else:
+        reduced = _reduce_values(values, threshold, stride, aligner, prefilter, reduction, align_cache, None, strand,
+                                 segments, cluster_identity, key)
+    return key, reduced, accumulator_values(prefilter), accumulator_values(profile)
+
+
+def _reduce_values(values, threshold, stride, aligner, prefilter, reduction, align_cache, profile, strand, segments,
+                   cluster_identity, key):
+    if prefilter is not None:
+        values = [value for _, value in reducer.remove_duplicates(((key, value) for value in values), prefilter)]
+    if reduction == "cluster":
+        values = [reducer.add_sketch(value) for value in values]
+    if reduction == "cluster":
+        clusters = reducer.create_clusters(values[0])
+        for value in values[1:]:
+            clusters = reducer.add_to_clusters(clusters, value, threshold, stride, aligner, prefilter, align_cache,
+                                               profile, strand, segments, cluster_identity)
+        return reducer.clusters_to_groups(clusters)
+    if reduction == "fanout":
+        representative = reduce(reducer.longest_sequence, values)
+        regions = [(1, region) for member in values for region in
+                   reducer.align_to_representative(member, representative, threshold, stride, aligner, prefilter,
+                                                   align_cache, profile, strand, segments)]
+        return [reducer.order_reduced([(0, representative)] + regions)]
+    sequences = reducer.seq_to_list(values[0])
+    for value in values[1:]:
+        sequences = reducer.pairwise_reduction_merge_sequence(sequences, value, threshold, stride, aligner,
+                                                              prefilter, align_cache, profile, strand, segments)
+    return [[(seq[0], seq[1]) for seq in sequences]]
+
+
+def reduce_groups(groups, rank, executor=None, prefilter=None, profile=None, **reduce_options):
+    """ reduce the groups of a rank in the worker processes, the most expensive groups are started first
+        and the results are yielded in key order as soon as they are done, so they can be written while
+        the other groups are reduced
+        :param groups: a dictionary key -> [(seq, fastaHeader), ...]
+        :param executor: a concurrent.futures executor, None to reduce the groups in this process
+        :return: an iterator of (key, [representative, (region, fastaHeader), ...]) sorted by key, with a group
+         per cluster of the key with the "cluster" reduction
+    """
+    task = partial(reduce_group, rank=rank, prefilter=prefilter, profile=profile, **reduce_options)
+    if executor is None:
+        for key in sorted(groups):
+            for group in task(key, groups[key])[1]:
+                yield key, group
+        return
+
+    costs = dict((key, partitioner.estimate_cost(len(values), sum(len(v[0]) for v in values),
+                                                 max(len(v[0]) for v in values)))
+                 for key, values in groups.items())
+    futures = dict((key, executor.submit(task, key, groups[key]))
+                   for key in sorted(groups, key=costs.get, reverse=True))
+    for key in sorted(futures):
+        # the result is released once it is yielded
+        result = futures.pop(key).result()
+        # the accumulators of the main process are only updated by the results of the workers
+        add_accumulator_values(prefilter, result[2])
+        add_accumulator_values(profile, result[3])
+        for group in result[1]:
+            yield key, group
+
+
+def local_hierarchical_reduce(keyed_records, ranks, executor=None, memory_bytes=4 << 30, tmp_dir=None,
+                              **reduce_options):
+    """ reduce the sequences to several ranks like reducer.hierarchical_reduce
+        :param keyed_records: an iterator of ((tax_id of every rank), [tax_id, header, sequence])
+        :param memory_bytes: the bases of a rank held in memory, the groups of a larger rank are spilled to
+         bucket files and reduced one bucket at a time
+        :param tmp_dir: the directory of the bucket files, defaults to the temporary directory of the system
+        :return: an iterator of (rank, iterator of (rank tax_id, [representative, (region, fastaHeader), ...])),
+         the groups of a rank are yielded while they are reduced, they must be consumed before the next rank,
+         sorted by key when the rank fits in memory and by key within every bucket otherwise
+    """
+    level = SpilledGroups(memory_bytes, tmp_dir=tmp_dir)
+    for key, value in keyed_records:
+        level.add(key, value)
+    for i, rank in enumerate(ranks):
+        next_level = SpilledGroups(memory_bytes, tmp_dir=tmp_dir) if i + 1 < len(ranks) else None
+        reduced = _level_groups(level, rank, executor, next_level, reduce_options)
+        yield rank, reduced
+        # the groups the consumer did not read are still needed by the next rank
+        for _ in reduced:
+            pass
+        level = next_level
+
+
+def _level_groups(level, rank, executor, next_level, reduce_options):
+    # yield the groups of a rank bucket by bucket, their sequences are added to next_level for the next rank
+    for groups in level.buckets():
+        known = dict((key, [(value[2], value[1]) for value in values]) for key, values in groups.items()
+                     if key[0] >= 0)
+        for key, seqs in reduce_groups(known, rank, executor, **reduce_options):
+            if next_level is not None:
+                for next_key, value in reducer.level_sequences(key, seqs):
+                    next_level.add(next_key, value)
+            yield key[0], seqs
+        if next_level is not None:
+            # the sequences without a tax_id of this rank go up unreduced, after the reduced ones
+            for key, values in groups.items():
+                if key[0] < 0:
+                    for value in values:
+                        next_level.add(key[1:], value)
+
+
+def run_local(params, ranks, data_dir):
+    """ run the pipeline of sparkseqreducer.py on this machine, the groups of every rank are reduced by a
+        pool of params["workers"] processes and the output is written while the groups are reduced
+        :param params: the parameters of sparkseqreducer.py
+        :param ranks: the ranks from the lowest to the highest
+        :param data_dir: the directory of the configuration files
+    """
+    context = LocalContext(params["workers"])
+    stats = None if params["no_stats"] else create_pipeline_stats(context, ranks)
+    profile = profiler.create_profile(context) if params["profile"] else None
+    prefilter = reducer.create_prefilter_stats(context) if params["prefilter"] else None
+    align_cache = AlignmentCache(params["align_cache"], params["align_cache_size"] << 20) \
+        if params["align_cache"] else None
+    compression = None if params["compression"] == "none" else params["compression"]
+
+    print("Loading the taxonomy...")
+    taxonomy_file = os.path.join(data_dir, "taxonomy")
+    if is_taxonomy(taxonomy_file):
+        tax_tree = load_taxonomy(taxonomy_file)
+    else:
+        tax_tree = generate_dict(os.path.join(data_dir, "nodes.dmp"), os.path.join(data_dir, "names.dmp"))
+
+    print("Loading sequences, getting their TaxIDs and their phylogenetic information...")
+    lookup_hits = context.accumulator(0)
+    lookup_misses = context.accumulator(0)
+    records = read_fasta(params["infile"], params["packed"])
+    if stats:
+        records = count_records(records, stats["loaded"])
+    records = map_taxids(records, os.path.join(data_dir, "gb.db"), os.path.join(data_dir, "gb.idx"), hits=lookup_hits,
+                         misses=lookup_misses, profile=profile)
+    keyed_records = map_rank_keys(records, tax_tree, ranks, stats, profile)
+
+    print("Starting Reduction algorithm with", context.defaultParallelism, "processes...")
+    reduce_options = dict(threshold=params["threshold"], stride=params["stride"], aligner=params["aligner"],
+                          prefilter=prefilter, reduction=params["reduction"], align_cache=align_cache,
+                          profile=profile, strand=params["strand"], segments=segmented_aligner(params),
+                          cluster_identity=params["cluster_identity"])
+    # the groups are reduced in this process when there is a single worker
+    with ProcessPoolExecutor(context.defaultParallelism) if context.defaultParallelism > 1 else nullcontext() \
+            as executor:
+        for rank, reduced in local_hierarchical_reduce(keyed_records, ranks, executor,
+                                                       memory_bytes=params["local_memory"] << 20, **reduce_options):
+            if stats:
+                reduced = count_records(reduced, stats["groups"][rank])
+            outfile = params["outfile"] if len(ranks) == 1 else params["outfile"] + "." + rank
+            print("Saving the", rank, "results to", write_fasta_stream(reduced, outfile, compression))
+    print("Done")
+
+    if stats:
+        print(format_stats(stats))
+        print("TaxID lookups: ", lookup_hits.value, " hits, ", lookup_misses.value, " misses")
+    if prefilter is not None:
+        print(reducer.format_prefilter_stats(prefilter))
+    if profile is not None:
+        print(profiler.format_profile(profile))
+        print("The profile has been saved to",
+              " and ".join(profiler.write_profile_report(profile, params["outfile"], params["profile_top"])))
+
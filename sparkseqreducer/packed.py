@@ -0,0 +1,128 @@
+#     packed: A compact 2 bit representation of nucleotide sequences
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import numpy as np
+
+# A, C, G, T -> 0..3 (lower case is packed as upper case, the sequences are read upper cased), anything else -> 4
+_codes = np.full(256, 4, dtype=np.uint8)
+for _i, _c in enumerate(b"ACGT"):
+    _codes[_c] = _i
+    _codes[ord(chr(_c).lower())] = _i
+_bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+
+
+class PackedSequence(object):
+    """ A nucleotide sequence packed 4 bases per byte, the runs of other characters
+    (N and the IUPAC codes) are kept apart as (start, characters) and packed as A
+    """
+    __slots__ = ("length", "data", "exceptions")
+
+    def __init__(self, length, data, exceptions=()):
+        self.length = length
+        self.data = data
+        self.exceptions = exceptions
+
+    def __len__(self):
+        return self.length
+
+    def __reduce__(self):
+        # pickled as the three fields only, sequences are pickled on every shuffle
+        return PackedSequence, (self.length, self.data, self.exceptions)
+
+    def __eq__(self, other):
+        return isinstance(other, PackedSequence) and self.length == other.length and self.data == other.data \
+            and self.exceptions == other.exceptions
+
+    def __hash__(self):
+        return hash((self.length, self.data, self.exceptions))
+
+    def __str__(self):
+        return self.to_bytes().decode("latin-1")
+
+    def _unpack_codes(self):
+        packed = np.frombuffer(self.data, dtype=np.uint8)
+        codes = np.empty(len(packed) * 4, dtype=np.uint8)
+        codes[0::4] = packed >> 6
+        codes[1::4] = (packed >> 4) & 3
+        codes[2::4] = (packed >> 2) & 3
+        codes[3::4] = packed & 3
+        return codes[:self.length]
+
+    def codes(self):
+        """ the 2 bit codes of the sequence, the exceptions are coded as 4
+        """
+        codes = self._unpack_codes()
+        for start, run in self.exceptions:
+            codes[start:start + len(run)] = 4
+        return codes
+
+    def to_bytes(self):
+        """ the sequence as ascii bytes
+        """
+        seq = _bases[self._unpack_codes()]
+        for start, run in self.exceptions:
+            seq[start:start + len(run)] = np.frombuffer(run, dtype=np.uint8)
+        return seq.tobytes()
+
+
+def pack(seq):
+    """ pack a nucleotide sequence, upper cased like sequence_io.normalize_sequence does for the unpacked sequences
+        :param seq: a str or bytes sequence
+        :return: a PackedSequence
+    """
+    raw = np.frombuffer(seq.encode("latin-1") if isinstance(seq, str) else seq, dtype=np.uint8)
+    codes = _codes[raw]
+    exceptions = ()
+    other = codes == 4
+    if other.any():
+        edges = np.diff(np.concatenate(([0], other.view(np.int8), [0])))
+        starts = np.nonzero(edges == 1)[0]
+        ends = np.nonzero(edges == -1)[0]
+        exceptions = tuple((int(start), raw[start:end].tobytes().upper()) for start, end in zip(starts, ends))
+        codes = codes & 3
+    quads = np.concatenate((codes, np.zeros(-len(codes) % 4, dtype=np.uint8))).reshape(-1, 4)
+    data = (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+    return PackedSequence(len(raw), data.tobytes(), exceptions)
+
+
+def encode(seq):
+    """ the 2 bit codes of a nucleotide sequence (str or PackedSequence), non ACGT characters are coded as 4
+    """
+    if isinstance(seq, PackedSequence):
+        return seq.codes()
+    return _codes[np.frombuffer(seq.encode("latin-1"), dtype=np.uint8)]
+
+
+def unpack(seq):
+    """ the str of a packed sequence, str sequences are returned as they are
+    """
+    return str(seq) if isinstance(seq, PackedSequence) else seq
+
+
+def sequence_bytes(seq):
+    """ the ascii bytes of a packed or str sequence
+    """
+    return seq.to_bytes() if isinstance(seq, PackedSequence) else seq.encode("latin-1")
+
+
+# the complement of the bases and of the IUPAC codes, in both cases
+_complement = bytes.maketrans(b"ACGTURYKMBVDHNacgturykmbvdhn", b"TGCAAYRMKVBHDNtgcaayrmkvbhdn")
+
+
+def reverse_complement(seq):
+    """ the reverse complement of a packed or str sequence, of the same type
+    """
+    complement = sequence_bytes(seq).translate(_complement)[::-1]
+    return pack(complement) if isinstance(seq, PackedSequence) else complement.decode("latin-1")
@@ -0,0 +1,112 @@
+#     partitioner: Cost based assignment of the ranks to the partitions of the reduction
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import heapq
+import time
+
+
+class DictAccumulatorParam(object):
+    """ AccumulatorParam of dictionaries, the values of the same key are added
+    """
+
+    def zero(self, value):
+        return {}
+
+    def addInPlace(self, value1, value2):
+        for key, value in value2.items():
+            value1[key] = value1.get(key, 0) + value
+        return value1
+
+
+def create_partition_stats(sc):
+    """ create the statistics of the partitions of the reduction
+        :param sc: the spark context
+        :return: a dictionary with the estimated cost of each partition (filled by reducer.reduce)
+         and an accumulator with the seconds spent by each partition
+    """
+    return {"estimated": [], "actual": sc.accumulator({}, DictAccumulatorParam())}
+
+
+def estimate_cost(count, total_length, max_length):
+    """ estimate the alignment work of a rank, every sequence is aligned against the longest one
+        and the cost of an alignment is the product of the lengths
+        :param count: the number of sequences of the rank
+        :param total_length: the sum of the lengths of the sequences
+        :param max_length: the length of the longest sequence
+    """
+    return max_length * (total_length - max_length) + total_length
+
+
+def rank_sizes(tax_seq_rdd):
+    """ get the number of sequences, the total length and the maximum length of every rank
+        :param tax_seq_rdd: a rdd with key = rank tax_id, value = (seq, fastaHeader)
+        :return: a list of (rank tax_id, (count, total_length, max_length))
+    """
+    return tax_seq_rdd.mapValues(lambda x: (1, len(x[0]), len(x[0]))) \
+        .reduceByKey(lambda a, b: (a[0] + b[0], a[1] + b[1], max(a[2], b[2]))).collect()
+
+
+def plan_partitions(key_costs, n_partitions):
+    """ assign the keys to the partitions with the longest processing time first rule,
+        the most expensive key goes to the least loaded partition
+        :param key_costs: a list of (key, cost)
+        :param n_partitions: the number of partitions
+        :return: a dictionary key -> partition and the list of the estimated costs of the partitions
+    """
+    loads = [(0, partition) for partition in range(n_partitions)]
+    assignment = {}
+    for key, cost in sorted(key_costs, key=lambda x: x[1], reverse=True):
+        load, partition = heapq.heappop(loads)
+        assignment[key] = partition
+        heapq.heappush(loads, (load + cost, partition))
+    costs = [0] * n_partitions
+    for load, partition in loads:
+        costs[partition] = load
+    return assignment, costs
+
+
+def partition_func(assignment):
+    """ create the partitionFunc of a planned assignment
+        :param assignment: a broadcast variable with the dictionary key -> partition
+    """
+    def get_partition(key):
+        partition = assignment.value.get(key)
+        return hash(key) if partition is None else partition
+    return get_partition
+
+
+def time_partition(index, records, actual):
+    """ yield the records of a partition and add the seconds spent producing them to the accumulator,
+        the time spent by the consumer of the records is not counted
+    """
+    elapsed = 0.0
+    records = iter(records)
+    while True:
+        start = time.time()
+        try:
+            record = next(records)
+        except StopIteration:
+            break
+        finally:
+            elapsed += time.time() - start
+        yield record
+    actual.add({index: elapsed})
+
+
+def format_partition_costs(partition_stats):
+    # one line per partition, the estimated cost is the sum of the length products of the partition
+    actual = partition_stats["actual"].value
+    return "\n".join("partition %d: estimated cost %d, %.1f s" % (i, cost, actual.get(i, 0.0))
+                     for i, cost in enumerate(partition_stats["estimated"]))
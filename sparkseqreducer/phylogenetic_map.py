@@ -15,11 +15,16 @@
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import os
+
+from sparkseqreducer.profiler import profiled
+from sparkseqreducer.taxonomy import is_taxonomy, load_taxonomy
+
+
 def generate_dict(nodes_filename=None, names_filename=None):
     """ Builds the following dictionary from NCBI taxonomy nodes.dmp and
     names.dmp files
     """
-    standard_ranks = stdranks = ['species', 'genus', 'family', 'order', 'class', 'phylum', 'superkingdom']
     if nodes_filename and names_filename:
 
         taxid2name = {}
@@ -30,31 +35,16 @@ def generate_dict(nodes_filename=None, names_filename=None):
                     taxid = int(line[0].strip('\t'))
                     taxid2name[taxid] = line[1][1:-1].strip('\t')
 
-        dic = {}  # 0 - taxidname, 1 - rank, 2 - parent taxid, 3 - childrens
+        dic = {}  # 0 - taxidname, 1 - rank, 2 - parent taxid
         with open(nodes_filename) as nodes_file:
             for line in nodes_file:
                 line = [elt for elt in line.split('|')][:3]
                 taxid = int(line[0].strip('\t'))
                 parent_taxid = int(line[1].strip('\t'))
-
-                if taxid in dic:  # 18204/1308852
-                    dic[taxid][1] = line[2][1:-1].strip('\t')
-                    dic[taxid][2] = parent_taxid
-                else:  # 1290648/1308852
-                    dic[taxid] = [taxid2name[taxid], line[2][1:-1].strip('\t'), parent_taxid, []]
-                    del taxid2name[taxid]
-
-                try:  # 1290648/1308852
-                    dic[parent_taxid][3].append(taxid)
-                except KeyError:  # 18204/1308852
-                    dic[parent_taxid] = [taxid2name[parent_taxid], None, None, [taxid]]
-                    del taxid2name[parent_taxid]
+                dic[taxid] = [taxid2name[taxid], line[2][1:-1].strip('\t'), parent_taxid]
 
         # to avoid infinite loop
-        root_children = dic[1][3]
-        root_children.remove(1)
         dic[1][2] = None
-        dic[1][3] = root_children
         return dic
 
 
@@ -87,29 +77,91 @@ def get_tax_ids(mapped_seq_rdd):
     return mapped_seq_rdd.map(lambda x: x[1][0]).collect()
 
 
-def map_phylogenetic_info(mapped_seq_rdd, nodes_dmp, names_dmp, sc, broadcast=True):
-    """ create a fasta file locally from the given rdd using collect
-                    :param seq_rdd: the rdd containing the sequences
-                    :param filename: the path to save the fasta file
-                    :return:
+def map_phylogenetic_info(mapped_seq_rdd, nodes_dmp, names_dmp, sc, broadcast=True, taxonomy_file=None,
+                          profile=None):
+    """ create a rdd keyed by the phylogenetic info of every sequence
+                    :param mapped_seq_rdd: the rdd((key=accession_version, v=[tax_id, header, sequence]))
+                    :param nodes_dmp: the path to nodes.dmp
+                    :param names_dmp: the path to names.dmp
+                    :param sc: the spark context
+                    :param broadcast: broadcast the taxonomy to the executors instead of resolving
+                     every taxid on the driver
+                    :param taxonomy_file: the taxonomy cache created by configure, used instead of
+                     parsing nodes.dmp and names.dmp when the file exists
+                    :param profile: optional profile created by profiler.create_profile to time the lineage walks
+                    :return: rdd((key=phylo_dict, v=[tax_id, header, sequence]))
             """
-    # create a dictionary
-    tax_dic = generate_dict(nodes_dmp, names_dmp)
+    if taxonomy_file and is_taxonomy(taxonomy_file):
+        # the array based tree loads in a fraction of a second and is much smaller to broadcast
+        tax_tree = load_taxonomy(taxonomy_file)
+        get_lineage = lambda tree, taxid: tree.get_lineage(taxid, True)
+    else:
+        # create a dictionary
+        tax_tree = generate_dict(nodes_dmp, names_dmp)
+        get_lineage = lambda dic, taxid: get_ascendants_with_ranks_and_names(dic, taxid, True)
+    get_lineage = profiled(profile, "lineage", get_lineage)
     if broadcast and sc:
-        tax_dic_bc = sc.broadcast(tax_dic)
+        tax_tree_bc = sc.broadcast(tax_tree)
         # on a cluster
-        ptree_rdd = mapped_seq_rdd.map(lambda x:
-                                       (get_ascendants_with_ranks_and_names(tax_dic_bc.value, x[1][0], True), x[1]))
+        ptree_rdd = mapped_seq_rdd.map(lambda x: (get_lineage(tax_tree_bc.value, x[1][0]), x[1]))
     else:
         all_tax_ids = get_tax_ids(mapped_seq_rdd)
         # use local dictionary to make a new dictionary that maps taxid to ascendants
         dic_map = {}
         for taxid in all_tax_ids:
-            dic_map[taxid] = get_ascendants_with_ranks_and_names(tax_dic, taxid, True)
+            dic_map[taxid] = get_lineage(tax_tree, taxid)
         ptree_rdd = mapped_seq_rdd.map(lambda x: (dic_map[x[1][0]], x[1]))
     return ptree_rdd
 
 
+def get_rank_taxids(tax_tree, taxid, ranks):
+    """ project a taxid to its ascendants of the given ranks using a TaxonomyTree or a generate_dict dictionary
+        :return: a tuple with the taxid of each rank, -1 when the lineage has no taxid of that rank
+    """
+    if hasattr(tax_tree, "get_rank_taxids"):
+        return tax_tree.get_rank_taxids(taxid, ranks)
+    try:
+        lineage = get_ascendants_with_ranks_and_names(tax_tree, taxid, False)
+    except ValueError:  # not a valid taxid
+        return tuple([-1] * len(ranks))
+    if "unknown" in lineage:
+        return tuple([-1] * len(ranks))
+    return tuple(lineage[rank][0] if rank in lineage else -1 for rank in ranks)
+
+
+def map_rank_taxid(mapped_seq_rdd, nodes_dmp, names_dmp, sc, ranks, taxonomy_file=None, profile=None):
+    """ create a rdd keyed by the taxid of the chosen rank(s) of every sequence, every distinct taxid
+        is resolved once on the driver and only a taxid -> rank taxid mapping is broadcast
+                    :param mapped_seq_rdd: the rdd((key=accession_version, v=[tax_id, header, sequence]))
+                    :param nodes_dmp: the path to nodes.dmp
+                    :param names_dmp: the path to names.dmp
+                    :param sc: the spark context
+                    :param ranks: a rank, or a list of ranks
+                    :param taxonomy_file: the taxonomy cache created by configure, used instead of
+                     parsing nodes.dmp and names.dmp when the file exists
+                    :param profile: optional profile created by profiler.create_profile to time the lineage walks
+                    :return: rdd((key=rank_taxid, v=[tax_id, header, sequence])), the key is a tuple with
+                     one taxid per rank when a list of ranks is given, and -1 when the rank is unknown
+            """
+    single_rank = isinstance(ranks, str)
+    if single_rank:
+        ranks = [ranks]
+    if taxonomy_file and is_taxonomy(taxonomy_file):
+        tax_tree = load_taxonomy(taxonomy_file)
+    else:
+        tax_tree = generate_dict(nodes_dmp, names_dmp)
+
+    projection = {}
+    get_projection = profiled(profile, "lineage", get_rank_taxids)
+    for taxid in mapped_seq_rdd.map(lambda x: x[1][0]).distinct().collect():
+        rank_taxids = get_projection(tax_tree, taxid, ranks)
+        projection[taxid] = rank_taxids[0] if single_rank else rank_taxids
+    del tax_tree
+
+    projection_bc = sc.broadcast(projection)
+    return mapped_seq_rdd.map(lambda x: (projection_bc.value[x[1][0]], x[1]))
+
+
 def get_unknowns(ptree_rdd):
     return ptree_rdd.filter(lambda x: "unknown" in x[0])
 
@@ -0,0 +1,105 @@
+#     pipeline: Persistence and statistics of the stages of the reduction pipeline
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from functools import partial
+
+storage_levels = ["NONE", "MEMORY_ONLY", "MEMORY_AND_DISK", "DISK_ONLY"]
+
+# the statistics of every stage, in pipeline order
+stat_names = ["loaded", "mapped", "unmapped", "lineage", "unknown_lineage", "groups"]
+
+
+def create_pipeline_stats(sc, ranks):
+    """ create the accumulators of the statistics of the stages, they are filled while the stages are computed
+        :param sc: the spark context
+        :param ranks: the reduced ranks, the groups of every rank are counted apart
+        :return: a dictionary statistic name -> accumulator, "groups" is a dictionary rank -> accumulator
+    """
+    stats = dict((name, sc.accumulator(0)) for name in stat_names)
+    stats["groups"] = dict((rank, sc.accumulator(0)) for rank in ranks)
+    return stats
+
+
+def _count_partition(records, counter):
+    n = 0
+    for record in records:
+        n += 1
+        yield record
+    counter.add(n)
+
+
+def _filter_partition(records, predicate, kept, dropped):
+    n_kept = n_dropped = 0
+    for record in records:
+        if predicate(record):
+            n_kept += 1
+            yield record
+        else:
+            n_dropped += 1
+    if kept is not None:
+        kept.add(n_kept)
+    if dropped is not None:
+        dropped.add(n_dropped)
+
+
+def count_records(rdd, counter=None):
+    """ count the records of a rdd in an accumulator when the rdd is computed
+    """
+    if counter is None:
+        return rdd
+    return rdd.mapPartitions(partial(_count_partition, counter=counter), preservesPartitioning=True)
+
+
+def filter_records(rdd, predicate, kept=None, dropped=None):
+    """ filter a rdd counting the kept and dropped records in accumulators when the rdd is computed
+    """
+    return rdd.mapPartitions(partial(_filter_partition, predicate=predicate, kept=kept, dropped=dropped),
+                             preservesPartitioning=True)
+
+
+def persist(rdd, storage_level="MEMORY_AND_DISK", checkpoint=False):
+    """ keep a stage so the later actions do not compute it again
+        :param rdd: the rdd of the stage
+        :param storage_level: one of storage_levels, NONE does not persist the rdd
+        :param checkpoint: also checkpoint the rdd to the checkpoint directory of the spark context,
+         that truncates the lineage
+        :return: the rdd
+    """
+    if storage_level != "NONE":
+        # imported here so the local engine does not need pyspark
+        from pyspark import StorageLevel
+        rdd = rdd.persist(getattr(StorageLevel, storage_level))
+    if checkpoint:
+        rdd.checkpoint()
+    return rdd
+
+
+def unpersist(rdds):
+    """ release the rdds persisted for a stage once the actions that read them have run
+        :param rdds: a list of persisted rdds, it is emptied
+    """
+    while rdds:
+        rdds.pop().unpersist()
+
+
+def format_stats(stats):
+    return "\n".join([
+        "%d sequences have been loaded" % stats["loaded"].value,
+        "%d sequences have been mapped to their TaxID, %d not mapped and filtered out" %
+        (stats["mapped"].value, stats["unmapped"].value),
+        "The phylogenetic information of %d sequences has been mapped, %d with an unknown lineage have been "
+        "filtered out" % (stats["lineage"].value, stats["unknown_lineage"].value)] +
+        ["The sequences have been reduced to %d %s ranks" % (groups.value, rank)
+         for rank, groups in stats["groups"].items()])
@@ -0,0 +1,175 @@
+#     profiler: Optional instrumentation of the TaxID lookups, the lineage walks and the alignments
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import csv
+import json
+import time
+
+from sparkseqreducer.partitioner import DictAccumulatorParam
+
+# the metrics of every instrumented function and of every rank TaxID
+function_metrics = ["calls", "seconds", "bases", "cells"]
+taxon_metrics = ["seconds", "alignments", "cells", "input_bases", "kept_bases"]
+
+
+def create_profile(sc):
+    """ create the accumulators of the profile, every profiled function of the pipeline takes the profile
+        as an optional parameter and is not instrumented when it is None
+        :param sc: the spark context
+        :return: a dictionary with an accumulator (function, metric) -> value, an accumulator
+         (rank, taxid, metric) -> value and the rank TaxID being reduced by the current task
+    """
+    return {"functions": sc.accumulator({}, DictAccumulatorParam()),
+            "taxa": sc.accumulator({}, DictAccumulatorParam()),
+            "taxon": [None]}
+
+
+def _taxid(key):
+    # the key of the hierarchical reduction is a tuple, the first TaxID is the one of the reduced rank
+    return key[0] if isinstance(key, tuple) else key
+
+
+def add_call(profile, name, seconds, seq_a=None, seq_b=None):
+    """ add a call of a function to the profile, the lengths of the aligned sequences are added
+        as bases aligned and dynamic programming cells (m*n), also to the current rank TaxID
+    """
+    metrics = {(name, "calls"): 1, (name, "seconds"): seconds}
+    if seq_a is not None:
+        metrics[(name, "bases")] = len(seq_a) + len(seq_b)
+        metrics[(name, "cells")] = len(seq_a) * len(seq_b)
+        taxon = profile["taxon"][0]
+        if taxon is not None:
+            profile["taxa"].add({taxon + ("alignments",): 1, taxon + ("cells",): len(seq_a) * len(seq_b)})
+    profile["functions"].add(metrics)
+
+
+def profiled(profile, name, function, alignment=False):
+    """ wrap a function so its calls and wall time are added to the profile,
+        the function itself is returned when the profile is None
+        :param profile: the profile created by create_profile or None
+        :param name: the name of the function in the report
+        :param function: the function to wrap
+        :param alignment: the first two arguments are the aligned sequences
+    """
+    if profile is None:
+        return function
+
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if alignment:
+                add_call(profile, name, time.time() - start, args[0], args[1])
+            else:
+                add_call(profile, name, time.time() - start)
+    return wrapper
+
+
+def profiled_taxon(profile, rank, key, function, *args, **kwargs):
+    """ call a function of the reduction of a rank TaxID, its wall time and the alignments it does
+        are added to the TaxID
+    """
+    taxon = (rank, _taxid(key))
+    profile["taxon"][0] = taxon
+    start = time.time()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        profile["taxa"].add({taxon + ("seconds",): time.time() - start})
+        profile["taxon"][0] = None
+
+
+def profiled_combiner(profile, rank, create_combiner, merge_value, merge_combiners):
+    """ wrap the functions of combineByKey so the reduction of every rank TaxID is profiled,
+        the values must be (key, value) and the combiners are (key, combiner)
+        :return: the three wrapped functions
+    """
+    def create(value):
+        return value[0], create_combiner(value[1])
+
+    def merge(combiner, value):
+        return combiner[0], profiled_taxon(profile, rank, combiner[0], merge_value, combiner[1], value[1])
+
+    def merge_both(combiner_a, combiner_b):
+        return combiner_a[0], profiled_taxon(profile, rank, combiner_a[0], merge_combiners, combiner_a[1],
+                                             combiner_b[1])
+    return create, merge, merge_both
+
+
+def count_bases(records, profile, rank, metric):
+    """ add the bases of every rank TaxID of a partition to the profile
+        :param records: an iterator of (key, (seq, fastaHeader...)) or (key, [(seq, fastaHeader), ...])
+        :param metric: "input_bases" or "kept_bases"
+    """
+    bases = {}
+    for key, value in records:
+        if isinstance(value, list):
+            n_bases = sum(len(seq[0]) for seq in value)
+        else:
+            n_bases = len(value[0])
+        metric_key = (rank, _taxid(key), metric)
+        bases[metric_key] = bases.get(metric_key, 0) + n_bases
+        yield key, value
+    profile["taxa"].add(bases)
+
+
+def function_report(profile):
+    # name -> metric -> value
+    report = {}
+    for (name, metric), value in profile["functions"].value.items():
+        report.setdefault(name, dict((m, 0) for m in function_metrics))[metric] = value
+    return report
+
+
+def taxa_report(profile):
+    """ the metrics of every rank TaxID, the most expensive first
+        :return: a list of dictionaries with the rank, the taxid, taxon_metrics and the dropped bases
+    """
+    taxa = {}
+    for (rank, taxid, metric), value in profile["taxa"].value.items():
+        taxa.setdefault((rank, taxid), dict((m, 0) for m in taxon_metrics))[metric] = value
+    rows = []
+    for (rank, taxid), metrics in taxa.items():
+        row = {"rank": rank, "taxid": taxid}
+        row.update(metrics)
+        row["dropped_bases"] = metrics["input_bases"] - metrics["kept_bases"]
+        rows.append(row)
+    return sorted(rows, key=lambda row: (row["seconds"], row["cells"]), reverse=True)
+
+
+def write_profile_report(profile, filename, top=20):
+    """ write the profile to filename.profile.json, with the functions and the top most expensive rank TaxIDs,
+        and the metrics of every rank TaxID to filename.profile.csv
+        :return: the paths of the two files
+    """
+    taxa = taxa_report(profile)
+    json_file = filename + ".profile.json"
+    with open(json_file, "w") as f:
+        json.dump({"functions": function_report(profile), "n_taxa": len(taxa), "top_taxa": taxa[:top]}, f,
+                  indent=2, sort_keys=True)
+    csv_file = filename + ".profile.csv"
+    with open(csv_file, "w") as f:
+        writer = csv.DictWriter(f, ["rank", "taxid"] + taxon_metrics + ["dropped_bases"])
+        writer.writeheader()
+        writer.writerows(taxa)
+    return json_file, csv_file
+
+
+def format_profile(profile):
+    # one line per instrumented function
+    return "\n".join("%s: %d calls, %.1f s, %d bases, %d cells" %
+                     (name, metrics["calls"], metrics["seconds"], metrics["bases"], metrics["cells"])
+                     for name, metrics in sorted(function_report(profile).items()))
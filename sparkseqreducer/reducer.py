@@ -13,8 +13,19 @@
 #
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from sparkseqreducer import stretcher
+from sparkseqreducer import anchor_align, partitioner, profiler, sketch, stretcher
+from sparkseqreducer.packed import reverse_complement, sequence_bytes
+from functools import partial
 import os
+import zlib
+
+import numpy as np
+
+# Comparison matrix must be on the same directory on all nodes
+_cmp_mat_file = os.path.join(os.path.dirname(__file__), "../data/EDNAFULL")
+
+# Alignment backends, all of them return the two aligned sequences with the longest one first
+aligners = {"stretcher": stretcher.align, "anchor": anchor_align.align}
 
 
 # Reduce function using emboss stretcher (with wrapper)
@@ -51,47 +62,179 @@ def string_similarity(a, b):
     return sim
 
 
-def align_reduce(sequences, seq_a, seq_b, threshold=0.95, stride=100):
-    # align using stretcher, Comparison matrix must be on the same directory on all nodes
-    seq_a_aligned, seq_b_aligned = stretcher.align(seq_a[0], seq_b[0],
-                                                   os.path.join(os.path.dirname(__file__), "../data/EDNAFULL"))
+def find_diff_regions(seq_a_aligned, seq_b_aligned, threshold=0.95, stride=100):
+    """
+    Finds the regions of two aligned sequences where the identity of the windows of size = stride
+    is below the threshold. Every run of adjacent low identity windows is extended by stride to the left
+    and to the right, and the overlapping regions are merged.
+    :return: a list of [start, end] ranges sorted by start
+    """
+    a = np.frombuffer(seq_a_aligned.encode("ascii"), dtype=np.uint8)
+    b = np.frombuffer(seq_b_aligned.encode("ascii"), dtype=np.uint8)
+    length = len(a)
+    if length == 0:
+        return []
+    # a position is a match when both characters are equal and not a gap
+    matches = np.concatenate(([0], np.cumsum((a == b) & (a != ord('-')))))
+    starts = np.arange(0, length, stride)
+    ends = np.minimum(starts + stride, length)
+    low = (matches[ends] - matches[starts]).astype(np.float64) / (ends - starts) < threshold
+    if not low.any():
+        return []
+    # runs of low identity windows: [first window, last window]
+    edges = np.diff(np.concatenate(([False], low, [False])).astype(np.int8))
+    run_first = np.nonzero(edges == 1)[0]
+    run_last = np.nonzero(edges == -1)[0] - 1
+    # region of a run, includes stride to the left and stride to the right
+    region_starts = np.maximum(run_first * stride - stride, 0)
+    region_ends = run_last * stride + 2 * stride
+    # merge the regions that overlap or touch the previous one
+    new_region = np.concatenate(([True], region_starts[1:] > region_ends[:-1]))
+    merged_starts = region_starts[new_region]
+    merged_ends = region_ends[np.concatenate((np.nonzero(new_region)[0][1:] - 1, [len(region_ends) - 1]))]
+    return [[int(start), int(end)] for start, end in zip(merged_starts, merged_ends)]
+
+
+def align_reduce(sequences, seq_a, seq_b, threshold=0.95, stride=100, aligner="stretcher", align_cache=None,
+                 profile=None, segments=None, offsets=False):
+    # align using the chosen backend (stretcher by default), in segments if the pair is long enough,
+    # through the alignment cache if there is one, with offsets the regions are (region, fastaHeader, start)
+    align = aligners[aligner]
+    name = aligner
+    if segments is not None and segments.applies(seq_a[0], seq_b[0]):
+        align = partial(segments.align, align=align)
+        name = segments.name(aligner)
+    align = profiler.profiled(profile, "align", align, alignment=True)
+    if align_cache is None:
+        seq_a_aligned, seq_b_aligned = align(seq_a[0], seq_b[0], _cmp_mat_file)
+    else:
+        seq_a_aligned, seq_b_aligned = align_cache.align(seq_a[0], seq_b[0], align, name, _cmp_mat_file)
 
     if len(seq_a_aligned) != len(seq_b_aligned):  # something went wrong while aligning
         return [""]
 
     else:
-        # Explore the similarity between regions of size = stride
-        diff_regions = []
-        i = 0
-        while i < len(seq_a_aligned):  # Check the similarity of all slices of size = stride
-            start_end = [i, i + stride]
-            if (string_similarity(seq_a_aligned[i:i + stride],
-                                  seq_b_aligned[i:i + stride]) < threshold):  # check similarity in slice
-                while i < len(seq_a_aligned) and (string_similarity(seq_a_aligned[i:i + stride],
-                                                                    seq_b_aligned[i:i + stride]) < threshold):
-                    # continue looking on adjacent slices
-                    start_end[1] = i + stride
-                    i = i + stride
-                # if region is different by threshold, append region to the left and region to the right to final
-                # sequence
-                start_end[0] = max(0, start_end[0] - stride)
-                start_end[1] = start_end[1] + stride
-                diff_regions.append(start_end)
-            else:
-                i = i + stride
-        # search for overlaps, reduce to one sequence
-        # optimize using an interval tree?
-        diff_regions = remove_overlaps(diff_regions)
         # use the list of ranges to get the unique parts of the aligned sequence
-        for start_end in diff_regions:
+        for start_end in find_diff_regions(seq_a_aligned, seq_b_aligned, threshold, stride):
             region = seq_b_aligned[start_end[0]:start_end[1]].replace('-',
                                                                       '')  # region, includes stride to the left and
             # stride to the right
-            sequences.append((region, seq_b[1]))
+            if offsets:
+                sequences.append((region, seq_b[1], start_end[0]))
+            else:
+                sequences.append((region, seq_b[1]))
 
     return sequences
 
 
+# Prefilter and sketch settings, sketches are only trusted with enough hashes
+prefilter_k = 21
+prefilter_scale = 50
+prefilter_min_hashes = 20
+prefilter_counters = ["duplicate", "contained", "similar", "aligned"]
+# the k-mer length of the strand detection
+strand_k = 15
+
+
+def create_prefilter_stats(sc):
+    """ create the spark accumulators that count the decisions of the prefilter
+        :param sc: the spark context
+        :return: a dictionary counter name -> accumulator
+    """
+    return dict((name, sc.accumulator(0)) for name in prefilter_counters)
+
+
+def format_prefilter_stats(stats):
+    # the alignments avoided by every decision of the prefilter
+    avoided = ["duplicate", "contained", "similar"]
+    return "The prefilter avoided %d alignments (%s), %d alignments done" % (
+        sum(stats[name].value for name in avoided), ", ".join("%s: %d" % (name, stats[name].value) for name in avoided),
+        stats["aligned"].value)
+
+
+def add_sketch(value):
+    # (seq, header) -> (seq, header, sketch)
+    return value[0], value[1], sketch.compute_sketch(value[0], prefilter_k, prefilter_scale)
+
+
+def remove_duplicates(records, stats=None):
+    """ drop the exact duplicated sequences of a partition partitioned by key,
+    all sequences of a key are in the same partition so the duplicates are dropped globally
+    """
+    seen = set()
+    for key, value in records:
+        digest = (key, sketch.content_hash(value[0]))
+        if digest in seen:
+            if stats is not None:
+                stats["duplicate"].add(1)
+            continue
+        seen.add(digest)
+        yield key, value
+
+
+def prefilter_pair(seq_a, seq_b):
+    """ decide if a pair of sequences needs to be aligned, seq_a must be the longest, seq_b is only dropped
+        when it has nothing seq_a does not have, an estimate could drop a small novel region
+        :return: "contained" if seq_b is a substring of seq_a, "similar" if every k-mer of seq_b is a k-mer
+         of seq_a, None if the pair must be aligned
+    """
+    if sequence_bytes(seq_b[0]).upper() in sequence_bytes(seq_a[0]).upper():
+        return "contained"
+    if sketch.contains_kmers(seq_b[0], seq_a[0], prefilter_k):
+        return "similar"
+    return None
+
+
+def orient(seq_a, seq_b):
+    """ put seq_b on the strand of the representative seq_a, the chosen strand is added to the header of seq_b
+        :return: seq_b or its reverse complement, with the sketch of the reverse complement when seq_b has a sketch
+    """
+    if sketch.strand(seq_b[0], seq_a[0], strand_k) == "+":
+        return (seq_b[0], seq_b[1] + " strand=+") + tuple(seq_b[2:])
+    seq = reverse_complement(seq_b[0])
+    if len(seq_b) > 2:
+        return seq, seq_b[1] + " strand=-", sketch.compute_sketch(seq, prefilter_k, prefilter_scale)
+    return seq, seq_b[1] + " strand=-"
+
+
+def flip_strand(region):
+    # a unique region of a member, on the other strand of the new representative
+    header = region[1]
+    if header.endswith(" strand=+"):
+        header = header[:-1] + "-"
+    elif header.endswith(" strand=-"):
+        header = header[:-1] + "+"
+    return (reverse_complement(region[0]), header) + tuple(region[2:])
+
+
+def orient_group(seq_a, seq_b, members):
+    """ put seq_b, the previous representative of members, on the strand of the new representative seq_a,
+        the unique regions of members were oriented against seq_b, they are reverse complemented with it
+        so their strand stays relative to the representative
+        :return: seq_b oriented like orient, members are changed in place
+    """
+    seq_b = orient(seq_a, seq_b)
+    if seq_b[1].endswith(" strand=-"):
+        members[:] = [flip_strand(member) for member in members]
+    return seq_b
+
+
+def reduce_pair(sequences, seq_a, seq_b, threshold=0.95, stride=100, aligner="stretcher", prefilter=None,
+                align_cache=None, profile=None, strand=False, segments=None, offsets=False):
+    # align seq_b against the representative seq_a, unless the prefilter can decide without the alignment
+    if strand:
+        # a sequence deposited on the other strand would be kept whole
+        seq_b = orient(seq_a, seq_b)
+    if prefilter is not None:
+        decision = prefilter_pair(seq_a, seq_b)
+        if decision is not None:
+            prefilter[decision].add(1)
+            return sequences
+        prefilter["aligned"].add(1)
+    return profiler.profiled(profile, "align_reduce", align_reduce)(sequences, seq_a, seq_b, threshold, stride,
+                                                                    aligner, align_cache, profile, segments, offsets)
+
+
 # SPARK RDD createCombiner for "combineByKey" function
 def seq_to_list(seq_a):
     # Receives a Value (tuple of (seq, header)) and turns it into a list
@@ -99,51 +242,342 @@ def seq_to_list(seq_a):
 
 
 # SPARK RDD mergeValue for "combineByKey" function
-def pairwise_reduction_merge_sequence(sequences, seq_b, threshold=0.95, stride=100):
+def pairwise_reduction_merge_sequence(sequences, seq_b, threshold=0.95, stride=100, aligner="stretcher",
+                                      prefilter=None, align_cache=None, profile=None, strand=False,
+                                      segments=None):
     # pop the longest sequence from Sequences
     seq_a = sequences.pop(0)
 
     # Check which one is the longest sequence
     if len(seq_b[0]) > len(seq_a[0]):
         seq_a, seq_b = seq_b, seq_a
+        if strand:
+            # the regions of sequences were oriented against the previous representative
+            seq_b = orient_group(seq_a, seq_b, sequences)
+            strand = False
 
     # Save original longest sequence
     sequences.insert(0, seq_a)
 
-    return align_reduce(sequences, seq_a, seq_b, threshold, stride)
+    return reduce_pair(sequences, seq_a, seq_b, threshold, stride, aligner, prefilter, align_cache, profile, strand,
+                       segments)
 
 
 # SPARK RDD mergeCombiners for "combineByKey" function
-def pairwise_merge_reduce_sequences(sequences_a, sequences_b, threshold=0.95, stride=100):
+def pairwise_merge_reduce_sequences(sequences_a, sequences_b, threshold=0.95, stride=100, aligner="stretcher",
+                                    prefilter=None, align_cache=None, profile=None, strand=False, segments=None):
     # pop the longest sequence from SequencesA, and SequencesB
     seq_a = sequences_a.pop(0)
     seq_b = sequences_b.pop(0)
 
-    # Extend Sequences A with Sequences B
-    sequences_a.extend(sequences_b)
-
     # Check which one is the longest sequence
+    members_b = sequences_b
     if len(seq_b[0]) > len(seq_a[0]):
         seq_a, seq_b = seq_b, seq_a
+        members_b = sequences_a
+    if strand:
+        # the regions of the other group were oriented against its representative
+        seq_b = orient_group(seq_a, seq_b, members_b)
+        strand = False
+
+    # Extend Sequences A with Sequences B
+    sequences_a.extend(sequences_b)
 
     # Save the longest sequence of SequencesA or SequencesB at the first position of SequencesA
     sequences_a.insert(0, seq_a)
 
-    return align_reduce(sequences_a, seq_a, seq_b, threshold, stride)
+    return reduce_pair(sequences_a, seq_a, seq_b, threshold, stride, aligner, prefilter, align_cache, profile,
+                       strand, segments)
+
+
+def longest_sequence(seq_a, seq_b):
+    # the representative of a rank, ties are broken by header so the choice does not depend on the order
+    return max(seq_a, seq_b, key=lambda seq: (len(seq[0]), seq[1]))
 
 
-def reduce(pmapped_rdd, rank="species"):
+def count_and_longest(stats_a, stats_b):
+    # (number of sequences, longest sequence) of a rank
+    return stats_a[0] + stats_b[0], longest_sequence(stats_a[1], stats_b[1])
+
+
+def salt_of(header, n_salts):
+    # stable across python processes, unlike hash() of a string
+    return zlib.crc32(header.encode("UTF-8")) % n_salts
+
+
+def align_to_representative(member, representative, threshold=0.95, stride=100, aligner="stretcher",
+                            prefilter=None, align_cache=None, profile=None, strand=False, segments=None):
+    """ get the unique regions of a member of a rank compared to the representative of the rank
+        :return: a list of (region, fastaHeader, start), start is the offset of the region in the alignment,
+         empty for the representative itself
+    """
+    if member[1] == representative[1] and member[0] == representative[0]:
+        return []
+    # a failed alignment returns [""]
+    return [region for region in reduce_pair([], representative, member, threshold, stride, aligner, prefilter,
+                                             align_cache, profile, strand, segments, offsets=True) if region]
+
+
+def order_reduced(values):
+    # values are (0, representative) and (1, (region, fastaHeader, start)), the representative goes first
+    # and the regions of every member follow in position order, like the combine reduction, whatever the
+    # arrival order
+    return [value[1][:2] for value in sorted(values, key=lambda value: (value[0], value[1][1], value[1][2])
+                                             if value[0] else (0,))]
+
+
+# the representatives of the fanout reduction are broadcast when they have at most this many bases in total,
+# otherwise they are joined with the members
+fanout_broadcast_bases = 1 << 26
+
+
+def fanout_reduce(tax_seq_rdd, threshold=0.95, stride=100, aligner="stretcher", prefilter=None, salt=None,
+                  align_cache=None, profile=None, rank=None, strand=False, segments=None, persisted=None):
+    """ reduce the sequences of every rank against a representative chosen up front (the longest one),
+        the alignments of the members of a large rank are spread over up to salt tasks
+        :param tax_seq_rdd: a rdd with key = rank tax_id, value = (seq, fastaHeader)
+        :param salt: the maximum number of tasks that align the members of a single rank,
+         defaults to the default parallelism
+        :param profile: the profile created by profiler.create_profile, to profile the alignments of every rank
+        :param rank: the name of the rank in the profile
+        :param strand: detect the strand of every member and align the reverse complement of the members
+         deposited on the other strand
+        :param segments: a segment_align.SegmentedAligner to align the very long pairs in segments
+        :param persisted: a list the sequences persisted by the reduction are appended to, the caller unpersists
+         them once the result has been computed
+        :return: a rdd with key = rank tax_id, value = [representative, (region, fastaHeader), ...]
+    """
+    sc = tax_seq_rdd.context
+    salt = salt or sc.defaultParallelism
+    # the sequences are read twice, to choose the representatives and to align the members
+    tax_seq_rdd = tax_seq_rdd.persist()
+    if persisted is not None:
+        persisted.append(tax_seq_rdd)
+    rank_stats = tax_seq_rdd.mapValues(lambda seq: (1, seq)).reduceByKey(count_and_longest)
+    representatives = rank_stats.mapValues(lambda stats: stats[1])
+    # (rank tax_id, number of sequences, length of the representative)
+    rank_sizes = rank_stats.map(lambda x: (x[0], x[1][0], len(x[1][1][0]))).collect()
+    # only the ranks with more than one sequence are salted, the others are aligned by a single task
+    n_salts = sc.broadcast(dict((key, min(salt, count)) for key, count, _ in rank_sizes if count > 1))
+
+    salted_members = tax_seq_rdd.map(lambda x: ((x[0], salt_of(x[1][1], n_salts.value.get(x[0], 1))), x[1]))
+
+    def align_member(key, member, representative):
+        if profile is None:
+            return align_to_representative(member, representative, threshold, stride, aligner, prefilter,
+                                           align_cache, None, strand, segments)
+        return profiler.profiled_taxon(profile, rank, key, align_to_representative, member, representative,
+                                       threshold, stride, aligner, prefilter, align_cache, profile, strand,
+                                       segments)
+
+    n_partitions = max(salt, tax_seq_rdd.getNumPartitions())
+    if sum(length for _, _, length in rank_sizes) <= fanout_broadcast_bases:
+        # every executor gets the representatives once instead of once per salt of their rank
+        representative_of = sc.broadcast(representatives.collectAsMap())
+        regions = salted_members.partitionBy(n_partitions).flatMap(
+            lambda x: [(x[0][0], (1, region))
+                       for region in align_member(x[0][0], x[1], representative_of.value[x[0][0]])])
+    else:
+        salted_representatives = representatives.flatMap(
+            lambda x: [((x[0], i), x[1]) for i in range(n_salts.value.get(x[0], 1))])
+        regions = salted_members.join(salted_representatives, n_partitions) \
+            .flatMap(lambda x: [(x[0][0], (1, region)) for region in align_member(x[0][0], x[1][0], x[1][1])])
+
+    return representatives.mapValues(lambda seq: (0, seq)).union(regions).groupByKey().mapValues(order_reduced)
+
+
+def nearest_centroid(clusters, member, min_identity=0.9):
+    """ find the cluster whose centroid is the nearest to a member by the identity estimated with their sketches
+        :param clusters: a list of clusters, the centroid of a cluster is its first sequence
+        :param member: a (seq, fastaHeader, sketch)
+        :param min_identity: the minimum estimated identity of the member to the centroid
+        :return: the index of the cluster, None when no centroid is close enough, the first cluster
+         when the sketch of the member is too small to be trusted
+    """
+    if len(member[2]) < prefilter_min_hashes:
+        return 0
+    identities = [sketch.containment_identity(member[2], cluster[0][2], prefilter_k) for cluster in clusters]
+    nearest = max(range(len(clusters)), key=identities.__getitem__)
+    return nearest if identities[nearest] >= min_identity else None
+
+
+# SPARK RDD createCombiner for "combineByKey" function, cluster reduction
+def create_clusters(seq_a):
+    # a single cluster with seq_a as centroid
+    return [[seq_a]]
+
+
+# SPARK RDD mergeValue for "combineByKey" function, cluster reduction
+def add_to_clusters(clusters, seq_b, threshold=0.95, stride=100, aligner="stretcher", prefilter=None,
+                    align_cache=None, profile=None, strand=False, segments=None, min_identity=0.9):
+    # seq_b is only aligned against the nearest centroid, or becomes the centroid of a new cluster
+    nearest = nearest_centroid(clusters, seq_b, min_identity)
+    if nearest is None:
+        clusters.append([seq_b])
+    else:
+        clusters[nearest] = pairwise_reduction_merge_sequence(clusters[nearest], seq_b, threshold, stride, aligner,
+                                                              prefilter, align_cache, profile, strand, segments)
+    return clusters
+
+
+# SPARK RDD mergeCombiners for "combineByKey" function, cluster reduction
+def merge_clusters(clusters_a, clusters_b, threshold=0.95, stride=100, aligner="stretcher", prefilter=None,
+                   align_cache=None, profile=None, strand=False, segments=None, min_identity=0.9):
+    # every cluster of clusters_b is merged with the cluster of clusters_a with the nearest centroid
+    for cluster in clusters_b:
+        nearest = nearest_centroid(clusters_a, cluster[0], min_identity)
+        if nearest is None:
+            clusters_a.append(cluster)
+        else:
+            clusters_a[nearest] = pairwise_merge_reduce_sequences(clusters_a[nearest], cluster, threshold, stride,
+                                                                  aligner, prefilter, align_cache, profile, strand,
+                                                                  segments)
+    return clusters_a
+
+
+def clusters_to_groups(clusters):
+    # one group per cluster, the centroid is the representative, the longest centroids first, without the sketches
+    return [[(seq[0], seq[1]) for seq in cluster]
+            for cluster in sorted(clusters, key=lambda cluster: (-len(cluster[0][0]), cluster[0][1]))]
+
+
+def reduce(pmapped_rdd, rank="species", projected=False, aligner="stretcher", threshold=0.95, stride=100,
+           prefilter=None, reduction="combine", salt=None, n_partitions=None, partition_stats=None,
+           align_cache=None, profile=None, strand=False, segments=None, cluster_identity=0.9, persisted=None):
     """ create a rdd that combines sequences with the same chosen rank identified by his TaxID
                         :param pmapped_rdd: the rdd containing the sequences and the phylogenetic info dict as key
                         :param rank: the rank to use as key to combine and reduce the sequences in pmapped_rdd
+                        :param projected: pmapped_rdd is already keyed by the rank TaxID (map_rank_taxid)
+                        :param aligner: the alignment backend, "stretcher" or "anchor"
+                        :param threshold: the minimum identity of a window to be considered redundant
+                        :param stride: the size of the windows compared after the alignment
+                        :param prefilter: the accumulators created by create_prefilter_stats to enable the
+                         prefilter, duplicated and contained sequences and sequences whose k-mers are all
+                         k-mers of the representative are then dropped without alignment
+                        :param reduction: "combine" reduces the sequences of a rank in arrival order with
+                         combineByKey, "fanout" aligns every sequence against the longest one of the rank
+                         and spreads the alignments of large ranks over many tasks, "cluster" keeps several
+                         centroids per rank, every sequence is aligned against the nearest centroid only or
+                         becomes a new centroid, the rdd has a group per centroid
+                        :param salt: the maximum number of tasks per rank of the fanout reduction
+                        :param n_partitions: the number of partitions of the reduction, defaults to the
+                         default parallelism, the ranks are assigned to them by estimated alignment cost
+                        :param partition_stats: the statistics created by partitioner.create_partition_stats,
+                         to get the estimated and actual cost of every partition
+                        :param align_cache: an align_cache.AlignmentCache, the alignments are read from it
+                         and the new ones are stored in it
+                        :param profile: the profile created by profiler.create_profile, to get the time, the
+                         alignments and the kept and dropped bases of every rank TaxID
+                        :param strand: detect the strand of every sequence compared to the representative, the
+                         sequences on the other strand are reverse complemented before the alignment and the
+                         strand is added to the header of the unique regions
+                        :param segments: a segment_align.SegmentedAligner, the pairs it applies to are split
+                         into collinear segments aligned in parallel by threads of the task
+                        :param cluster_identity: the minimum identity to the nearest centroid, estimated with
+                         the sketches, of a sequence of the cluster reduction
+                        :param persisted: a list the rdds persisted by the fanout reduction are appended to,
+                         to unpersist them once the reduced rdd has been computed
                         :return: reduced_sequence_rdd a rdd generated by spark combineByKey
                 """
     # create a key/value rdd
     # key = rank tax_id, value = (seq, fastaHeader)
-    tax_seq_rdd = pmapped_rdd.map(lambda x: (x[0][rank][0], (x[1][2], x[1][1]))).partitionBy(12)
+    if projected:
+        tax_seq_rdd = pmapped_rdd.map(lambda x: (x[0], (x[1][2], x[1][1])))
+    else:
+        tax_seq_rdd = pmapped_rdd.map(lambda x: (x[0][rank][0], (x[1][2], x[1][1])))
 
+    sc = pmapped_rdd.context
+    n_partitions = n_partitions or sc.defaultParallelism
+    if reduction == "fanout":
+        # the costs of the fanout reduction are spread over the salted partitions, they are not planned,
+        # the duplicates are only dropped globally when all the sequences of a key share a partition
+        if prefilter is not None:
+            tax_seq_rdd = tax_seq_rdd.partitionBy(n_partitions)
+    else:
+        # Bin pack the ranks into the partitions using their estimated alignment cost
+        key_costs = [(key, partitioner.estimate_cost(*sizes)) for key, sizes in partitioner.rank_sizes(tax_seq_rdd)]
+        assignment, estimated_costs = partitioner.plan_partitions(key_costs, n_partitions)
+        partition_func = partitioner.partition_func(sc.broadcast(assignment))
+        tax_seq_rdd = tax_seq_rdd.partitionBy(n_partitions, partition_func)
+    if profile is not None:
+        tax_seq_rdd = tax_seq_rdd.mapPartitions(
+            partial(profiler.count_bases, profile=profile, rank=rank, metric="input_bases"), preservesPartitioning=True)
+
+    if prefilter is not None:
+        tax_seq_rdd = tax_seq_rdd.mapPartitions(lambda records: remove_duplicates(records, prefilter),
+                                                preservesPartitioning=True)
+    if reduction == "cluster":
+        # the centroids are compared by their sketches, value = (seq, fastaHeader, sketch)
+        tax_seq_rdd = tax_seq_rdd.mapValues(add_sketch)
+
+    if reduction == "fanout":
+        reduced_sequence_rdd = fanout_reduce(tax_seq_rdd, threshold, stride, aligner, prefilter, salt, align_cache,
+                                             profile, rank, strand, segments, persisted)
+        if profile is not None:
+            reduced_sequence_rdd = reduced_sequence_rdd.mapPartitions(
+                partial(profiler.count_bases, profile=profile, rank=rank, metric="kept_bases"))
+        return reduced_sequence_rdd
+
+    merge_options = dict(threshold=threshold, stride=stride, aligner=aligner, prefilter=prefilter,
+                         align_cache=align_cache, profile=profile, strand=strand, segments=segments)
+    if reduction == "cluster":
+        combine_functions = (create_clusters, partial(add_to_clusters, min_identity=cluster_identity, **merge_options),
+                             partial(merge_clusters, min_identity=cluster_identity, **merge_options))
+    else:
+        combine_functions = (seq_to_list, partial(pairwise_reduction_merge_sequence, **merge_options),
+                             partial(pairwise_merge_reduce_sequences, **merge_options))
+    if profile is not None:
+        # the combiners carry their key, so the merges are profiled by rank TaxID
+        combine_functions = profiler.profiled_combiner(profile, rank, *combine_functions)
+        tax_seq_rdd = tax_seq_rdd.mapPartitions(lambda records: ((key, (key, value)) for key, value in records),
+                                                preservesPartitioning=True)
     # CombineByKey, reduce all sequences sharing rank TaxID
-    reduced_sequence_rdd = tax_seq_rdd.combineByKey(seq_to_list,
-                                                    pairwise_reduction_merge_sequence,
-                                                    pairwise_merge_reduce_sequences)
+    # same partitioner as tax_seq_rdd, so the sequences are not shuffled again
+    reduced_sequence_rdd = tax_seq_rdd.combineByKey(*combine_functions, numPartitions=n_partitions,
+                                                    partitionFunc=partition_func)
+    if profile is not None:
+        reduced_sequence_rdd = reduced_sequence_rdd.mapValues(lambda combiner: combiner[1])
+    if reduction == "cluster":
+        # a group per cluster
+        reduced_sequence_rdd = reduced_sequence_rdd.flatMapValues(clusters_to_groups)
+    if profile is not None:
+        reduced_sequence_rdd = reduced_sequence_rdd.mapPartitions(
+            partial(profiler.count_bases, profile=profile, rank=rank, metric="kept_bases"), preservesPartitioning=True)
+    if partition_stats is not None:
+        partition_stats["estimated"] = estimated_costs
+        actual = partition_stats["actual"]
+        reduced_sequence_rdd = reduced_sequence_rdd.mapPartitionsWithIndex(
+            lambda index, records: partitioner.time_partition(index, records, actual), preservesPartitioning=True)
     return reduced_sequence_rdd
+
+
+def level_sequences(key, seqs):
+    # the representative and the unique regions of a group are the sequences of the next rank
+    return [(key[1:], [key[0], header, seq]) for seq, header in seqs]
+
+
+def hierarchical_reduce(keyed_rdd, ranks, persist=None, partition_stats=None, **reduce_options):
+    """ reduce the sequences to several ranks, from the lowest rank to the highest one, the representatives
+        and the unique regions of a rank are the sequences reduced at the next rank
+        :param keyed_rdd: a rdd with key = a tuple with the tax_id of every rank (-1 when unknown),
+         value = [tax_id, header, sequence]
+        :param ranks: the ranks of the key, from the lowest to the highest
+        :param persist: a function that persists the reduced rdd of a rank, it is read by the output of the rank
+         and by the next rank
+        :param partition_stats: a dictionary rank -> the statistics created by partitioner.create_partition_stats,
+         the partitions of every rank are planned and timed apart
+        :param reduce_options: the options of reduce
+        :return: an iterator of (rank, rdd with key = rank tax_id, value = [representative, (region, fastaHeader), ...])
+    """
+    level_rdd = keyed_rdd
+    for i, rank in enumerate(ranks):
+        # the key keeps the tax_id of the higher ranks, a tax_id determines them so the groups are the same
+        reduced_rdd = reduce(level_rdd.filter(lambda x: x[0][0] >= 0), rank, projected=True,
+                             partition_stats=partition_stats and partition_stats[rank], **reduce_options)
+        if persist is not None:
+            reduced_rdd = persist(reduced_rdd)
+        yield rank, reduced_rdd.map(lambda x: (x[0][0], x[1]))
+        if i + 1 < len(ranks):
+            # the sequences without a tax_id of this rank go up unreduced
+            level_rdd = reduced_rdd.flatMap(lambda x: level_sequences(x[0], x[1])) \
+                .union(level_rdd.filter(lambda x: x[0][0] < 0).map(lambda x: (x[0][1:], x[1])))
@@ -0,0 +1,124 @@
+#     segment_align: Alignment of very long sequence pairs in collinear segments aligned in parallel
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from concurrent.futures import ThreadPoolExecutor
+
+from sparkseqreducer import anchor_align, stretcher
+from sparkseqreducer.packed import unpack
+
+
+def anchor_cuts(seq_a, seq_b, k=21, min_anchor=50):
+    """ the cut points of a pair at the middle of its high confidence anchors, the runs of the collinear
+        chain of unique k-mer matches that are at least min_anchor bases long
+        :return: a list of (pos_a, pos_b) increasing in both sequences
+    """
+    return [(pos_a + length // 2, pos_b + length // 2)
+            for pos_a, pos_b, length in anchor_align.collinear_runs(seq_a, seq_b, k) if length >= min_anchor]
+
+
+def _span(start, end):
+    return max(end[0] - start[0], end[1] - start[1])
+
+
+def cut_points(seq_a, seq_b, max_segment, k=21, min_anchor=50):
+    """ split a pair into collinear segments of at most max_segment bases of each sequence, the segments
+        end at anchors when possible, the segments without anchors are cut along their diagonal
+        :return: a list of (pos_a, pos_b) from (0, 0) to (len(seq_a), len(seq_b))
+    """
+    end = (len(seq_a), len(seq_b))
+    cuts = [(0, 0)]
+    previous = None
+    # keep the farthest anchor that keeps the segment under the budget
+    for cut in anchor_cuts(seq_a, seq_b, k, min_anchor) + [end]:
+        if _span(cuts[-1], cut) > max_segment and previous is not None and previous != cuts[-1]:
+            cuts.append(previous)
+        previous = cut
+    if cuts[-1] != end:
+        cuts.append(end)
+
+    # re-cut the segments that are still over the budget
+    result = [cuts[0]]
+    for start, stop in zip(cuts, cuts[1:]):
+        n_pieces = -(-_span(start, stop) // max_segment)
+        for i in range(1, n_pieces):
+            result.append((start[0] + (stop[0] - start[0]) * i // n_pieces,
+                           start[1] + (stop[1] - start[1]) * i // n_pieces))
+        result.append(stop)
+    return result
+
+
+def align_segment(seg_a, seg_b, align, cmp_mat_file, gap_open=16, gap_extend=4):
+    """ global alignment of a segment, keeps the order of the sequences
+    """
+    if not seg_b:
+        return seg_a, "-" * len(seg_a)
+    if not seg_a:
+        return "-" * len(seg_b), seg_b
+    if len(seg_a) >= len(seg_b):
+        return align(seg_a, seg_b, cmp_mat_file, gap_open=gap_open, gap_extend=gap_extend)
+    aligned_b, aligned_a = align(seg_a, seg_b, cmp_mat_file, gap_open=gap_open, gap_extend=gap_extend)
+    return aligned_a, aligned_b
+
+
+class SegmentedAligner(object):
+    """ Aligns the pairs of very long sequences in collinear segments cut at anchors, the segments are aligned
+    by a pool of threads (stretcher releases the GIL) and their alignments are concatenated. Only the
+    parameters are pickled, a pool is created by every alignment.
+    """
+
+    def __init__(self, min_length=1000000, max_segment=100000, threads=4, k=21, min_anchor=50):
+        self.min_length = min_length
+        self.max_segment = max_segment
+        self.threads = threads
+        self.k = k
+        self.min_anchor = min_anchor
+
+    def applies(self, seq_a, seq_b):
+        """ the pair is long enough to be aligned in segments
+        """
+        return min(len(seq_a), len(seq_b)) >= self.min_length
+
+    def name(self, aligner):
+        # the alignments of a segmented pair differ from the alignment of the whole pair
+        return "%s/segments%d" % (aligner, self.max_segment)
+
+    def align(self, seq_a, seq_b, cmp_mat_file, align=stretcher.align, gap_open=16, gap_extend=4):
+        """ align a pair in segments, same contract as stretcher.align, the longest sequence is returned first
+            :param seq_a: a sequence string or PackedSequence
+            :param seq_b: a sequence string or PackedSequence
+            :param cmp_mat_file: the path to the comparison matrix
+            :param align: the function that aligns the segments, stretcher.align or anchor_align.align
+            :param gap_open: the gap opening penalty
+            :param gap_extend: the gap extension penalty
+            :return: the two aligned sequences (with gaps) as strings of the same length
+        """
+        if len(seq_a) < len(seq_b):
+            seq_a, seq_b = seq_b, seq_a
+        seq_a = unpack(seq_a).upper()
+        seq_b = unpack(seq_b).upper()
+        cuts = cut_points(seq_a, seq_b, self.max_segment, self.k, self.min_anchor)
+        segments = [(seq_a[start[0]:stop[0]], seq_b[start[1]:stop[1]]) for start, stop in zip(cuts, cuts[1:])]
+        with ThreadPoolExecutor(max(1, min(self.threads, len(segments)))) as executor:
+            pieces = list(executor.map(lambda segment: align_segment(segment[0], segment[1], align, cmp_mat_file,
+                                                                     gap_open, gap_extend), segments))
+        return "".join(piece[0] for piece in pieces), "".join(piece[1] for piece in pieces)
+
+
+def segmented_aligner(params):
+    """ the SegmentedAligner of the parameters of sparkseqreducer.py, None when the pairs are aligned whole
+    """
+    if not params["segment_threshold"]:
+        return None
+    return SegmentedAligner(params["segment_threshold"], params["segment_length"], params["segment_threads"])
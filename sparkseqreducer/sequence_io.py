@@ -14,62 +14,264 @@
 #     You should have received a copy of the GNU General Public License
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import gzip
+import os
 import re
+import shutil
+from functools import partial
 
+from sparkseqreducer import bgzf
+from sparkseqreducer.bgzf import BgzfWriter, EOF_BLOCK
+from sparkseqreducer.packed import pack, unpack
 
-def fasta_to_rdd(file_loc, sc):
+# file name suffix of every output compression
+compressions = {None: ".fasta", "gzip": ".fasta.gz", "bgzf": ".fasta.gz"}
+
+# Note: An accession number applies to the complete record and is usually a combination of a letter(s) and numbers,
+# such as a single letter followed by five digits (e.g., U12345) or two letters followed by six digits Records from
+# the RefSeq database of reference sequences have a different accession number format that begins with two letters
+# followed by an underscore bar and six or more digits
+_accession_re = re.compile("^>([_A-Za-z0-9.]+)")
+_to_upper = bytes.maketrans(b"abcdefghijklmnopqrstuvwxyz", b"ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+_whitespace = b" \t\r\n\v\f"
+
+
+def header_accession(header):
+    """ the accession.version of a fasta header, None if the header does not start with one
+    """
+    match = _accession_re.match(header)
+    return None if match is None else match.group(1)
+
+
+def normalize_sequence(seq, packed=False):
+    # remove the whitespace and upper case the sequence in a single pass
+    seq = seq.encode("latin-1").translate(_to_upper, _whitespace)
+    return pack(seq) if packed else seq.decode("latin-1")
+
+
+def parse_fasta_records(records, packed=False):
+    """ parse the records of a partition, a record is a header line followed by the sequence lines,
+        the leading ">" may be missing as it is used to split the records
+        :param records: an iterator of fasta records
+        :param packed: return the sequences as PackedSequence
+        :return: an iterator of (accession.version, [header, sequence])
+    """
+    for record in records:
+        if not record.startswith(">"):
+            record = ">" + record
+        header, _, seq = record.partition("\n")
+        accession = header_accession(header)
+        if accession is None:  # empty record or text before the first header
+            continue
+        yield accession, [header.rstrip(), normalize_sequence(seq, packed)]
+
+
+def bgzf_ranges(offsets, n_ranges):
+    """ split the blocks of a BGZF file into contiguous ranges of blocks
+        :param offsets: the offsets of the blocks
+        :param n_ranges: the maximum number of ranges
+        :return: a list of (offset of the first block, offset of the first block of the next range or None)
+    """
+    n_ranges = max(1, min(n_ranges, len(offsets)))
+    starts = [offsets[len(offsets) * i // n_ranges] for i in range(n_ranges)]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def read_fasta_range(filename, start, end=None):
+    """ read the fasta records of a range of blocks of a BGZF file, a record belongs to the range
+        that contains the newline before its ">", the last record is completed reading the next blocks
+        :param filename: the path to the BGZF file
+        :param start: the offset of the first block of the range
+        :param end: the offset of the first block after the range, None for the end of the file
+        :return: an iterator of records, without the leading ">" except for the first record of the file
+    """
+    data = bytearray()
+    range_length = None
+    stop = -1
+    for offset, block in bgzf.read_blocks(filename, start):
+        if end is not None and offset >= end and range_length is None:
+            range_length = len(data)
+        data.extend(block)
+        if range_length is not None:
+            # only the new block, and the newline before it, can hold the header that ends the last record
+            stop = data.find(b"\n>", max(range_length, len(data) - len(block) - 1))
+            if stop != -1:
+                break
+    if range_length is None:
+        range_length = len(data)
+
+    if start == 0 and data.startswith(b">"):
+        first = 0
+    else:
+        first = data.find(b"\n>")
+        if first == -1 or first >= range_length:
+            return
+        first += 2
+    if stop == -1:
+        stop = len(data)
+    for record in data[first:stop].decode("latin-1").split("\n>"):
+        yield record
+
+
+def fasta_to_rdd(file_loc, sc, n_partitions=None, packed=False):
     """ create a rdd using a fasta file from the given path and a sparkcontext
-            :param file_loc: the path to the the fasta file/files
+            :param file_loc: the path to the the fasta file/files, plain, gzip or BGZF compressed
             :param sc: the spark context to use to create the rdd
+            :param n_partitions: the number of partitions of compressed inputs, defaults to the default parallelism
+            :param packed: pack the sequences 4 bases per byte, they are unpacked when writing the output
             :return: rdd(accession.version, [header, sequence])
     """
-    # Read the files in the directory using newAPIHadoopFile with double line skip as delimiter
-    # Split the sequences (fasta format: header+multi-line sequence) in a multi-fasta file or multiple fasta files
-    fasta_files_rdd = sc.newAPIHadoopFile(
-        file_loc,
-        inputFormatClass="org.apache.hadoop.mapreduce.lib.input.TextInputFormat",
-        keyClass="org.apache.hadoop.io.LongWritable", valueClass="org.apache.hadoop.io.Text",
-        conf={"textinputformat.record.delimiter": "\n\n"})
-    # newAPIHadoopFile generates a RDD of tuples with a arbitrary key for each element
-
-    # A sequence on a fasta format is split on multiple lines,
-    # the first newline splits the header from the beginning of the sequence
-    # we have to replace the rest of newlines characters to have a complete sequence
-    fasta_files_rdd = fasta_files_rdd.map(lambda x: x[1].replace('\n', '<', 1).replace('\n', '').split('<'))
-    # rdd([header, sequence])
+    n_partitions = n_partitions or sc.defaultParallelism
+    if os.path.isfile(file_loc) and bgzf.is_bgzf(file_loc):
+        # BGZF blocks are compressed independently, every task reads a range of blocks
+        ranges = bgzf_ranges(bgzf.block_offsets(file_loc), n_partitions)
+        fasta_files_rdd = sc.parallelize(ranges, len(ranges)) \
+            .flatMap(lambda start_end: read_fasta_range(file_loc, start_end[0], start_end[1]))
+    else:
+        # Read the files using newAPIHadoopFile with the start of a header as delimiter, the splits of
+        # uncompressed files are resynchronized on the delimiter by hadoop
+        fasta_files_rdd = sc.newAPIHadoopFile(
+            file_loc,
+            inputFormatClass="org.apache.hadoop.mapreduce.lib.input.TextInputFormat",
+            keyClass="org.apache.hadoop.io.LongWritable", valueClass="org.apache.hadoop.io.Text",
+            conf={"textinputformat.record.delimiter": "\n>"}).values()
+        # newAPIHadoopFile generates a RDD of tuples with a arbitrary key for each element
+        if file_loc.endswith(".gz"):
+            # gzip files can not be split, spread the records before parsing them
+            fasta_files_rdd = fasta_files_rdd.repartition(n_partitions)
 
     # Use regular expressions to extract the accession version from the sequence header and use it as key
-    # ----------------------------------------------------------------------------------------# Note: An accession
-    # number applies to the complete record and is usually a combination of a letter(s) and numbers, such as a single
-    # letter followed by five digits (e.g., U12345) or two letters followed by six digits Records from the RefSeq
-    # database of reference sequences have a different accession number format that begins with two letters followed
-    # by an underscore bar and six or more digits
-    # ----------------------------------------------------------------------------------------#
-    fasta_files_rdd = fasta_files_rdd.map(lambda x: (re.search("^>([_A-Za-z0-9.]+).*", x[0]).group(1), x))
     # rdd((key=accession.version, value=[header,sequence]))
+    return fasta_files_rdd.mapPartitions(partial(parse_fasta_records, packed=packed))
+
+
+def format_reduced(taxid, seqs, width=70):
+    """ format the reduced sequences of a rank as fasta records, the first sequence is the representative
+            :param taxid: the rank TaxID
+            :param seqs: a list of (sequence, header), the sequences may be packed
+            :param width: the length of the sequence lines
+            :return: the fasta records as a string
+    """
+    lines = []
+    for i, (seq, header) in enumerate(seqs):
+        seq = unpack(seq)
+        if i == 0:
+            lines.append(header + ", Representative " + str(taxid))
+        else:
+            lines.append(header + ", Unique" + str(i))
+        lines.extend(seq[j:j + width] for j in range(0, len(seq), width))
+        lines.append("")
+    lines.append("")
+    return "\n".join(lines)
+
 
-    return fasta_files_rdd
+def open_fasta_writer(filename, compression=None):
+    """ open a binary file to write, compressed with gzip or bgzf if requested
+    """
+    if compression is None:
+        return open(filename, "wb")
+    if compression == "gzip":
+        return gzip.open(filename, "wb")
+    if compression == "bgzf":
+        return BgzfWriter(filename)
+    raise ValueError("unknown compression " + str(compression))
 
 
 def rdd_to_fasta_local(seq_rdd, filename):
     """ create a fasta file locally from the given rdd using collect
                 :param seq_rdd: the rdd containing the sequences rdd((taxid,))
                 :param filename: the path to save the fasta file
-                :return:
+                :return: the path of the fasta file
         """
     seqs_rank_list = seq_rdd.collect()
     with open(filename + ".fasta", "w") as f:
-        for taxids_seqs in seqs_rank_list:
-            taxid = taxids_seqs[0]
-            seqs = taxids_seqs[1]
-            f.write(seqs[0][1] + ", Representative " + str(taxid) + "\n")
-            # write first sequence
-            for subseq in [seqs[0][0][j:j + 70] for j in range(0, len(seqs[0][0]), 70)]:
-                f.write(subseq + "\n")
-            f.write("\n")
-            # write reduced sequences
-            for i in range(1, len(seqs)):
-                f.write(seqs[i][1] + ", Unique" + str(i) + "\n")
-                for subseq in [seqs[i][0][j:j + 70] for j in range(0, len(seqs[i][0]), 70)]:
-                    f.write(subseq + "\n")
-                f.write("\n")
+        for taxid, seqs in seqs_rank_list:
+            f.write(format_reduced(taxid, seqs))
+    return filename + ".fasta"
+
+
+def write_fasta_stream(records, filename, compression=None):
+    """ write the reduced sequences to a fasta file as they are produced
+                :param records: an iterator of (taxid, [(sequence, header), ...])
+                :param filename: the path to save the fasta file, without extension
+                :param compression: None, "gzip" or "bgzf"
+                :return: the path of the fasta file
+        """
+    out_file = filename + compressions[compression]
+    with open_fasta_writer(out_file, compression) as f:
+        for taxid, seqs in records:
+            f.write(format_reduced(taxid, seqs).encode("UTF-8"))
+    return out_file
+
+
+def rdd_to_fasta_stream(seq_rdd, filename, compression=None):
+    """ create a fasta file locally from the given rdd using toLocalIterator,
+        the driver holds a single partition at a time
+                :param seq_rdd: the rdd containing the sequences rdd((taxid, [(sequence, header), ...]))
+                :param filename: the path to save the fasta file, without extension
+                :param compression: None, "gzip" or "bgzf"
+                :return: the path of the fasta file
+        """
+    return write_fasta_stream(seq_rdd.toLocalIterator(), filename, compression)
+
+
+def write_fasta_part(index, records, out_dir, compression=None):
+    """ write the records of a partition to the part file of the partition, the part file is written
+        under a temporary name and renamed once complete, so retried tasks never leave a partial file
+        :return: an iterator with the path of the part file
+    """
+    part_file = os.path.join(out_dir, "part-%05d" % index + compressions[compression])
+    tmp_file = part_file + ".tmp%d" % os.getpid()
+    with open_fasta_writer(tmp_file, compression) as f:
+        for taxid, seqs in records:
+            f.write(format_reduced(taxid, seqs).encode("UTF-8"))
+    os.replace(tmp_file, part_file)
+    yield part_file
+
+
+def rdd_to_fasta_parts(seq_rdd, out_dir, compression=None):
+    """ create a fasta part file for every partition of the rdd, the partitions are written by the executors
+                :param seq_rdd: the rdd containing the sequences rdd((taxid, [(sequence, header), ...]))
+                :param out_dir: a directory on storage shared by the driver and all the executors
+                :param compression: None, "gzip" or "bgzf"
+                :return: the paths of the part files sorted by partition
+        """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    return sorted(seq_rdd.mapPartitionsWithIndex(
+        lambda index, records: write_fasta_part(index, records, out_dir, compression)).collect())
+
+
+def merge_fasta_parts(part_files, filename, compression=None):
+    """ concatenate the part files into a single fasta file, concatenated gzip and bgzf files are valid files,
+        only the end of file block of the last bgzf part is kept
+                :param part_files: the paths of the part files, in order
+                :param filename: the path to save the fasta file, without extension
+                :param compression: the compression of the part files
+                :return: the path of the fasta file
+        """
+    out_file = filename + compressions[compression]
+    with open(out_file, "wb") as out:
+        for part_file in part_files:
+            with open(part_file, "rb") as part:
+                if compression == "bgzf":
+                    size = os.path.getsize(part_file)
+                    part.seek(size - len(EOF_BLOCK))
+                    if part.read() == EOF_BLOCK:
+                        size -= len(EOF_BLOCK)
+                    part.seek(0)
+                    _copy_bytes(part, out, size)
+                else:
+                    shutil.copyfileobj(part, out)
+        if compression == "bgzf":
+            out.write(EOF_BLOCK)
+    return out_file
+
+
+def _copy_bytes(src, dst, size, buffer_size=1 << 20):
+    while size > 0:
+        data = src.read(min(size, buffer_size))
+        if not data:
+            break
+        dst.write(data)
+        size -= len(data)
@@ -0,0 +1,131 @@
+#     sketch: Content hashes and k-mer sketches to compare sequences without aligning them
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import hashlib
+
+import numpy as np
+
+from sparkseqreducer.packed import encode, sequence_bytes
+
+_max_hash = np.iinfo(np.uint64).max
+
+
+def kmers(codes, k):
+    """ the integer value of every k-mer of a coded sequence (k <= 31)
+        :return: an uint64 array with one value per position, and a mask of the valid (ACGT only) k-mers
+    """
+    n = len(codes) - k + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.uint64), np.empty(0, dtype=bool)
+    values = np.zeros(n, dtype=np.uint64)
+    for j in range(k):
+        values <<= np.uint64(2)
+        values |= (codes[j:j + n] & 3).astype(np.uint64)
+    invalid = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = (invalid[k:] - invalid[:n]) == 0
+    return values, valid
+
+
+def hash64(values):
+    """ splitmix64 finalizer, spreads the k-mer values uniformly over 64 bits
+    """
+    values = values + np.uint64(0x9E3779B97F4A7C15)
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return values ^ (values >> np.uint64(31))
+
+
+def content_hash(seq):
+    """ a digest of the sequence content (str or PackedSequence), case insensitive
+    """
+    return hashlib.blake2b(sequence_bytes(seq).upper(), digest_size=16).digest()
+
+
+def compute_sketch(seq, k=21, scale=50):
+    """ a FracMinHash sketch of the sequence, the k-mer hashes below max_hash / scale
+        :param seq: the sequence string
+        :param k: the k-mer length
+        :param scale: keep about one k-mer out of scale
+        :return: a sorted uint64 array of unique hashes
+    """
+    values, valid = kmers(encode(seq), k)
+    hashes = hash64(values[valid])
+    return np.unique(hashes[hashes <= np.uint64(_max_hash // scale)])
+
+
+def containment(sketch_b, sketch_a):
+    """ the estimated fraction of the k-mers of b that are also in a
+    """
+    if not len(sketch_b):
+        return 0.0
+    return len(np.intersect1d(sketch_b, sketch_a, assume_unique=True)) / float(len(sketch_b))
+
+
+def containment_identity(sketch_b, sketch_a, k=21):
+    """ the identity of b to a estimated from the k-mer containment, c ** (1 / k)
+    """
+    return containment(sketch_b, sketch_a) ** (1.0 / k)
+
+
+def _kmer_set(codes, k):
+    values, valid = kmers(codes, k)
+    return np.unique(values[valid])
+
+
+# k -> (sequence, k-mer set) of the last reference, the members of a rank are compared to the same representative
+_references = {}
+
+
+def reference_kmers(seq_a, k):
+    """ the k-mer set of a reference sequence, it is computed once while the same sequence object is
+        the reference of consecutive calls
+    """
+    cached = _references.get(k)
+    if cached is not None and cached[0] is seq_a:
+        return cached[1]
+    kmers_a = _kmer_set(encode(seq_a), k)
+    _references[k] = (seq_a, kmers_a)
+    return kmers_a
+
+
+def contains_kmers(seq_b, seq_a, k=21):
+    """ check that every k-mer of seq_b is a k-mer of seq_a, on the full k-mer sets
+        :param seq_b: a sequence string or PackedSequence
+        :param seq_a: a sequence string or PackedSequence, the reference of reference_kmers
+        :param k: the k-mer length
+        :return: False when seq_b has no k-mer or a k-mer with a character other than ACGT
+    """
+    values, valid = kmers(encode(seq_b), k)
+    if not len(values) or not valid.all():
+        return False
+    return bool(np.isin(values, reference_kmers(seq_a, k)).all())
+
+
+def strand(seq_b, seq_a, k=15):
+    """ the orientation of seq_b relative to seq_a, from the k-mers seq_a shares with each strand of seq_b
+        :param seq_b: a sequence string or PackedSequence
+        :param seq_a: a sequence string or PackedSequence
+        :param k: the k-mer length
+        :return: "-" when seq_a shares more k-mers with the reverse complement of seq_b, "+" otherwise
+    """
+    codes_b = encode(seq_b)
+    # the complement of the codes 0..3 is 3 - code, the other characters stay 4
+    reverse_b = codes_b[::-1].copy()
+    bases = reverse_b < 4
+    reverse_b[bases] = 3 - reverse_b[bases]
+    kmers_a = reference_kmers(seq_a, k)
+    forward = len(np.intersect1d(kmers_a, _kmer_set(codes_b, k), assume_unique=True))
+    reverse = len(np.intersect1d(kmers_a, _kmer_set(reverse_b, k), assume_unique=True))
+    return "-" if reverse > forward else "+"
@@ -15,20 +15,93 @@
 #     along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import ctypes
 import os
+import threading
+
+from sparkseqreducer.packed import sequence_bytes
 
 _lib_stretcher = os.path.abspath(os.path.join(os.path.dirname(__file__), "./stretcher/libstretcher.so"))
 _stretcher = ctypes.CDLL(_lib_stretcher)
-_stretcher.stretcher.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p]
-_stretcher.stretcher.restype = ctypes.c_char_p
-
-
-def align(seq_a, seq_b, cmp_mat_file):
-    global _stretcher
-    if len(seq_a) < len(seq_b):
-        seq_a, seq_b = seq_b, seq_a
-    # if s' and t' (s and t with gaps) are the alignment output then
-    # card(s') = card(t') = l, and max(m, n) <= l <= m + n
-    res0 = ctypes.create_string_buffer(len(seq_a) + len(seq_b) + 1)
-    res1 = ctypes.create_string_buffer(len(seq_a) + len(seq_b) + 1)
-    result = _stretcher.stretcher(seq_a.encode("UTF-8"), seq_b.encode("UTF-8"), res0, res1, cmp_mat_file.encode("UTF-8"))
-    return res0.value.decode("UTF-8"), res1.value.decode("UTF-8")
+_stretcher.stretcher.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p]
+_stretcher.stretcher.restype = ctypes.c_int
+_stretcher.stretcher_new.argtypes = [ctypes.c_char_p, ctypes.c_int, ctypes.c_int]
+_stretcher.stretcher_new.restype = ctypes.c_void_p
+_stretcher.stretcher_align.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p,
+                                       ctypes.c_char_p, ctypes.c_char_p]
+_stretcher.stretcher_align.restype = ctypes.c_int
+_stretcher.stretcher_free.argtypes = [ctypes.c_void_p]
+_stretcher.stretcher_free.restype = None
+
+# reading the matrix file goes through emboss globals, handles are created one at a time
+_new_lock = threading.Lock()
+_local = threading.local()
+
+
+class Aligner(object):
+    """ A stretcher alignment handle, the scoring matrix is loaded once and the
+    working buffers are reused between calls. A handle must only be used by one
+    thread at a time, different handles can align at the same time because ctypes
+    releases the GIL during the call.
+    """
+
+    def __init__(self, cmp_mat_file, gap_open=16, gap_extend=4):
+        self.cmp_mat_file = cmp_mat_file
+        self.gap_open = gap_open
+        self.gap_extend = gap_extend
+        with _new_lock:
+            self._handle = _stretcher.stretcher_new(cmp_mat_file.encode("UTF-8"), gap_open, gap_extend)
+        if not self._handle:
+            raise IOError("The comparison matrix " + cmp_mat_file + " could not be read")
+        self._buffer_size = 0
+        self._res0 = None
+        self._res1 = None
+
+    def align(self, seq_a, seq_b):
+        """ global alignment of two sequences, the longest sequence is always returned first
+            :param seq_a: a sequence string or PackedSequence
+            :param seq_b: a sequence string or PackedSequence
+            :return: the two aligned sequences (with gaps) as strings of the same length
+        """
+        if len(seq_a) < len(seq_b):
+            seq_a, seq_b = seq_b, seq_a
+        # if s' and t' (s and t with gaps) are the alignment output then
+        # card(s') = card(t') = l, and max(m, n) <= l <= m + n
+        size = len(seq_a) + len(seq_b) + 1
+        if size > self._buffer_size:
+            self._res0 = ctypes.create_string_buffer(size)
+            self._res1 = ctypes.create_string_buffer(size)
+            self._buffer_size = size
+        if _stretcher.stretcher_align(self._handle, sequence_bytes(seq_a), sequence_bytes(seq_b),
+                                      self._res0, self._res1) != 0:
+            raise MemoryError("stretcher could not allocate the alignment buffers")
+        return self._res0.value.decode("UTF-8"), self._res1.value.decode("UTF-8")
+
+    def close(self):
+        if self._handle:
+            _stretcher.stretcher_free(self._handle)
+            self._handle = None
+            self._res0 = self._res1 = None
+            self._buffer_size = 0
+
+    def __del__(self):
+        self.close()
+
+
+def get_aligner(cmp_mat_file, gap_open=16, gap_extend=4):
+    """ get an aligner for the current thread, aligners are created once per thread and parameters
+        :param cmp_mat_file: the path to the comparison matrix
+        :param gap_open: the gap opening penalty
+        :param gap_extend: the gap extension penalty
+        :return: an Aligner
+    """
+    aligners = getattr(_local, "aligners", None)
+    if aligners is None:
+        aligners = _local.aligners = {}
+    key = (cmp_mat_file, gap_open, gap_extend)
+    aligner = aligners.get(key)
+    if aligner is None:
+        aligner = aligners[key] = Aligner(cmp_mat_file, gap_open, gap_extend)
+    return aligner
+
+
+def align(seq_a, seq_b, cmp_mat_file, gap_open=16, gap_extend=4):
+    return get_aligner(cmp_mat_file, gap_open, gap_extend).align(seq_a, seq_b)
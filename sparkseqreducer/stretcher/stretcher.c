@@ -23,44 +23,101 @@
 ** Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA  02111-1307, USA.
 ******************************************************************************/
 
+#include <ctype.h>
+
 #include "emboss.h"
 #include "stretcher.h"
 
 
 
 
+/* @datastatic StretcherPAligner **********************************************
+**
+** Alignment handle, owns the scoring matrix and the working buffers so
+** several handles can be used at the same time from different threads
+**
+** @attr matrix [AjPMatrix] Scoring matrix, loaded once
+** @attr sub [ajint**] Substitution scores of the matrix
+** @attr cvt [AjPSeqCvt] Sequence character conversion table of the matrix
+** @attr gapopen [ajint] Gap opening penalty
+** @attr gapextend [ajint] Gap extension penalty
+** @attr g [ajint] Gap penalty minus extension penalty of the current alignment
+** @attr hh [ajint] Gap extension penalty of the current alignment
+** @attr m [ajint] g + hh
+** @attr sapp [ajint*] Current script append ptr
+** @attr last [ajint] Last script op appended
+** @attr CC [ajint*] Forward cost-only vector
+** @attr DD [ajint*] Forward cost-only vector
+** @attr RR [ajint*] Reverse cost-only vector
+** @attr SS [ajint*] Reverse cost-only vector
+** @attr nmax [size_t] Allocated length of the cost-only vectors
+** @attr res [ajint*] Edit script
+** @attr seq0 [char*] Upper case sequence A
+** @attr seq1 [char*] Upper case sequence B
+** @attr aa0 [char*] Matrix codes of sequence A with a leading blank
+** @attr aa1 [char*] Matrix codes of sequence B with a leading blank
+** @attr size [size_t] Allocated length of the sequence buffers
+** @attr ressize [size_t] Allocated length of the edit script
+******************************************************************************/
+
+typedef struct StretcherSAligner
+{
+    AjPMatrix matrix;
+    ajint **sub;
+    AjPSeqCvt cvt;
+    ajint gapopen;
+    ajint gapextend;
+    ajint g;
+    ajint hh;
+    ajint m;
+    ajint *sapp;
+    ajint last;
+    ajint *CC;
+    ajint *DD;
+    ajint *RR;
+    ajint *SS;
+    size_t nmax;
+    ajint *res;
+    char *seq0;
+    char *seq1;
+    char *aa0;
+    char *aa1;
+    size_t size;
+    size_t ressize;
+} StretcherOAligner;
+
+#define StretcherPAligner StretcherOAligner*
+
+
+
+
 /* @macro stretchergap ********************************************************
 **
 ** k-symbol indel score
 **
+** @param [r] h [StretcherPAligner] Alignment handle
 ** @param [r] k [ajint] Symbol
 ** @return [void]
 ******************************************************************************/
 
-#define stretchergap(k)  ((k) <= 0 ? 0 : g+hh*(k)) /* k-symbol indel score */
+#define stretchergap(h, k)  ((k) <= 0 ? 0 : (h)->g+(h)->hh*(k)) /* k-symbol indel score */
 
 
 
 
-static ajint stretcher_Ealign(const char *A, const char *B,
-			      const AjPSeq seq0, const AjPSeq seq1, ajint G,
-			      ajint H,ajint *S, ajint* NC);
-static ajint stretcher_Calcons(ajint n0, ajint n1, const ajint* res);
-static ajint stretcher_Align(const char *A, const char *B,
+static ajint stretcher_Ealign(StretcherPAligner h, const char *A, const char *B,
+			      ajint M, ajint N, ajint G, ajint H, ajint *S,
+			      ajint* NC);
+static ajint stretcher_Calcons(const StretcherPAligner h, ajint n0, ajint n1,
+			       const ajint* res, char *seqc0, char *seqc1);
+static ajint stretcher_Align(StretcherPAligner h, const char *A, const char *B,
 			     ajint M, ajint N, ajint tb,
 			     ajint te);
-static ajint stretcher_CheckScore(const unsigned char *A,
+static ajint stretcher_CheckScore(const StretcherPAligner h,
+				  const unsigned char *A,
 				  const unsigned char *B,
-				  const AjPSeq seq0, const AjPSeq seq1,
-				  ajint *S,ajint *NC);
-
-static ajint *sapp;				/* Current script append ptr */
-static ajint  last;				/* Last script op appended */
-
-                                                /* gap penalties */
-static ajint g;
-static ajint hh;
-static ajint m;					/* g = G, hh = H, m = g+h */
+				  ajint M, ajint N, ajint *S, ajint *NC);
+static int stretcher_Reserve(StretcherPAligner h, size_t M, size_t N);
 
 
 
@@ -69,15 +126,16 @@ static ajint m;					/* g = G, hh = H, m = g+h */
 **
 ** Macro for a "Delete k" operation
 **
+** @param [r] h [StretcherPAligner] Alignment handle
 ** @param [r] k [ajint] Undocumented
 ** @return [void]
 ******************************************************************************/
 
-#define STRETCHERDEL(k)			\
-{ if (last < 0)				\
-    last = sapp[-1] -= (k);		\
-  else					\
-    last = *sapp++ = -(k);		\
+#define STRETCHERDEL(h, k)				\
+{ if ((h)->last < 0)					\
+    (h)->last = (h)->sapp[-1] -= (k);			\
+  else							\
+    (h)->last = *(h)->sapp++ = -(k);			\
 }
 						/* Append "Insert k" op */
 
@@ -88,15 +146,16 @@ static ajint m;					/* g = G, hh = H, m = g+h */
 **
 ** Macro for an "Insert k" operation
 **
+** @param [r] h [StretcherPAligner] Alignment handle
 ** @param [r] k [ajint] Undocumented
 ** @return [void]
 ******************************************************************************/
 
-#define STRETCHERINS(k)			\
-{ if (last < 0)				\
-    { sapp[-1] = (k); *sapp++ = last; }	\
-  else					\
-    last = *sapp++ = (k);		\
+#define STRETCHERINS(h, k)				\
+{ if ((h)->last < 0)					\
+    { (h)->sapp[-1] = (k); *(h)->sapp++ = (h)->last; }	\
+  else							\
+    (h)->last = *(h)->sapp++ = (k);			\
 }
 
 
@@ -106,30 +165,144 @@ static ajint m;					/* g = G, hh = H, m = g+h */
 **
 ** Macro for a "Replace" operation
 **
+** @param [r] h [StretcherPAligner] Alignment handle
+** @return [void]
+******************************************************************************/
+
+#define STRETCHERREP(h) { (h)->last = *(h)->sapp++ = 0; } /* Append "Replace" op */
+
+
+
+
+/* @func stretcher_new ********************************************************
+**
+** Creates an alignment handle, the scoring matrix is read once
+**
+** @param [r] cmpMatFile [const char*] Scoring matrix file
+** @param [r] gapOpen [int] Gap opening penalty
+** @param [r] gapExtend [int] Gap extension penalty
+** @return [void*] Alignment handle or NULL if the matrix can not be read
+******************************************************************************/
+
+void *stretcher_new(const char *cmpMatFile, int gapOpen, int gapExtend)
+{
+    StretcherPAligner h;
+    AjPStr filename;
+
+    h = calloc(1, sizeof(StretcherOAligner));
+    if(h == NULL)
+	return NULL;
+
+    filename = ajStrNewC(cmpMatFile);
+    h->matrix = ajMatrixNewFile(filename);
+    ajStrDel(&filename);
+
+    if(h->matrix == NULL)
+    {
+	free(h);
+	return NULL;
+    }
+
+    h->sub = ajMatrixGetMatrix(h->matrix);
+    h->cvt = ajMatrixGetCvt(h->matrix);
+    h->gapopen = gapOpen;
+    h->gapextend = gapExtend;
+
+    return h;
+}
+
+
+
+
+/* @func stretcher_free *******************************************************
+**
+** Deletes an alignment handle, its scoring matrix and its buffers
+**
+** @param [d] handle [void*] Alignment handle
 ** @return [void]
 ******************************************************************************/
 
-#define STRETCHERREP { last = *sapp++ = 0; } /* Append "Replace" op */
+void stretcher_free(void *handle)
+{
+    StretcherPAligner h = handle;
+
+    if(h == NULL)
+	return;
+
+    ajMatrixDel(&h->matrix);
+    free(h->CC);
+    free(h->DD);
+    free(h->RR);
+    free(h->SS);
+    free(h->res);
+    free(h->seq0);
+    free(h->seq1);
+    free(h->aa0);
+    free(h->aa1);
+    free(h);
+}
+
+
+
+
+/* @func stretcher_align ******************************************************
+**
+** Finds the best global alignment between two sequences using a handle,
+** the result buffers must hold at least strlen(seqA)+strlen(seqB)+1 chars
+**
+** @param [u] handle [void*] Alignment handle
+** @param [r] seqA [const char*] Sequence A
+** @param [r] seqB [const char*] Sequence B
+** @param [w] retSeqA [char*] Aligned sequence A
+** @param [w] retSeqB [char*] Aligned sequence B
+** @return [int] 0 on success, -1 on error
+******************************************************************************/
+
+int stretcher_align(void *handle, const char *seqA, const char *seqB,
+		    char *retSeqA, char *retSeqB)
+{
+    StretcherPAligner h = handle;
+    size_t M;
+    size_t N;
+    size_t i;
+    ajint nres;
+    ajint nc;
+    unsigned char ch;
 
+    if(h == NULL)
+	return -1;
 
-static AjPSeq glseq0;
-static AjPSeq glseq1;
+    M = strlen(seqA);
+    N = strlen(seqB);
 
-static ajint *CC, *DD;			/* Forward cost-only vectors */
-static ajint *RR, *SS;		        /* Reverse cost-only vectors */
+    if(stretcher_Reserve(h, M, N) != 0)
+	return -1;
 
-static ajint nd;
-static ajint *glres;
-static ajint nres;
-static ajint glnc;
+    //Upper case and matrix codes, with a leading blank to index from 1
+    h->aa0[0] = ' ';
+    h->aa1[0] = ' ';
+    for(i=0;i<M;i++)
+    {
+	ch = (unsigned char) toupper((unsigned char) seqA[i]);
+	h->seq0[i] = (char) ch;
+	h->aa0[i+1] = (char) (ch < 128 ? ajSeqcvtGetCodeK(h->cvt, (char) ch) : 0);
+    }
+    for(i=0;i<N;i++)
+    {
+	ch = (unsigned char) toupper((unsigned char) seqB[i]);
+	h->seq1[i] = (char) ch;
+	h->aa1[i+1] = (char) (ch < 128 ? ajSeqcvtGetCodeK(h->cvt, (char) ch) : 0);
+    }
 
-static AjPMatrix matrix = NULL;
+    stretcher_Ealign(h, h->aa0, h->aa1, (ajint) M, (ajint) N,
+		     (h->gapopen-h->gapextend), h->gapextend, h->res, &nres);
 
-static ajint **sub;
-static AjPSeqCvt cvt = NULL;
+    nc = stretcher_Calcons(h, (ajint) M, (ajint) N, h->res, retSeqA, retSeqB);
+    retSeqA[nc] = '\0';
+    retSeqB[nc] = '\0';
 
-static char *seqc0;
-static char *seqc1;   /* aligned sequences */
+    return 0;
+}
 
 
 
@@ -142,117 +315,71 @@ static char *seqc1;   /* aligned sequences */
 
 const int stretcher(char *seqA, char *seqB, char *retSeqA, char *retSeqB, char *cmpMatFile)
 {
-    AjPStr aa0str = 0;
-    AjPStr aa1str = 0;
-    const char *s1;
-    const char *s2;
-    ajint gdelval;
-    ajint ggapval;
-    ajuint i;
-    ajint gscore;
-    /* float percent; */
-    AjPAlign align   = NULL;
-    //AjPSeqset seqset = NULL;
-
-    AjPSeq res0 = NULL;
-    AjPSeq res1 = NULL;
-
-    //Creates the two sequences from two inputs strings (char*)
-    glseq0 = NULL;
-    glseq0 = ajSeqNewNameC(seqA, "Seq0");
-    ajSeqAssignUsaS(glseq0, ajStrNewC("Seq0"));
-
-    glseq1 = NULL;
-    glseq1 = ajSeqNewNameC(seqB, "Seq1");
-    ajSeqAssignUsaS(glseq1, ajStrNewC("Seq1"));
-    
-    //Declaring the matrix (scoring matrix) object, read from file
-    matrix = ajMatrixNewFile(ajStrNewC(cmpMatFile));
-
-    gdelval = 16;
-    ggapval = 4;
-
-    //Trims the sequence using begin,end. Does reverse complement if needed
-    ajSeqTrim(glseq0);
-    ajSeqTrim(glseq1);
-
-    //Upper case
-    ajSeqFmtUpper(glseq0);
-    ajSeqFmtUpper(glseq1);
-
-    //returns a pointer to the sequence string
-    s1 = ajStrGetPtr(ajSeqGetSeqS(glseq0));
-    s2 = ajStrGetPtr(ajSeqGetSeqS(glseq1));
-
-    //gets the substitution and cvt matrices from matrix
-    sub = ajMatrixGetMatrix(matrix);
-    cvt = ajMatrixGetCvt(matrix);
-
-    //prepares empty string with allocated size
-    aa0str = ajStrNewRes(2+ajSeqGetLen(glseq0)); /* length + blank + trailing null */
-    aa1str = ajStrNewRes(2+ajSeqGetLen(glseq1));
-    ajStrAppendK(&aa0str,' ');
-    ajStrAppendK(&aa1str,' ');
-
-    for(i=0;i<ajSeqGetLen(glseq0);i++)
-	ajStrAppendK(&aa0str,(char)ajSeqcvtGetCodeK(cvt, *s1++));
-
-    for(i=0;i<ajSeqGetLen(glseq1);i++)
-	ajStrAppendK(&aa1str,ajSeqcvtGetCodeK(cvt, *s2++));
-
-    AJCNEW(glres,   ajSeqGetLen(glseq0)+ajSeqGetLen(glseq1));
-    AJCNEW(seqc0, ajSeqGetLen(glseq0)+ajSeqGetLen(glseq1));
-    AJCNEW(seqc1, ajSeqGetLen(glseq0)+ajSeqGetLen(glseq1));
-
-    gscore = stretcher_Ealign(ajStrGetPtr(aa0str),ajStrGetPtr(aa1str),
-			      glseq0, glseq1,
-			      (gdelval-ggapval),ggapval,glres,&nres);
-
-    glnc = stretcher_Calcons(ajSeqGetLen(glseq0),ajSeqGetLen(glseq1),glres);
-
-    //Creates the first aligned sequence (should be the longest sequence)
-    res0 =  ajSeqNewRangeC(seqc0, ajSeqGetOffset(glseq0), ajSeqGetOffend(glseq0),
-			       ajSeqIsReversed(glseq0));
-    ajSeqAssignUsaS(res0, ajSeqGetUsaS(glseq0));
-    ajSeqAssignNameS(res0, ajSeqGetNameS(glseq0));
-
-    //Creates the second aligned sequence
-    res1 =  ajSeqNewRangeC(seqc1, ajSeqGetOffset(glseq1), ajSeqGetOffend(glseq1),
-			       ajSeqIsReversed(glseq1));
-    ajSeqAssignUsaS(res1, ajSeqGetUsaS(glseq1));
-    ajSeqAssignNameS(res1, ajSeqGetNameS(glseq1));
-
-    //copy res0 to the output variable
-    strcpy(retSeqA, ajStrGetPtr(ajSeqGetSeqS(res0)));
-
-    //copy res1 to the output variable
-    strcpy(retSeqB, ajStrGetPtr(ajSeqGetSeqS(res1)));
-
-    AJFREE(glres);
-    AJFREE(seqc0);
-    AJFREE(seqc1);
-    AJFREE(CC);
-    AJFREE(DD);
-    AJFREE(RR);
-    AJFREE(SS);
-    ajStrDel(&aa0str);
-    ajStrDel(&aa1str);
-
-    ajSeqDel(&res0);
-    ajSeqDel(&res1);
-    //ajSeqsetDel(&seqset);
-    ajSeqDel(&glseq0);
-    ajSeqDel(&glseq1);
-    /* ajMatrixDel(&matrix);*/ /* owned by align, deleted by ajAlignDel */
-
-    //embExit();
+    void *handle;
+    int ret;
 
-    return 0;
+    handle = stretcher_new(cmpMatFile, 16, 4);
+    if(handle == NULL)
+	return -1;
+
+    ret = stretcher_align(handle, seqA, seqB, retSeqA, retSeqB);
+    stretcher_free(handle);
+
+    return ret;
 }
 
-/* Interface and top level of comparator */
 
-static ajint nmax=0;
+
+
+/* @funcstatic stretcher_Reserve **********************************************
+**
+** Grows the buffers of a handle to align sequences of length M and N
+**
+** @param [u] h [StretcherPAligner] Alignment handle
+** @param [r] M [size_t] Length of sequence A
+** @param [r] N [size_t] Length of sequence B
+** @return [int] 0 on success, -1 if memory can not be allocated
+******************************************************************************/
+
+static int stretcher_Reserve(StretcherPAligner h, size_t M, size_t N)
+{
+    void *p;
+
+    if(M > h->size || N > h->size)
+    {
+	h->size = M > N ? M : N;
+	if((p = realloc(h->seq0, h->size+1)) == NULL) return -1;
+	h->seq0 = p;
+	if((p = realloc(h->seq1, h->size+1)) == NULL) return -1;
+	h->seq1 = p;
+	if((p = realloc(h->aa0, h->size+2)) == NULL) return -1;
+	h->aa0 = p;
+	if((p = realloc(h->aa1, h->size+2)) == NULL) return -1;
+	h->aa1 = p;
+    }
+
+    if(M+N+1 > h->ressize)
+    {
+	h->ressize = M+N+1;
+	if((p = realloc(h->res, h->ressize*sizeof(ajint))) == NULL) return -1;
+	h->res = p;
+    }
+
+    if(N+1 > h->nmax)
+    {
+	h->nmax = N+1;
+	if((p = realloc(h->CC, h->nmax*sizeof(ajint))) == NULL) return -1;
+	h->CC = p;
+	if((p = realloc(h->DD, h->nmax*sizeof(ajint))) == NULL) return -1;
+	h->DD = p;
+	if((p = realloc(h->RR, h->nmax*sizeof(ajint))) == NULL) return -1;
+	h->RR = p;
+	if((p = realloc(h->SS, h->nmax*sizeof(ajint))) == NULL) return -1;
+	h->SS = p;
+    }
+
+    return 0;
+}
 
 
 
@@ -261,10 +388,11 @@ static ajint nmax=0;
 **
 ** Undocumented
 **
+** @param [u] h [StretcherPAligner] Alignment handle
 ** @param [r] A [const char*] Sequence A with trailing blank
 ** @param [r] B [const char*] Sequence B with trailing blank
-** @param [r] seq0 [const AjPSeq] Sequence A
-** @param [r] seq1 [const AjPSeq] Sequence B
+** @param [r] M [ajint] Length of sequence A
+** @param [r] N [ajint] Length of sequence B
 ** @param [r] G [ajint] Gap penalty (minus extension penalty)
 ** @param [r] H [ajint] Gap extension penalty
 ** @param [w] S [ajint*] Result
@@ -272,51 +400,23 @@ static ajint nmax=0;
 ** @return [ajint] Undocumented
 ******************************************************************************/
 
-static ajint stretcher_Ealign(const char *A,const char *B,
-			      const AjPSeq seq0, const AjPSeq seq1, ajint G,
+static ajint stretcher_Ealign(StretcherPAligner h, const char *A, const char *B,
+			      ajint M, ajint N, ajint G,
 			      ajint H,ajint *S,ajint *NC)
 {
     ajint c;
     ajint ck;
 
-    ajint M = ajSeqGetLen(seq0);
-    ajint N = ajSeqGetLen(seq1);
-
-    /*  if(N > NMAX) return -1;*/	/* Error check */
-
     /* Setup global parameters */
-    g    = G;
-    hh   = H;
-    m    = g+hh;
-    sapp = S;
-    last = 0;
-
-    if(CC==NULL)
-    {
-	nmax = ajSeqGetLen(seq1);
-	AJCNEW(CC, nmax+1);
-	AJCNEW(DD, nmax+1);
-	AJCNEW(RR, nmax+1);
-	AJCNEW(SS, nmax+1);
-    }
-    else if(N > nmax)
-    {
-	nmax = ajSeqGetLen(seq1);
-	AJCRESIZE(CC, nmax+1);
-	AJCRESIZE(DD, nmax+1);
-	AJCRESIZE(RR, nmax+1);
-	AJCRESIZE(SS, nmax+1);
-    }
-
-    if(CC==NULL || DD==NULL || RR==NULL || SS==NULL)
-    {
-	ajErr(" cannot allocate llmax arrays\n");
-	//embExitBad();
-    }
+    h->g    = G;
+    h->hh   = H;
+    h->m    = h->g+h->hh;
+    h->sapp = S;
+    h->last = 0;
 
-    c  = stretcher_Align(A,B,M,N,-g,-g);	/* OK, do it */
-    ck = stretcher_CheckScore((unsigned const char *)A,(unsigned const char *)B,
-                              seq0, seq1,S,NC);
+    c  = stretcher_Align(h,A,B,M,N,-h->g,-h->g);	/* OK, do it */
+    ck = stretcher_CheckScore(h,(unsigned const char *)A,(unsigned const char *)B,
+                              M,N,S,NC);
 
     if(c != ck)
 	ajWarn("stretcher CheckScore failed");
@@ -327,12 +427,14 @@ static ajint stretcher_Ealign(const char *A,const char *B,
 
 
 
+
 /* @funcstatic stretcher_Align ************************************************
 **
 ** align(A,B,M,N,tb,te) returns the cost of an optimum conversion between
 ** A[1..M] and B[1..N] that begins(ends) with a delete if tb(te) is zero
 ** and appends such a conversion to the current script.
 **
+** @param [u] h [StretcherPAligner] Alignment handle
 ** @param [r] A [const char*] Undocumented
 ** @param [r] B [const char*] Undocumented
 ** @param [r] M [ajint] Undocumented
@@ -342,15 +444,13 @@ static ajint stretcher_Ealign(const char *A,const char *B,
 ** @return [ajint] Undocumented
 ******************************************************************************/
 
-static ajint stretcher_Align(const char *A,const char *B,
+static ajint stretcher_Align(StretcherPAligner h, const char *A,const char *B,
 			     ajint M,ajint N,ajint tb,ajint te)
 {
     ajint midi;
     ajint midj;
     ajint type;				/* Midpoint, type, and cost */
     ajint midc;
-    ajint c1;
-    ajint c2;
 
 
     register ajint i;
@@ -367,28 +467,28 @@ static ajint stretcher_Align(const char *A,const char *B,
     if(N <= 0)
     {
 	if(M > 0)
-	    STRETCHERDEL(M);
+	    STRETCHERDEL(h,M);
 
-	return -stretchergap(M);
+	return -stretchergap(h,M);
     }
 
     if(M <= 1)
     {
 	if(M <= 0)
 	{
-	    STRETCHERINS(N)
-	    return -stretchergap(N);
+	    STRETCHERINS(h,N)
+	    return -stretchergap(h,N);
 	}
 
 	if(tb < te)
 	    tb = te;
 
-	midc = (tb-hh) - stretchergap(N);
+	midc = (tb-h->hh) - stretchergap(h,N);
 	midj = 0;
-	wa = sub[(ajint)A[1]];
+	wa = h->sub[(ajint)A[1]];
 	for(j = 1; j <= N; j++)
         {
-	    c = -stretchergap(j-1) + wa[(ajint)B[j]] - stretchergap(N-j);
+	    c = -stretchergap(h,j-1) + wa[(ajint)B[j]] - stretchergap(h,N-j);
 
 	    if(c > midc)
             {
@@ -399,15 +499,15 @@ static ajint stretcher_Align(const char *A,const char *B,
 
 	if(midj == 0)
         {
-	    STRETCHERINS(N) STRETCHERDEL(1)
+	    STRETCHERINS(h,N) STRETCHERDEL(h,1)
 	}
 	else
         {
 	    if(midj > 1)
-		STRETCHERINS(midj-1)
-		    STRETCHERREP
+		STRETCHERINS(h,midj-1)
+		    STRETCHERREP(h)
 			if(midj < N)
-			    STRETCHERINS(N-midj)
+			    STRETCHERINS(h,N-midj)
         }
 
 	return midc;
@@ -416,26 +516,26 @@ static ajint stretcher_Align(const char *A,const char *B,
     /* Divide: Find optimum midpoint (midi,midj) of cost midc */
 
     midi  = M/2;	 /* Forward phase:                          */
-    CC[0] = 0;		 /*   Compute C(M/2,k) & D(M/2,k) for all k */
-    t     = -g;
+    h->CC[0] = 0;		 /*   Compute C(M/2,k) & D(M/2,k) for all k */
+    t     = -h->g;
     for(j = 1; j <= N; j++)
     {
-	CC[j] = t = t-hh;
-	DD[j] = t-g;
+	h->CC[j] = t = t-h->hh;
+	h->DD[j] = t-h->g;
     }
     t = tb;
 
     for(i = 1; i <= midi; i++)
     {
-	s = CC[0];
-	CC[0] = c = t = t-hh;
-	e = t-g;
-	wa = sub[(ajint)A[i]];
+	s = h->CC[0];
+	h->CC[0] = c = t = t-h->hh;
+	e = t-h->g;
+	wa = h->sub[(ajint)A[i]];
 	for(j = 1; j <= N; j++)
         {
-	    if((c =   c   - m) > (e =   e   - hh))
+	    if((c =   c   - h->m) > (e =   e   - h->hh))
 		e = c;
-	    if((c = CC[j] - m) > (d = DD[j] - hh))
+	    if((c = h->CC[j] - h->m) > (d = h->DD[j] - h->hh))
 		d = c;
 	    c = s + wa[(ajint)B[j]];
 
@@ -445,34 +545,34 @@ static ajint stretcher_Align(const char *A,const char *B,
 	    if(d > c)
 		c = d;
 
-	    s = CC[j];
-	    CC[j] = c;
-	    DD[j] = d;
+	    s = h->CC[j];
+	    h->CC[j] = c;
+	    h->DD[j] = d;
         }
     }
-    DD[0] = CC[0];
+    h->DD[0] = h->CC[0];
 
-    RR[N] = 0;		 /* Reverse phase:                          */
-    t = -g;		 /*   Compute R(M/2,k) & S(M/2,k) for all k */
+    h->RR[N] = 0;		 /* Reverse phase:                          */
+    t = -h->g;		 /*   Compute R(M/2,k) & S(M/2,k) for all k */
     for(j = N-1; j >= 0; j--)
     {
-	RR[j] = t = t-hh;
-	SS[j] = t-g;
+	h->RR[j] = t = t-h->hh;
+	h->SS[j] = t-h->g;
     }
     t = te;
 
     for(i = M-1; i >= midi; i--)
     {
-	s = RR[N];
-	RR[N] = c = t = t-hh;
-	e = t-g;
-	wa = sub[(ajint)A[i+1]];
+	s = h->RR[N];
+	h->RR[N] = c = t = t-h->hh;
+	e = t-h->g;
+	wa = h->sub[(ajint)A[i+1]];
 	for(j = N-1; j >= 0; j--)
         {
-	    if((c =   c   - m) > (e =   e   - hh))
+	    if((c =   c   - h->m) > (e =   e   - h->hh))
 		e = c;
 
-	    if((c = RR[j] - m) > (d = SS[j] - hh))
+	    if((c = h->RR[j] - h->m) > (d = h->SS[j] - h->hh))
 		d = c;
 	    c = s + wa[(ajint)B[j+1]];
 
@@ -482,26 +582,26 @@ static ajint stretcher_Align(const char *A,const char *B,
 	    if(d > c)
 		c = d;
 
-	    s = RR[j];
-	    RR[j] = c;
-	    SS[j] = d;
+	    s = h->RR[j];
+	    h->RR[j] = c;
+	    h->SS[j] = d;
         }
     }
-    SS[N] = RR[N];
+    h->SS[N] = h->RR[N];
 
-    midc = CC[0]+RR[0];			/* Find optimal midpoint */
+    midc = h->CC[0]+h->RR[0];			/* Find optimal midpoint */
     midj = 0;
     type = 1;
     for(j = 0; j <= N; j++)
-	if((c = CC[j] + RR[j]) >= midc)
-	    if(c > midc || (CC[j] != DD[j] && RR[j] == SS[j]))
+	if((c = h->CC[j] + h->RR[j]) >= midc)
+	    if(c > midc || (h->CC[j] != h->DD[j] && h->RR[j] == h->SS[j]))
 	    {
 		midc = c;
 		midj = j;
 	    }
 
     for(j = N; j >= 0; j--)
-	if((c = DD[j] + SS[j] + g) > midc)
+	if((c = h->DD[j] + h->SS[j] + h->g) > midc)
 	{
 	    midc = c;
 	    midj = j;
@@ -513,15 +613,14 @@ static ajint stretcher_Align(const char *A,const char *B,
 
     if(type == 1)
     {
-	c1 = stretcher_Align(A,B,midi,midj,tb,-g);
-	c2 = stretcher_Align(A+midi,B+midj,M-midi,N-midj,-g,te);
-	ajDebug("c1=%d, c2 = %d\n",c1,c2);
+	stretcher_Align(h,A,B,midi,midj,tb,-h->g);
+	stretcher_Align(h,A+midi,B+midj,M-midi,N-midj,-h->g,te);
     }
     else
     {
-	stretcher_Align(A,B,midi-1,midj,tb,0);
-	STRETCHERDEL(2);
-	stretcher_Align(A+midi+1,B+midj,M-midi-1,N-midj,0,te);
+	stretcher_Align(h,A,B,midi-1,midj,tb,0);
+	STRETCHERDEL(h,2);
+	stretcher_Align(h,A+midi+1,B+midj,M-midi-1,N-midj,0,te);
     }
 
     return midc;
@@ -532,17 +631,23 @@ static ajint stretcher_Align(const char *A,const char *B,
 
 /* @funcstatic stretcher_Calcons **********************************************
 **
-** Undocumented
+** Writes the aligned sequences using the edit script
 **
-** @param [r] n0 [ajint] Undocumented
-** @param [r] n1 [ajint] Undocumented
-** @param [r] res [const ajint*] Undocumented
-** @return [ajint] Undocumented
+** @param [r] h [const StretcherPAligner] Alignment handle
+** @param [r] n0 [ajint] Length of sequence A
+** @param [r] n1 [ajint] Length of sequence B
+** @param [r] res [const ajint*] Edit script
+** @param [w] seqc0 [char*] Aligned sequence A
+** @param [w] seqc1 [char*] Aligned sequence B
+** @return [ajint] Alignment length
 ******************************************************************************/
 
-static ajint stretcher_Calcons(ajint n0,
+static ajint stretcher_Calcons(const StretcherPAligner h,
+			       ajint n0,
 			       ajint n1,
-			       const ajint *res)
+			       const ajint *res,
+			       char *seqc0,
+			       char *seqc1)
 {
     ajint i0;
     ajint i1;
@@ -554,31 +659,22 @@ static ajint stretcher_Calcons(ajint n0,
     const char *sq1;
     const char *sq2;
 
-    int min0;
-    int min1;
-    int max0;
-    int max1;
-
     sp0 = seqc0;
     sp1 = seqc1;
     rp  = res;
-    nc = nd = i0 = i1 = op = 0;
-    min0 = min1 = 0;
+    nc = i0 = i1 = op = 0;
 
-    sq1 = ajStrGetPtr(ajSeqGetSeqS(glseq0));
-    sq2 = ajStrGetPtr(ajSeqGetSeqS(glseq1));
+    sq1 = h->seq0;
+    sq2 = h->seq1;
 
     while(i0 < n0 || i1 < n1)
     {
 	if(op == 0 && *rp == 0)
 	{
 	    op = *rp++;
-	    *sp0 = sq1[i0++];
-	    *sp1 = sq2[i1++];
+	    *sp0++ = sq1[i0++];
+	    *sp1++ = sq2[i1++];
 	    nc++;
-
-	    if(*sp0++ == *sp1++)
-		nd++;
 	}
 	else
 	{
@@ -602,10 +698,6 @@ static ajint stretcher_Calcons(ajint n0,
 	}
     }
 
-    max0 = max1 = nc;
-    ajDebug("calcons donenc %d min0 %d min1 %d  max0 %d max1 %d\n",
-	     nc, min0, min1, max0, max1);
-
     return nc;
 }
 
@@ -616,44 +708,46 @@ static ajint stretcher_Calcons(ajint n0,
 **
 ** return the score of the alignment stored in S
 **
+** @param [r] h [const StretcherPAligner] Alignment handle
 ** @param [r] A [const unsigned char*] Undocumented
 ** @param [r] B [const unsigned char*] Undocumented
-** @param [r] seq0 [const AjPSeq] Sequence A
-** @param [r] seq1 [const AjPSeq] Sequence B
+** @param [r] M [ajint] Length of sequence A
+** @param [r] N [ajint] Length of sequence B
 ** @param [w] S [ajint*] Undocumented
 ** @param [w] NC [ajint*] Alignment length returned
 ** @return [ajint] Undocumented
 ******************************************************************************/
 
-static ajint stretcher_CheckScore(const unsigned char *A,
+static ajint stretcher_CheckScore(const StretcherPAligner h,
+				  const unsigned char *A,
 				  const unsigned char *B,
-				  const AjPSeq seq0, const AjPSeq seq1,
+				  ajint M, ajint N,
                                   ajint *S,ajint *NC)
 {
-    register ajuint i;
-    register ajuint j;
+    register ajint i;
+    register ajint j;
     register ajint op;
     register ajint nc1;
     ajint score;
 
     score = i = j = op = nc1 = 0;
-    while(i < ajSeqGetLen(seq0) || j < ajSeqGetLen(seq1))
+    while(i < M || j < N)
     {
 	op = *S++;
 	if(op == 0)
 	{
-	    score = sub[A[++i]][B[++j]] + score;
+	    score = h->sub[A[++i]][B[++j]] + score;
 	    nc1++;
 	}
 	else if(op > 0)
 	{
-	    score = score - (g+op*hh);
+	    score = score - (h->g+op*h->hh);
 	    j = j+op;
 	    nc1 += op;
 	}
 	else
 	{
-	    score = score - (g-op*hh);
+	    score = score - (h->g-op*h->hh);
 	    i = i-op;
 	    nc1 -= op;
 	}
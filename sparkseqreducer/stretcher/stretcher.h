@@ -47,4 +47,11 @@
 /* =========================== public functions ============================ */
 /* ========================================================================= */
 
-const int stretcher(char *seqA, char *seqB, char *retSeqA, char *retSeqB, char *cmpMatFile);
\ No newline at end of file
+const int stretcher(char *seqA, char *seqB, char *retSeqA, char *retSeqB, char *cmpMatFile);
+
+void *stretcher_new(const char *cmpMatFile, int gapOpen, int gapExtend);
+
+int stretcher_align(void *handle, const char *seqA, const char *seqB,
+		    char *retSeqA, char *retSeqB);
+
+void stretcher_free(void *handle);
\ No newline at end of file
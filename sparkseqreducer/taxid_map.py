@@ -16,9 +16,15 @@
 import csv
 import sqlite3
 import gzip
+import multiprocessing
 import os
+import time
+from itertools import islice
 from sqlite3 import Error
 
+from sparkseqreducer.accession_index import open_accession_index
+from sparkseqreducer.profiler import profiled
+
 
 def create_connection(db_file):
     """ create a database connection to the SQLite database
@@ -82,39 +88,355 @@ def create_accession2taxid_db(conn, filepath):
         return 0
 
 
+def _parse_accession2taxid(filepath, skip, batch_size, queue):
+    # runs in a separate process, decompresses and parses the file and sends batches of rows to the loader
+    try:
+        with gzip.open(filepath, "rt") as f:
+            next(f)  # skip the header line
+            for _ in islice(f, skip):
+                pass
+            batch = []
+            for line in f:
+                fields = line.split("\t")
+                batch.append((fields[1], int(fields[2])))
+                if len(batch) >= batch_size:
+                    queue.put(batch)
+                    batch = []
+            if batch:
+                queue.put(batch)
+    finally:
+        queue.put(None)
+
+
+def bulk_create_accession2taxid_db(conn, filepath, batch_size=100000, resume=False, commit_every=10):
+    """ create a compact table keyed by accession_version and fill it using a compressed file,
+        the file is decompressed and parsed by a separate process while this one inserts the rows
+        :param conn: Connection object
+        :param filepath: the path to the compressed file
+        :param batch_size: the number of rows inserted per executemany call
+        :param resume: continue a previous interrupted load instead of starting over
+        :param commit_every: the number of batches per transaction, progress is saved at every commit
+        :return: 0 on success, -1 on error
+        """
+    sql_create_map_table = """ CREATE TABLE IF NOT EXISTS accession_taxid_map (
+                                    accession_version TEXT PRIMARY KEY,
+                                    taxid INTEGER) WITHOUT ROWID; """
+    sql_create_progress_table = """ CREATE TABLE IF NOT EXISTS load_progress (
+                                        id INTEGER PRIMARY KEY CHECK (id = 0),
+                                        rows INTEGER,
+                                        done INTEGER); """
+    # rows inserted after the last saved progress are inserted again when resuming
+    sql_insert_rows = "INSERT OR IGNORE INTO accession_taxid_map VALUES (?, ?);"
+    sql_save_progress = "INSERT OR REPLACE INTO load_progress VALUES (0, ?, ?);"
+    try:
+        c = conn.cursor()
+        c.execute("PRAGMA journal_mode = OFF;")
+        c.execute("PRAGMA synchronous = OFF;")
+        c.execute("PRAGMA cache_size = -1048576;")  # 1 GiB
+        c.execute("PRAGMA temp_store = MEMORY;")
+        if resume:
+            # without a journal a load that crashed in a transaction can leave the database corrupt
+            try:
+                problems = [row[0] for row in c.execute("PRAGMA quick_check;").fetchall() if row[0] != "ok"]
+            except Error as e:
+                problems = [str(e)]
+            if problems:
+                print("The database failed the integrity check and can not be resumed:", "; ".join(problems[:5]))
+                return -1
+        else:
+            c.execute("DROP TABLE IF EXISTS accession_taxid_map;")
+            c.execute("DROP TABLE IF EXISTS load_progress;")
+        c.execute(sql_create_map_table)
+        c.execute(sql_create_progress_table)
+        conn.commit()
+
+        c.execute("SELECT rows, done FROM load_progress WHERE id = 0;")
+        progress = c.fetchone()
+        loaded, done = progress if progress else (0, 0)
+        if done:
+            print("The database has already been loaded with", loaded, "rows")
+            return 0
+        if loaded:
+            print("Resuming after", loaded, "rows")
+    except Error as e:
+        print(e)
+        return -1
+
+    queue = multiprocessing.Queue(maxsize=8)
+    parser = multiprocessing.Process(target=_parse_accession2taxid, args=(filepath, loaded, batch_size, queue))
+    parser.daemon = True
+    parser.start()
+    start = time.time()
+    start_rows = loaded
+    n_batches = 0
+    try:
+        while True:
+            batch = queue.get()
+            if batch is None:
+                break
+            c.executemany(sql_insert_rows, batch)
+            loaded += len(batch)
+            n_batches += 1
+            if n_batches % commit_every == 0:
+                c.execute(sql_save_progress, (loaded, 0))
+                conn.commit()
+                print(loaded, "rows loaded,", int((loaded - start_rows) / max(time.time() - start, 1e-6)), "rows/s")
+        parser.join()
+        if parser.exitcode != 0:
+            print("The accession2taxid file could not be parsed")
+            c.execute(sql_save_progress, (loaded, 0))
+            conn.commit()
+            return -1
+        c.execute(sql_save_progress, (loaded, 1))
+        conn.commit()
+        print(loaded, "rows loaded in", int(time.time() - start), "s")
+    except Error as e:
+        print(e)
+        return -1
+    finally:
+        if parser.is_alive():
+            parser.terminate()
+    return 0
+
+
+def default_db_path():
+    return os.path.join(os.path.dirname(__file__), "../data", "gb.db")
+
+
+def default_index_path():
+    return os.path.join(os.path.dirname(__file__), "../data", "gb.idx")
+
+
+def create_readonly_connection(db_file):
+    """ create a read-only database connection to the SQLite database
+        specified by db_file, a missing file is not created
+    :param db_file: database file
+    :return: Connection object or None
+    """
+    conn = None
+    try:
+        conn = sqlite3.connect("file:" + os.path.abspath(db_file) + "?mode=ro", uri=True)
+    except Error as e:
+        print(e)
+
+    return conn
+
+
 def get_taxid_from_accession_db(accession):
+    conn = None
     try:
         # (the db needs to be manually replicated to all worker nodes)
         # The db needs to be indexed for best performance
-        conn = create_connection(os.path.join(os.path.dirname(__file__), "../data", "gb.db"))
+        conn = create_connection(default_db_path())
         c = conn.cursor()
-        c.execute("""SELECT * from accession_taxid_map where accession_version = '""" + str(accession) + """'""")
+        c.execute("SELECT taxid FROM accession_taxid_map WHERE accession_version = ?", (str(accession),))
         rows = c.fetchall()
         for row in rows:
-            return row[2]
+            return row[0]
     except Error as e:
         print(e)
         return -1
     finally:
-        conn.close()
+        if conn is not None:
+            conn.close()
     return 0
 
 
-def map_accession_to_taxid(seq_rdd):
+def get_taxids_from_accessions_db(conn, accessions, batch_size=500):
+    """ look up the taxids of many accessions using batched parameterized queries
+        :param conn: Connection object
+        :param accessions: the accession.version strings to look up
+        :param batch_size: the number of accessions per query, must stay below the sqlite variable limit
+        :return: a dictionary accession_version -> taxid, accessions not found are left out
+        """
+    accessions = list(set(accessions))
+    taxids = {}
+    c = conn.cursor()
+    for i in range(0, len(accessions), batch_size):
+        batch = accessions[i:i + batch_size]
+        sql = "SELECT accession_version, taxid FROM accession_taxid_map WHERE accession_version IN (" + \
+              ",".join("?" * len(batch)) + ")"
+        c.execute(sql, batch)
+        taxids.update(c.fetchall())
+    return taxids
+
+
+def _map_partition(index, records, lookup_batch, batch_size, hits, misses):
+    # map the records of a partition in batches using lookup_batch(accessions) -> {accession: taxid},
+    # the lookups are counted per batch so a partially consumed partition is counted too
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        taxids = lookup_batch([x[0] for x in batch])
+        n_hits = sum(1 for x in batch if taxids.get(x[0]) is not None)
+        if hits is not None:
+            hits.add(n_hits)
+        if misses is not None:
+            misses.add(len(batch) - n_hits)
+        for accession, (header, sequence) in batch:
+            yield accession, [str(taxids.get(accession)), header, sequence]
+
+
+def map_partition_accession_to_taxid(index, records, db_file, batch_size=500, hits=None, misses=None, profile=None):
+    """ map the records of a single partition to their taxids using one connection per partition
+        :param index: the partition index of mapPartitionsWithIndex
+        :param records: an iterator of (accession_version, [header, sequence])
+        :param db_file: the path to the accession to taxid database
+        :param batch_size: the number of accessions per query
+        :param hits: optional spark accumulator counting the mapped sequences
+        :param misses: optional spark accumulator counting the sequences without a taxid
+        :param profile: optional profile created by profiler.create_profile, every batch is a call
+        :return: a generator of (accession_version, [tax_id, header, sequence]), tax_id is "None" when not found
+        """
+    conn = create_readonly_connection(db_file)
+
+    def lookup_batch(accessions):
+        if conn is None:
+            return {}
+        try:
+            return get_taxids_from_accessions_db(conn, accessions, batch_size)
+        except Error as e:
+            print(e)
+            return {}
+
+    try:
+        for record in _map_partition(index, records, profiled(profile, "taxid_lookup", lookup_batch), batch_size,
+                                     hits, misses):
+            yield record
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def map_partition_accession_to_taxid_index(index, records, index_file, batch_size=10000, hits=None, misses=None,
+                                           profile=None):
+    """ map the records of a single partition to their taxids using a memory mapped accession index
+        :param index: the partition index of mapPartitionsWithIndex
+        :param records: an iterator of (accession_version, [header, sequence])
+        :param index_file: the path to the accession index file
+        :param batch_size: the number of accessions per vectorized lookup
+        :param hits: optional spark accumulator counting the mapped sequences
+        :param misses: optional spark accumulator counting the sequences without a taxid
+        :param profile: optional profile created by profiler.create_profile, every batch is a call
+        :return: a generator of (accession_version, [tax_id, header, sequence]), tax_id is "None" when not found
+        """
+    accession_index = open_accession_index(index_file)
+
+    def lookup_batch(accessions):
+        taxids = accession_index.lookup_batch(accessions)
+        return dict((a, t) for a, t in zip(accessions, taxids.tolist()) if t >= 0)
+
+    return _map_partition(index, records, profiled(profile, "taxid_lookup", lookup_batch), batch_size, hits, misses)
+
+
+def map_accession_to_taxid(seq_rdd, db_file=None, batch_size=500, hits=None, misses=None, index_file=None,
+                           profile=None):
     """ create a rdd that contains the taxonomy id of the sequence as part of his value
                     :param seq_rdd: the rdd((key=accession_version, v=[header, sequence]))
+                    :param db_file: the path to the accession to taxid database, data/gb.db by default
+                    :param batch_size: the number of accessions looked up per query
+                    :param hits: optional spark accumulator counting the mapped sequences
+                    :param misses: optional spark accumulator counting the sequences without a taxid
+                    :param index_file: the path to an accession index, data/gb.idx by default,
+                     used instead of the database when the file exists
+                    :param profile: optional profile created by profiler.create_profile to time the lookups
                     :return: seq_rdd: a rdd((key=accession_version, v=[tax_id, header, sequence]))
             """
-    # Use the given key=accession.version to map a TaxID using a locally stored database
-    return seq_rdd.map(lambda x: (x[0], [str(get_taxid_from_accession_db(x[0])), x[1][0], x[1][1]]))
+    if index_file is None:
+        index_file = default_index_path()
+    if os.path.isfile(index_file):
+        # The memory mapped index is faster and smaller than the database, use it when available
+        return seq_rdd.mapPartitionsWithIndex(
+            lambda index, records: map_partition_accession_to_taxid_index(index, records, index_file,
+                                                                          max(batch_size, 10000), hits, misses,
+                                                                          profile))
+    if db_file is None:
+        db_file = default_db_path()
+    # Use the given key=accession.version to map a TaxID using a locally stored database,
+    # every partition opens a single connection and looks up its accessions in batches
+    return seq_rdd.mapPartitionsWithIndex(
+        lambda index, records: map_partition_accession_to_taxid(index, records, db_file, batch_size, hits, misses,
+                                                                profile))
+
 
+def accession2taxid_to_parquet(spark, filepath, parquet_dir, n_partitions=200):
+    """ write the accession to taxid table to shared storage as a parquet dataset partitioned by accession,
+        the dataset is read by the workers at run time so no database has to be replicated to them
+        :param spark: the spark session
+        :param filepath: the path to the compressed accession2taxid file
+        :param parquet_dir: the path of the parquet dataset to create
+        :param n_partitions: the number of files of the dataset
+        :return:
+        """
+    from pyspark.sql import functions as F
+
+    table = spark.read.csv(filepath, sep="\t", header=True)
+    table = table.select(F.col("`accession.version`").alias("accession_version"),
+                         F.col("taxid").cast("int").alias("taxid"))
+    table.repartition(n_partitions, "accession_version") \
+        .sortWithinPartitions("accession_version") \
+        .write.mode("overwrite").parquet(parquet_dir)
 
-def join_map_accession_to_taxid(seq_rdd,  taxid_rdd):
+
+def join_map_accession_to_taxid(seq_rdd, taxid_rdd, hits=None, misses=None):
+    """ map the sequences to their taxids with a shuffle join against a rdd of taxids
+        :param seq_rdd: the rdd((key=accession_version, v=[header, sequence]))
+        :param taxid_rdd: a rdd((key=accession_version, v=tax_id))
+        :param hits: optional spark accumulator counting the mapped sequences
+        :param misses: optional spark accumulator counting the sequences without a taxid
+        :return: a rdd((key=accession_version, v=[tax_id, header, sequence])), tax_id is "None" when not found
+        """
     # Join seq_rdd with a rdd that contains all TaxIDs using accession number.
-    # This function works better when using multiple nodes and when you can use a broadcasted join (more memory usage)
-    mapped_rdd = seq_rdd.join(taxid_rdd)
+    mapped_rdd = seq_rdd.leftOuterJoin(taxid_rdd)
+
+    return mapped_rdd.map(lambda x: (x[0], [_count_lookup(x[1][1], hits, misses), x[1][0][0], x[1][0][1]]))
+
+
+def table_map_accession_to_taxid(seq_rdd, spark, parquet_dir, n_accessions=None, broadcast_threshold=2000000,
+                                 hits=None, misses=None):
+    """ map the sequences to their taxids using the parquet accession to taxid table from shared storage
+        :param seq_rdd: the rdd((key=accession_version, v=[header, sequence]))
+        :param spark: the spark session
+        :param parquet_dir: the path of the parquet dataset created by accession2taxid_to_parquet
+        :param n_accessions: the number of sequences in seq_rdd if already known
+        :param broadcast_threshold: inputs with at most this many sequences use broadcast joins,
+         larger inputs are shuffle joined
+        :param hits: optional spark accumulator counting the mapped sequences
+        :param misses: optional spark accumulator counting the sequences without a taxid
+        :return: a rdd((key=accession_version, v=[tax_id, header, sequence])), tax_id is "None" when not found
+        """
+    from pyspark.sql import functions as F
+
+    if n_accessions is None:
+        n_accessions = seq_rdd.count()
+    broadcast = n_accessions <= broadcast_threshold
+
+    # Keep only the part of the table with accessions present in the input (semi-join),
+    # the accessions of a small input are broadcast so the table is never shuffled
+    accessions_df = spark.createDataFrame(seq_rdd.map(lambda x: (x[0],)), "accession_version string")
+    taxid_table = spark.read.parquet(parquet_dir)
+    filtered = taxid_table.join(F.broadcast(accessions_df) if broadcast else accessions_df,
+                                "accession_version", "left_semi")
+    taxid_rdd = filtered.rdd.map(lambda row: (row[0], row[1]))
+
+    if not broadcast:
+        return join_map_accession_to_taxid(seq_rdd, taxid_rdd, hits, misses)
+
+    # Broadcast hash join, the filtered table has at most one row per input sequence
+    taxids_bc = spark.sparkContext.broadcast(dict(taxid_rdd.collect()))
+    return seq_rdd.map(lambda x: (x[0], [_count_lookup(taxids_bc.value.get(x[0]), hits, misses),
+                                         x[1][0], x[1][1]]))
+
 
-    return mapped_rdd
+def _count_lookup(taxid, hits, misses):
+    # returns the taxid as a string and updates the hit/miss accumulators
+    if taxid is None:
+        if misses is not None:
+            misses.add(1)
+    elif hits is not None:
+        hits.add(1)
+    return str(taxid)
 
 
 def count_none_mapppings(mapped_seq_rdd):
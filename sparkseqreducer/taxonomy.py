@@ -0,0 +1,159 @@
+#     taxonomy: A compact array based representation of the NCBI taxonomy tree
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import argparse
+import os
+
+import numpy as np
+
+standard_ranks = ['species', 'genus', 'family', 'order', 'class', 'phylum', 'superkingdom', 'no rank']
+
+_MISSING = 255  # rank code of taxids that are not in the tree
+
+# the arrays of the taxonomy cache, one uncompressed .npy file each so they can be memory mapped
+_arrays = ["parents", "ranks", "name_offsets", "names", "rank_names"]
+
+
+class TaxonomyTree(object):
+    """ The taxonomy tree stored as parallel arrays indexed by taxid:
+    the parent taxid (-1 for the root), a rank code and the offset of the
+    scientific name in a single utf-8 blob
+    """
+
+    def __init__(self, parents, ranks, name_offsets, names, rank_names):
+        self.parents = parents
+        self.ranks = ranks
+        self.name_offsets = name_offsets
+        self.names = names
+        self.rank_names = [str(r) for r in rank_names]
+
+    def __contains__(self, taxid):
+        return 0 <= taxid < len(self.ranks) and self.ranks[taxid] != _MISSING
+
+    def get_name(self, taxid):
+        return self.names[self.name_offsets[taxid]:self.name_offsets[taxid + 1]].tobytes().decode("utf-8")
+
+    def get_rank(self, taxid):
+        return self.rank_names[self.ranks[taxid]]
+
+    def get_lineage(self, taxid, only_std_ranks=True):
+        """ get the ascendants of a taxid with their ranks and names, same result as
+        phylogenetic_map.get_ascendants_with_ranks_and_names
+        :param taxid: the taxid of the sequence
+        :param only_std_ranks: keep only the standard ranks
+        :return: a dictionary rank -> (taxid, name) or {"unknown": (taxid, "unknown")}
+        """
+        taxid = int(taxid)
+        if taxid not in self:
+            return {"unknown": (taxid, "unknown")}
+        lineage = {}
+        while taxid >= 0:
+            if self.ranks[taxid] == _MISSING:  # broken tree, the parent is not in nodes.dmp
+                return {"unknown": (taxid, "unknown")}
+            rank = self.rank_names[self.ranks[taxid]]
+            if not only_std_ranks or rank in standard_ranks:
+                lineage[rank] = (taxid, self.get_name(taxid))
+            taxid = int(self.parents[taxid])
+        return lineage
+
+    def get_rank_taxids(self, taxid, ranks):
+        """ project a taxid to its ascendants of the given ranks
+        :param taxid: the taxid of the sequence
+        :param ranks: a list of ranks
+        :return: a tuple with the taxid of each rank, -1 when the lineage has no taxid of that rank
+        """
+        taxid = int(taxid)
+        rank_taxids = [-1] * len(ranks)
+        if taxid not in self:
+            return tuple(rank_taxids)
+        positions = dict((rank, i) for i, rank in enumerate(ranks))
+        while taxid >= 0:
+            if self.ranks[taxid] == _MISSING:  # broken tree, the parent is not in nodes.dmp
+                return tuple([-1] * len(ranks))
+            position = positions.get(self.rank_names[self.ranks[taxid]])
+            if position is not None:
+                rank_taxids[position] = taxid
+            taxid = int(self.parents[taxid])
+        return tuple(rank_taxids)
+
+    def save(self, directory):
+        """ save the tree to a directory with a .npy file per array
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in _arrays:
+            value = np.array(self.rank_names) if name == "rank_names" else getattr(self, name)
+            np.save(os.path.join(directory, name + ".npy"), value)
+
+
+def build_taxonomy(nodes_filename, names_filename):
+    """ Builds a TaxonomyTree from NCBI taxonomy nodes.dmp and names.dmp files
+    """
+    taxid2name = {}
+    with open(names_filename) as names_file:
+        for line in names_file:
+            line = line.split('|')
+            if line[3] == "\tscientific name\t":
+                taxid2name[int(line[0].strip('\t'))] = line[1][1:-1].strip('\t')
+
+    taxids = []
+    parent_taxids = []
+    node_ranks = []
+    rank_codes = {}
+    with open(nodes_filename) as nodes_file:
+        for line in nodes_file:
+            line = line.split('|')[:3]
+            taxids.append(int(line[0].strip('\t')))
+            parent_taxids.append(int(line[1].strip('\t')))
+            node_ranks.append(rank_codes.setdefault(line[2][1:-1].strip('\t'), len(rank_codes)))
+
+    size = max(taxids) + 1
+    taxids = np.array(taxids, dtype=np.int64)
+    parents = np.full(size, -1, dtype=np.int32)
+    parents[taxids] = parent_taxids
+    parents[parents == np.arange(size)] = -1  # the root is its own parent in nodes.dmp
+    ranks = np.full(size, _MISSING, dtype=np.uint8)
+    ranks[taxids] = node_ranks
+
+    encoded = [taxid2name.get(taxid, "").encode("utf-8") if ranks[taxid] != _MISSING else b""
+               for taxid in range(size)]
+    name_offsets = np.zeros(size + 1, dtype=np.int64)
+    np.cumsum([len(name) for name in encoded], out=name_offsets[1:])
+    names = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+
+    rank_names = sorted(rank_codes, key=rank_codes.get)
+    return TaxonomyTree(parents, ranks, name_offsets, names, rank_names)
+
+
+def is_taxonomy(directory):
+    # the directory holds a taxonomy cache saved with TaxonomyTree.save
+    return all(os.path.isfile(os.path.join(directory, name + ".npy")) for name in _arrays)
+
+
+def load_taxonomy(directory):
+    """ load a TaxonomyTree saved with TaxonomyTree.save, the arrays are memory mapped so the pages
+        are only read when they are used and are shared by the processes of a worker
+    """
+    return TaxonomyTree(*[np.load(os.path.join(directory, name + ".npy"), mmap_mode="r") for name in _arrays])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create the taxonomy cache file.")
+    parser.add_argument("nodes", help="Path to nodes.dmp")
+    parser.add_argument("names", help="Path to names.dmp")
+    parser.add_argument("outfile", help="Path to the taxonomy cache directory to create (data/taxonomy)")
+    args = parser.parse_args()
+    build_taxonomy(args.nodes, args.names).save(args.outfile)
+    print("The taxonomy cache has been created")
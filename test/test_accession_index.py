@@ -0,0 +1,49 @@
+#     test_accession_index: Test code for the memory mapped accession index
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import gzip
+import os
+import random
+import tempfile
+
+from sparkseqreducer import accession_index, taxid_map
+
+
+def write_accession2taxid(path, rows):
+    with gzip.open(path, "wt") as f:
+        f.write("accession\taccession.version\ttaxid\tgi\n")
+        for accession, taxid in rows:
+            f.write("%s\t%s\t%d\t0\n" % (accession.split(".")[0], accession, taxid))
+
+
+def test_build_and_lookup():
+    rows = [("AB%06d.%d" % (i, i % 3 + 1), i * 7) for i in range(5000)] + [("NZ_CP012345678.1", 562)]
+    random.Random(1).shuffle(rows)
+    with tempfile.TemporaryDirectory() as tmp:
+        gz_file = os.path.join(tmp, "nucl_gb.accession2taxid.gz")
+        index_file = os.path.join(tmp, "gb.idx")
+        write_accession2taxid(gz_file, rows)
+        assert accession_index.build_accession_index(gz_file, index_file, chunk_bytes=20000) == len(rows)
+
+        index = accession_index.AccessionIndex(index_file)
+        assert index.lookup("AB000010.2") == 70
+        assert index.lookup("NZ_CP012345678.1") == 562
+        assert index.lookup("AB000010.1") is None
+        assert index.lookup("AB000010.2X_TOO_LONG_FOR_THE_INDEX") is None
+        assert index.lookup_batch(["AB000011.3", "missing", "AB000000.1"]).tolist() == [77, -1, 0]
+
+        records = [("AB000012.1", [">AB000012.1", "ACGT"]), ("ZZ1.1", [">ZZ1.1", "AC"])]
+        mapped = list(taxid_map.map_partition_accession_to_taxid_index(0, iter(records), index_file))
+        assert mapped == [("AB000012.1", ["84", ">AB000012.1", "ACGT"]), ("ZZ1.1", ["None", ">ZZ1.1", "AC"])]
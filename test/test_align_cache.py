@@ -0,0 +1,70 @@
+#     test_align_cache: Test code for the alignment cache
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import pickle
+import random
+
+from sparkseqreducer import align_cache, reducer
+
+
+def test_transcript_round_trip():
+    assert align_cache.encode_transcript("ACG-TT", "A-GCTT") == b"1M1I1M1D2M"
+    assert align_cache.apply_transcript("ACGTT", "AGCTT", b"1M1I1M1D2M") == ("ACG-TT", "A-GCTT")
+    assert align_cache.encode_transcript("A-", "-A") == b"1I1D"
+    assert align_cache.encode_transcript("A-", "A-") is None
+    assert align_cache.encode_transcript("", "") == b""
+
+
+def test_cached_alignments(tmpdir):
+    rnd = random.Random(4)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(2000))
+    seq_b = seq_a[:700] + "".join(rnd.choice("ACGT") for _ in range(100)) + seq_a[900:1900]
+    calls = []
+
+    def align(a, b, cmp_mat_file, gap_open=16, gap_extend=4):
+        calls.append(1)
+        return reducer.aligners["stretcher"](a, b, cmp_mat_file, gap_open, gap_extend)
+
+    cache = pickle.loads(pickle.dumps(align_cache.AlignmentCache(str(tmpdir), check_every=1)))
+    expected = reducer.aligners["stretcher"](seq_a, seq_b, reducer._cmp_mat_file)
+    assert cache.align(seq_a, seq_b, align, "stretcher", reducer._cmp_mat_file) == expected
+    assert cache.align(seq_b, seq_a, align, "stretcher", reducer._cmp_mat_file) == expected
+    assert len(calls) == 1
+    # the penalties of the key are the ones the pair is aligned with
+    assert cache.align(seq_a, seq_b, align, "stretcher", reducer._cmp_mat_file, gap_open=10) == \
+        reducer.aligners["stretcher"](seq_a, seq_b, reducer._cmp_mat_file, gap_open=10)
+    assert len(calls) == 2
+
+    # every transcript is larger than the limit, the cache is emptied
+    cache.max_bytes = 1
+    cache.evict()
+    assert cache.get(cache.key(seq_a, seq_b, "stretcher", reducer._cmp_mat_file)) is None
+
+    sequences = reducer.align_reduce([(seq_a, ">a")], (seq_a, ">a"), (seq_b, ">b"), align_cache=cache)
+    assert sequences == reducer.align_reduce([(seq_a, ">a")], (seq_a, ">a"), (seq_b, ">b"))
+
+
+def test_failed_cache_is_skipped(tmpdir):
+    rnd = random.Random(6)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(500))
+    seq_b = seq_a[:200] + seq_a[260:]
+    directory = tmpdir.join("cache")
+    directory.mkdir()
+    # the database path is a directory, sqlite can not open it
+    directory.join("alignments.db").mkdir()
+    cache = align_cache.AlignmentCache(str(directory))
+    expected = reducer.aligners["stretcher"](seq_a, seq_b, reducer._cmp_mat_file)
+    assert cache.align(seq_a, seq_b, reducer.aligners["stretcher"], "stretcher", reducer._cmp_mat_file) == expected
+    assert cache.get(cache.key(seq_a, seq_b, "stretcher", reducer._cmp_mat_file)) is None
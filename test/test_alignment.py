@@ -24,4 +24,50 @@ SeqASmall = ""
 SeqBSmall = ""
 mat = os.path.abspath(os.path.join(os.path.dirname(__file__),"../data/EDNAFULL"))
 
-print(stretcher.align(SeqA, SeqB, mat))
\ No newline at end of file
+print(stretcher.align(SeqA, SeqB, mat))
+
+def test_aligner_handle():
+    aligner = stretcher.Aligner(mat)
+    assert aligner.align(SeqA, SeqB) == ("TAATGAAATATTCACGAA", "TAAT-AAATATTCAC-AA")
+    assert aligner.align(SeqB, SeqA) == stretcher.align(SeqA, SeqB, mat)
+    assert aligner.align("acgt", "") == ("ACGT", "----")
+    aligner.close()
+
+
+def test_anchor_align_contract():
+    import random
+    from sparkseqreducer import anchor_align
+    rnd = random.Random(1)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(3000))
+    seq_b = seq_a[:1000] + "TTGA" + seq_a[1000:1800] + seq_a[1850:]
+    aligned_a, aligned_b = anchor_align.align(seq_b, seq_a, mat)
+    assert len(aligned_a) == len(aligned_b)
+    assert aligned_a.replace("-", "") == seq_a and aligned_b.replace("-", "") == seq_b
+    assert anchor_align.align(SeqA, SeqB, mat) == stretcher.align(SeqA, SeqB, mat)
+
+
+def test_anchor_align_splits_large_gaps():
+    import random
+    from sparkseqreducer import anchor_align
+    rnd = random.Random(1)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(6000))
+    # a diverged middle without exact 21-mers, it is only anchored with smaller k-mers
+    middle = [c if i % 12 else {"A": "C", "C": "G", "G": "T", "T": "A"}[c] for i, c in enumerate(seq_a[1000:4000])]
+    seq_b = seq_a[:1000] + "".join(middle) + seq_a[4000:]
+    cells = []
+    align_gap = anchor_align._align_gap
+
+    def spy(aligner, gap_a, gap_b):
+        cells.append(len(gap_a) * len(gap_b))
+        return align_gap(aligner, gap_a, gap_b)
+
+    anchor_align._align_gap = spy
+    try:
+        aligned_a, aligned_b = anchor_align.align(seq_a, seq_b, mat, max_gap_cells=10000)
+        assert max(cells) <= 10000
+        assert aligned_a.replace("-", "") == seq_a and aligned_b.replace("-", "") == seq_b
+        cells[:] = []
+        anchor_align.align(seq_a, seq_b, mat, min_k=21)
+        assert max(cells) > 2900 * 2900
+    finally:
+        anchor_align._align_gap = align_gap
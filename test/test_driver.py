@@ -0,0 +1,34 @@
+#     test_driver: Test code for the command line of sparkseqreducer.py
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import importlib.util
+import os
+
+import pytest
+
+# the driver script has the name of the package, it is loaded from its path
+_spec = importlib.util.spec_from_file_location(
+    "sparkseqreducer_driver", os.path.join(os.path.dirname(__file__), "..", "sparkseqreducer.py"))
+driver = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(driver)
+
+
+def test_rank_arguments():
+    params = driver.get_params(["--rank", "species", "example.fasta", "output"])
+    assert (params["rank"], params["infile"], params["outfile"]) == (["species"], "example.fasta", "output")
+    assert driver.get_params(["example.fasta", "output"])["rank"] == ["species"]
+    assert driver.get_params(["-r", "genus,species", "example.fasta", "output"])["rank"] == ["genus", "species"]
+    with pytest.raises(SystemExit):
+        driver.get_params(["--rank", "species,strain", "example.fasta", "output"])
@@ -0,0 +1,86 @@
+#     test_incremental: Test code for the incremental reduction
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import pytest
+
+from sparkseqreducer import incremental
+from sparkseqreducer.sequence_io import format_reduced, parse_fasta_records
+
+params = {"rank": "species", "threshold": 0.95, "stride": 100, "aligner": "stretcher", "reduction": "combine",
+          "prefilter": False, "strand": False, "segment_threshold": 0, "segment_length": 100000, "packed": False,
+          "outfile": "out"}
+
+
+def test_manifest_and_plan(tmpdir):
+    members = [(9606, ("NC_1.1", "d1")), (9606, ("NC_2.1", "d2")), (562, ("NC_3.1", "d3"))]
+    manifest = incremental.build_manifest(members, {"9606": "NC_1.1", "562": "NC_3.1"}, params, "/out.fasta")
+    filename = str(tmpdir.join("out.manifest.json"))
+    incremental.write_manifest(manifest, filename)
+    assert incremental.read_manifest(filename, params) == manifest
+    for name, value in [("stride", 50), ("reduction", "fanout"), ("prefilter", True), ("strand", True)]:
+        with pytest.raises(ValueError):
+            incremental.read_manifest(filename, dict(params, **{name: value}))
+    del manifest["params"]["prefilter"]
+    incremental.write_manifest(manifest, filename)
+    with pytest.raises(ValueError):
+        incremental.read_manifest(filename, params)
+
+    known = incremental.known_accessions(manifest)
+    assert known == {"NC_1.1": (9606, "d1"), "NC_2.1": (9606, "d2"), "NC_3.1": (562, "d3")}
+    assert incremental.classify_member(9606, "NC_1.1", "d1", known) == []
+    assert incremental.classify_member(9606, "NC_4.1", "d4", known) == [(9606, "new")]
+    assert incremental.classify_member(9606, "NC_3.1", "d3", known) == [(9606, "changed"), (562, "changed")]
+
+    changes = [(9606, "new"), (10090, "new"), (1280, "changed")]
+    assert incremental.plan_groups(changes, [562], {9606, 562, 1280}) == ({562, 1280, 10090}, {9606})
+    assert incremental.plan_groups([(9606, "new"), (9606, "changed")], [], {9606}) == ({9606}, set())
+
+
+def test_reduced_headers_round_trip():
+    seqs = [("ACGT", ">NC_1.1 Homo sapiens, chromosome 1"), ("GG", ">NC_2.1 b"), ("TT", ">NC_2.1 b")]
+    records = format_reduced(9606, seqs).split("\n>")
+    parsed = [incremental.parse_reduced_header(header) + (seq,)
+              for accession, (header, seq) in parse_fasta_records(records)]
+    assert parsed == [(">NC_1.1 Homo sapiens, chromosome 1", 0, "ACGT"), (">NC_2.1 b", 1, "GG"),
+                      (">NC_2.1 b", 2, "TT")]
+
+    def merge_sequence(sequences, seq):
+        return sequences + [seq]
+    assert incremental.fold_new_sequences(seqs[:1], [("C", ">z"), ("A", ">y")], merge_sequence) == \
+        [seqs[0], ("A", ">y"), ("C", ">z")]
+
+
+def test_fold_matches_a_full_reduction_with_the_prefilter():
+    import random
+    from functools import partial
+    from sparkseqreducer import local_engine, reducer
+    rnd = random.Random(17)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(3000))
+    previous = [(seq_a, ">a"), (seq_a[200:1200] + "".join(rnd.choice("ACGT") for _ in range(300)), ">b")]
+    # a contained sequence, a duplicate of it and a sequence with a novel region
+    new = [(seq_a[:1500] + "".join(rnd.choice("ACGT") for _ in range(200)), ">e"), (seq_a[500:2500], ">c"),
+           (seq_a[500:2500], ">d")]
+    context = local_engine.LocalContext(1)
+
+    full_stats = reducer.create_prefilter_stats(context)
+    _, full, _, _ = local_engine.reduce_group(1, previous + sorted(new, key=lambda s: s[1]), "species",
+                                              prefilter=full_stats)
+    stats = reducer.create_prefilter_stats(context)
+    _, reduced, _, _ = local_engine.reduce_group(1, previous, "species", prefilter=stats)
+    merge_sequence = partial(reducer.pairwise_reduction_merge_sequence, prefilter=stats)
+    assert incremental.fold_new_sequences(reduced[0], new, merge_sequence) == full[0]
+    # the duplicate of a new sequence is only contained in the group it is folded into
+    assert stats["aligned"].value == full_stats["aligned"].value == 2
+    assert stats["contained"].value == full_stats["contained"].value + full_stats["duplicate"].value == 2
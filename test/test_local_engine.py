@@ -0,0 +1,139 @@
+#     test_local_engine: Test code for the local execution engine
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import gzip
+import os
+import pickle
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+from sparkseqreducer import local_engine, reducer
+from sparkseqreducer.partitioner import DictAccumulatorParam
+
+
+def random_sequence(rnd, length):
+    return "".join(rnd.choice("ACGT") for _ in range(length))
+
+
+def test_read_fasta(tmpdir):
+    text = ">A1.1 first\nacgt\nACGT\n>B2.1 second\nGG\n"
+    plain = os.path.join(str(tmpdir), "in.fasta")
+    with open(plain, "w") as f:
+        f.write(text)
+    with gzip.open(plain + ".gz", "wt") as f:
+        f.write(text)
+    expected = [("A1.1", [">A1.1 first", "ACGTACGT"]), ("B2.1", [">B2.1 second", "GG"])]
+    assert list(local_engine.read_fasta(plain)) == expected
+    assert list(local_engine.read_fasta(plain + ".gz")) == expected
+
+
+def test_accumulators_start_from_zero_in_workers():
+    context = local_engine.LocalContext(2)
+    counter = context.accumulator(0)
+    counts = context.accumulator({}, DictAccumulatorParam())
+    counter.add(3)
+    counts.add({"a": 1})
+    assert pickle.loads(pickle.dumps(counter)).value == 0
+    assert pickle.loads(pickle.dumps(counts)).value == {}
+    local_engine.add_accumulator_values({"counter": counter}, {"counter": 2})
+    assert counter.value == 5
+
+
+def test_reduce_groups_is_independent_of_the_workers():
+    rnd = random.Random(5)
+    groups = {}
+    for taxid in range(4):
+        base = random_sequence(rnd, 600)
+        groups[(taxid, 100)] = [(base, ">s%d_0" % taxid)] + \
+            [(base[:300] + random_sequence(rnd, 100) + base[400:550], ">s%d_%d" % (taxid, i)) for i in range(1, 3)]
+    context = local_engine.LocalContext(2)
+    for reduction in ["combine", "fanout", "cluster"]:
+        inline_prefilter = reducer.create_prefilter_stats(context)
+        inline = list(local_engine.reduce_groups(groups, "species", None, prefilter=inline_prefilter,
+                                                 reduction=reduction))
+        pool_prefilter = reducer.create_prefilter_stats(context)
+        with ProcessPoolExecutor(2) as executor:
+            pooled = list(local_engine.reduce_groups(groups, "species", executor, prefilter=pool_prefilter,
+                                                     reduction=reduction))
+        assert inline == pooled
+        assert [key for key, _ in inline] == sorted(groups)
+        assert local_engine.accumulator_values(inline_prefilter) == local_engine.accumulator_values(pool_prefilter)
+        for key, seqs in inline:
+            assert seqs[0] == groups[key][0]
+            assert all(len(seq) < 600 for seq, _ in seqs[1:])
+
+    levels = [(rank, list(reduced)) for rank, reduced in local_engine.local_hierarchical_reduce(
+        [(key, [str(key[0]), header, seq]) for key, values in groups.items() for seq, header in values],
+        ["species", "genus"])]
+    assert [rank for rank, _ in levels] == ["species", "genus"]
+    assert [taxid for taxid, _ in levels[1][1]] == [100]
+    # the next rank is complete even if the groups of a rank are not read
+    for rank, reduced in local_engine.local_hierarchical_reduce(
+            [(key, [str(key[0]), header, seq]) for key, values in groups.items() for seq, header in values],
+            ["species", "genus"]):
+        if rank == "genus":
+            assert list(reduced) == levels[1][1]
+
+
+def test_cluster_reduction_writes_a_group_per_centroid():
+    rnd = random.Random(9)
+    first, second = random_sequence(rnd, 3000), random_sequence(rnd, 2500)
+    groups = {(1, 100): [(first, ">a"), (second, ">b"), (first[:1500] + random_sequence(rnd, 50), ">c")]}
+    reduced = list(local_engine.reduce_groups(groups, "species", None, reduction="cluster"))
+    assert [key for key, _ in reduced] == [(1, 100), (1, 100)]
+    assert [seqs[0] for _, seqs in reduced] == [(first, ">a"), (second, ">b")]
+    assert [header for _, header in reduced[0][1][1:]] == [">c"] and len(reduced[1][1]) == 1
+
+
+def test_groups_are_counted_per_rank():
+    from sparkseqreducer.pipeline import create_pipeline_stats, format_stats
+    stats = create_pipeline_stats(local_engine.LocalContext(1), ["species", "genus"])
+    stats["groups"]["species"].add(5)
+    stats["groups"]["genus"].add(2)
+    assert format_stats(stats).split("\n")[-2:] == ["The sequences have been reduced to 5 species ranks",
+                                                    "The sequences have been reduced to 2 genus ranks"]
+
+
+def test_groups_are_folded_in_input_order():
+    rnd = random.Random(21)
+    base = random_sequence(rnd, 1500)
+    # the longest sequence arrives last and becomes the representative of the folded regions
+    values = [(base[:700] + random_sequence(rnd, 150), ">a"), (base[400:1200] + random_sequence(rnd, 100), ">b"),
+              (base, ">c")]
+    sequences = reducer.seq_to_list(values[0])
+    for value in values[1:]:
+        sequences = reducer.pairwise_reduction_merge_sequence(sequences, value)
+    assert local_engine.reduce_group((1, 100), values, "species")[1] == [sequences]
+    assert local_engine.reduce_group((1, 100), values[::-1], "species")[1] != [sequences]
+
+
+def test_large_ranks_are_spilled_to_buckets(tmpdir):
+    rnd = random.Random(23)
+    records = []
+    for taxid in range(12):
+        base = random_sequence(rnd, 400)
+        records.extend(((taxid, 100 + taxid), [str(taxid), ">s%d_%d" % (taxid, i), base[:300 + 50 * i]])
+                       for i in range(3))
+    records.append(((-1, 200), ["99", ">u", random_sequence(rnd, 200)]))
+
+    def reduce_levels(**options):
+        return [(rank, sorted(reduced)) for rank, reduced in
+                local_engine.local_hierarchical_reduce(iter(records), ["species", "genus"], **options)]
+
+    # a genus has a single species, the sequences of a group arrive in the same order from the buckets
+    spilled = reduce_levels(memory_bytes=1000, tmp_dir=str(tmpdir))
+    assert spilled == reduce_levels()
+    assert [taxid for taxid, _ in spilled[1][1]] == list(range(100, 112)) + [200]
+    assert os.listdir(str(tmpdir)) == []
@@ -0,0 +1,69 @@
+#     test_packed: Test code for the 2 bit packed sequences
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import pickle
+import random
+
+from sparkseqreducer import packed, sketch
+
+
+def test_pack_round_trip():
+    rnd = random.Random(1)
+    for length in [0, 1, 3, 4, 5, 1000]:
+        for alphabet in ["ACGT", "ACGTN", "ACGTNRYKM-"]:
+            seq = "".join(rnd.choice(alphabet) for _ in range(length))
+            packed_seq = packed.pack(seq)
+            assert len(packed_seq) == length
+            assert str(packed_seq) == seq
+            assert packed.sequence_bytes(packed_seq) == seq.encode("ascii")
+            assert pickle.loads(pickle.dumps(packed_seq)) == packed_seq
+            assert (packed.encode(packed_seq) == packed.encode(seq)).all()
+    assert packed.pack("NNNNACGTNN").exceptions == ((0, b"NNNN"), (8, b"NN"))
+    assert len(packed.pack("ACGT" * 1000).data) == 1000
+    assert sketch.content_hash(packed.pack("ACGTN")) == sketch.content_hash("acgtn")
+
+
+def test_aligners_accept_packed_sequences():
+    from sparkseqreducer import reducer
+    rnd = random.Random(2)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(3000))
+    seq_b = seq_a[:1000] + "NNNN" + "".join(rnd.choice("ACGT") for _ in range(300)) + seq_a[1300:2800]
+    for aligner in reducer.aligners.values():
+        assert aligner(packed.pack(seq_a), packed.pack(seq_b), reducer._cmp_mat_file) == \
+            aligner(seq_a, seq_b, reducer._cmp_mat_file)
+    rep = (packed.pack(seq_a), ">a")
+    assert reducer.prefilter_pair(rep, (packed.pack(seq_a[10:500]), ">b")) == "contained"
+
+
+def test_packed_output_matches_unpacked_output(tmpdir):
+    from sparkseqreducer import local_engine
+    from sparkseqreducer.sequence_io import format_reduced
+    rnd = random.Random(3)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(2000))
+    # soft masked bases, a lower case run of unknown bases and a member with a novel region
+    seq_b = seq_a[:600].lower() + "nnnn" + "".join(rnd.choice("acgt") for _ in range(200)) + seq_a[800:1800]
+    filename = os.path.join(str(tmpdir), "in.fasta")
+    with open(filename, "w") as f:
+        f.write(">A1.1 a\n%s\n>B1.1 b\n%s\n" % (seq_a[:1000].lower() + seq_a[1000:], seq_b))
+
+    outputs = []
+    for is_packed in [False, True]:
+        groups = {(1,): [(seq, header) for _, (header, seq) in local_engine.read_fasta(filename, is_packed)]}
+        outputs.append("".join(format_reduced(key[0], seqs) for key, seqs in
+                               local_engine.reduce_groups(groups, "species")))
+    assert outputs[0] == outputs[1]
+    assert all(line == line.upper() for line in outputs[0].split("\n") if not line.startswith(">"))
+    assert str(packed.pack("acgtnNry")) == "ACGTNNRY"
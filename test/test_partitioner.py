@@ -0,0 +1,52 @@
+#     test_partitioner: Test code for the cost based partitioner of the reduction
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from sparkseqreducer import partitioner
+
+
+class Broadcast(object):
+    def __init__(self, value):
+        self.value = value
+
+
+def test_plan_partitions_balances_costs():
+    key_costs = [(1, 100), (2, 60), (3, 50), (4, 40), (5, 10), (6, 0)]
+    assignment, costs = partitioner.plan_partitions(key_costs, 2)
+    assert sorted(assignment) == [1, 2, 3, 4, 5, 6]
+    assert sorted(costs) == [120, 140]
+    for partition in range(2):
+        assert sum(cost for key, cost in key_costs if assignment[key] == partition) == costs[partition]
+
+    get_partition = partitioner.partition_func(Broadcast(assignment))
+    assert [get_partition(key) for key in range(1, 7)] == [assignment[key] for key in range(1, 7)]
+    assert partitioner.estimate_cost(1, 500, 500) == 500
+    assert partitioner.estimate_cost(3, 600, 300) == 300 * 300 + 600
+
+
+def test_time_partition_and_dict_accumulator():
+    param = partitioner.DictAccumulatorParam()
+
+    class Accumulator(object):
+        value = param.zero({})
+
+        def add(self, term):
+            self.value = param.addInPlace(self.value, term)
+
+    actual = Accumulator()
+    assert list(partitioner.time_partition(3, iter([1, 2, 3]), actual)) == [1, 2, 3]
+    assert list(partitioner.time_partition(3, [], actual)) == []
+    assert list(actual.value) == [3]
+    assert "partition 0: estimated cost 7" in partitioner.format_partition_costs({"estimated": [7],
+                                                                                   "actual": actual})
@@ -0,0 +1,76 @@
+#     test_profiler: Test code for the instrumentation of the pipeline
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import csv
+import json
+import os
+from functools import partial
+
+from sparkseqreducer import profiler, reducer
+
+
+class Accumulator(object):
+    def __init__(self, value, param):
+        self.value = value
+        self.param = param
+
+    def add(self, term):
+        self.value = self.param.addInPlace(self.value, term)
+
+
+class SparkContext(object):
+    def accumulator(self, value, param):
+        return Accumulator(value, param)
+
+
+def test_disabled_profile_returns_the_function():
+    assert profiler.profiled(None, "align", reducer.align_reduce) is reducer.align_reduce
+
+
+def test_profiled_reduction(tmpdir):
+    profile = profiler.create_profile(SparkContext())
+    seq_a = ("ACGTTGCA" * 150, ">a")
+    seq_b = ("ACGTTGCA" * 75 + "T" * 200 + "ACGTTGCA" * 50, ">b")
+    records = list(profiler.count_bases([(7, seq_a), (7, seq_b)], profile, "species", "input_bases"))
+    assert records == [(7, seq_a), (7, seq_b)]
+
+    # the alignment is attributed to the rank TaxID being merged
+    create, merge, merge_both = profiler.profiled_combiner(
+        profile, "species", reducer.seq_to_list, partial(reducer.pairwise_reduction_merge_sequence, profile=profile),
+        partial(reducer.pairwise_merge_reduce_sequences, profile=profile))
+    combiner = merge(create((7, seq_a)), (7, seq_b))
+    assert combiner[0] == 7
+    assert combiner[1] == reducer.pairwise_reduction_merge_sequence([seq_a], seq_b)
+    list(profiler.count_bases([(7, combiner[1])], profile, "species", "kept_bases"))
+
+    functions = profiler.function_report(profile)
+    assert functions["align"]["calls"] == 1
+    assert functions["align"]["cells"] == len(seq_a[0]) * len(seq_b[0])
+    assert functions["align_reduce"]["calls"] == 1
+
+    taxa = profiler.taxa_report(profile)
+    assert len(taxa) == 1
+    assert taxa[0]["taxid"] == 7
+    assert taxa[0]["alignments"] == 1
+    assert taxa[0]["input_bases"] == len(seq_a[0]) + len(seq_b[0])
+    assert 0 < taxa[0]["dropped_bases"] < len(seq_b[0])
+
+    json_file, csv_file = profiler.write_profile_report(profile, os.path.join(str(tmpdir), "out"), top=5)
+    with open(json_file) as f:
+        report = json.load(f)
+    assert report["n_taxa"] == 1 and report["top_taxa"][0]["taxid"] == 7
+    with open(csv_file) as f:
+        assert [row["taxid"] for row in csv.DictReader(f)] == ["7"]
+    assert "align:" in profiler.format_profile(profile)
@@ -0,0 +1,211 @@
+#     test_reducer: Test code for the window scan of the reduction algorithm
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import random
+
+from sparkseqreducer import reducer, sketch
+from sparkseqreducer.packed import pack, reverse_complement
+
+
+def scan_diff_regions(seq_a_aligned, seq_b_aligned, threshold, stride):
+    # the original per character window scan
+    diff_regions = []
+    i = 0
+    while i < len(seq_a_aligned):
+        start_end = [i, i + stride]
+        if reducer.string_similarity(seq_a_aligned[i:i + stride], seq_b_aligned[i:i + stride]) < threshold:
+            while i < len(seq_a_aligned) and (reducer.string_similarity(seq_a_aligned[i:i + stride],
+                                                                        seq_b_aligned[i:i + stride]) < threshold):
+                start_end[1] = i + stride
+                i = i + stride
+            start_end[0] = max(0, start_end[0] - stride)
+            start_end[1] = start_end[1] + stride
+            diff_regions.append(start_end)
+        else:
+            i = i + stride
+    return reducer.remove_overlaps(diff_regions)
+
+
+def test_find_diff_regions_matches_scan():
+    rnd = random.Random(7)
+    for _ in range(300):
+        length = rnd.randint(0, 1200)
+        seq_a = "".join(rnd.choice("ACGT-") for _ in range(length))
+        seq_b = list(seq_a)
+        for _ in range(rnd.randint(0, length // 4 + 1)):
+            if seq_b:
+                start = rnd.randrange(len(seq_b))
+                for j in range(start, min(len(seq_b), start + rnd.randint(1, 60))):
+                    seq_b[j] = rnd.choice("ACGT-")
+        seq_b = "".join(seq_b)
+        threshold = rnd.choice([0.5, 0.9, 0.95, 1.0])
+        stride = rnd.choice([1, 7, 50, 100])
+        assert reducer.find_diff_regions(seq_a, seq_b, threshold, stride) == \
+            scan_diff_regions(seq_a, seq_b, threshold, stride)
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def add(self, n):
+        self.value += n
+
+
+def test_prefilter_decisions():
+    rnd = random.Random(11)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(5000))
+    other = "".join(rnd.choice("ACGT") for _ in range(4000))
+    mutated = list(seq_a)
+    mutated[2500] = "A" if mutated[2500] != "A" else "C"
+    mutated = "".join(mutated)
+    rep = (seq_a, ">a")
+
+    assert reducer.prefilter_pair(rep, (seq_a[1000:3000].lower(), ">b")) == "contained"
+    assert reducer.prefilter_pair(rep, ("ACGTNNNNACGT", ">d")) is None
+    # a single substitution is a novel k-mer, the pair is aligned
+    assert reducer.prefilter_pair(rep, (mutated, ">e")) is None
+
+    stats = dict((name, Counter()) for name in reducer.prefilter_counters)
+    sequences = reducer.reduce_pair([rep], rep, (other, ">c"), prefilter=stats)
+    assert reducer.prefilter_pair(rep, (other, ">c")) is None
+    assert stats["aligned"].value == 1 and all(header == ">c" for _, header in sequences[1:])
+
+    records = [(1, (seq_a, ">a")), (1, (seq_a, ">a2")), (2, (seq_a, ">a3"))]
+    assert [r[1][1] for r in reducer.remove_duplicates(records, stats)] == [">a", ">a3"]
+    assert stats["duplicate"].value == 1
+
+    # the repeat of seq_r links both flanks, every k-mer of the member is in seq_r but it is not a substring
+    repeat = seq_a[:50]
+    seq_r = other[:1000] + repeat + other[1000:2000] + repeat + other[2000:3000]
+    member = other[500:1000] + repeat + other[2000:2500]
+    assert reducer.prefilter_pair((seq_r, ">r"), (member, ">g")) == "similar"
+    sequences = reducer.reduce_pair([(seq_r, ">r")], (seq_r, ">r"), (member, ">g"), prefilter=stats)
+    assert sequences == [(seq_r, ">r")] and stats["similar"].value == 1
+
+
+def test_prefilter_keeps_a_small_novel_insertion():
+    rnd = random.Random(13)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(10000))
+    insertion = "".join(rnd.choice("ACGT") for _ in range(150))
+    member = seq_a[1000:5000] + insertion + seq_a[5000:9000]
+    rep = (seq_a, ">a")
+    assert reducer.prefilter_pair(rep, (member, ">b")) is None
+    stats = dict((name, Counter()) for name in reducer.prefilter_counters)
+    sequences = reducer.reduce_pair([rep], rep, (member, ">b"), prefilter=stats)
+    assert stats["aligned"].value == 1
+    assert any(insertion in region for region, header in sequences[1:] if header == ">b")
+
+
+def test_fanout_helpers_are_order_independent():
+    rnd = random.Random(5)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(1000))
+    members = [(seq_a, ">b"), (seq_a[:900], ">c"), ("T" * 1000, ">a")]
+    for _ in range(5):
+        rnd.shuffle(members)
+        representative = members[0]
+        for member in members[1:]:
+            representative = reducer.longest_sequence(representative, member)
+        assert representative == (seq_a, ">b")
+
+    assert reducer.align_to_representative(representative, representative) == []
+    # the regions of a member keep their position order
+    values = [(1, ("AA", ">d", 300)), (1, ("CC", ">d", 0)), (0, representative), (1, ("GG", ">c", 50))]
+    assert reducer.order_reduced(values) == [representative, ("GG", ">c"), ("CC", ">d"), ("AA", ">d")]
+    assert reducer.order_reduced(list(reversed(values))) == reducer.order_reduced(values)
+    assert all(0 <= reducer.salt_of(header, 7) < 7 for header in [">a", ">b", ">c"])
+
+
+def test_level_sequences():
+    seqs = [("ACGT", ">a"), ("GG", ">b")]
+    assert reducer.level_sequences((9606, 9605, 9604), seqs) == [((9605, 9604), [9606, ">a", "ACGT"]),
+                                                                  ((9605, 9604), [9606, ">b", "GG"])]
+
+
+def test_reverse_strand_members_are_reverse_complemented():
+    rnd = random.Random(23)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(1500))
+    member = seq_a[200:1200]
+    reverse = reverse_complement(member)
+    assert reverse_complement(reverse) == member
+
+    # without the strand detection the whole member is unique
+    sequences = reducer.reduce_pair([(seq_a, ">a")], (seq_a, ">a"), (reverse, ">b"))
+    assert sum(len(region) for region, _ in sequences[1:]) >= len(member)
+
+    assert reducer.orient((seq_a, ">a"), (member, ">b")) == (member, ">b strand=+")
+    assert reducer.orient((seq_a, ">a"), (reverse, ">b")) == (member, ">b strand=-")
+    sequences = reducer.reduce_pair([(seq_a, ">a")], (seq_a, ">a"), (reverse, ">b"), strand=True)
+    forward = reducer.reduce_pair([(seq_a, ">a")], (seq_a, ">a"), (member, ">b"))
+    assert sequences == [forward[0]] + [(region, ">b strand=-") for region, _ in forward[1:]]
+    assert sum(len(region) for region, _ in sequences[1:]) < len(member) / 2
+
+    # packed sequences and sketches are oriented too
+    rep = reducer.add_sketch((pack(seq_a), ">a"))
+    oriented = reducer.orient(rep, reducer.add_sketch((pack(reverse), ">b")))
+    assert oriented[:2] == (pack(member), ">b strand=-")
+    assert list(oriented[2]) == list(reducer.add_sketch((member, ">b"))[2])
+
+
+def test_divergent_members_start_new_clusters():
+    rnd = random.Random(31)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(3000))
+    seq_c = "".join(rnd.choice("ACGT") for _ in range(2000))
+    near_a = reducer.add_sketch((seq_a[100:2900], ">b"))
+    near_c = reducer.add_sketch((seq_c[:1500], ">d"))
+
+    clusters = reducer.create_clusters(reducer.add_sketch((seq_a, ">a")))
+    assert reducer.nearest_centroid(clusters, near_a) == 0
+    assert reducer.nearest_centroid(clusters, reducer.add_sketch((seq_c, ">c"))) is None
+    assert reducer.nearest_centroid(clusters, reducer.add_sketch(("ACGTNNNNACGT", ">e"))) == 0
+
+    for member in [near_a, reducer.add_sketch((seq_c, ">c")), near_c]:
+        clusters = reducer.add_to_clusters(clusters, member)
+    assert [cluster[0][1] for cluster in clusters] == [">a", ">c"]
+    assert set(seq[1] for seq in clusters[0][1:]) <= {">b"} and set(seq[1] for seq in clusters[1][1:]) <= {">d"}
+
+    # merging the clusters of another partition adds its centroids to the nearest clusters
+    merged = reducer.merge_clusters([[reducer.add_sketch((seq_c, ">c"))]],
+                                    reducer.create_clusters(reducer.add_sketch((seq_a, ">a"))))
+    assert [cluster[0][1] for cluster in merged] == [">c", ">a"]
+    assert reducer.clusters_to_groups(merged) == [[(seq_a, ">a")], [(seq_c, ">c")]]
+
+
+def test_fanout_regions_follow_the_combine_order():
+    rnd = random.Random(41)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(2000))
+    # two unique regions, the second one sorts first as a string
+    member = seq_a[:500] + "T" * 150 + seq_a[500:1200] + "A" * 150 + seq_a[1200:1800]
+    combined = reducer.reduce_pair([(seq_a, ">a")], (seq_a, ">a"), (member, ">b"))
+    regions = reducer.align_to_representative((member, ">b"), (seq_a, ">a"))
+    starts = [region[2] for region in regions]
+    assert len(regions) > 1 and starts == sorted(starts)
+    assert reducer.order_reduced([(1, region) for region in reversed(regions)] + [(0, (seq_a, ">a"))]) == combined
+
+
+def test_promoted_representative_keeps_the_strand_labels_true():
+    rnd = random.Random(29)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(1500))
+    region = "".join(rnd.choice("ACGT") for _ in range(300))
+    longer = reverse_complement(seq_a + "".join(rnd.choice("ACGT") for _ in range(500)))
+    sequences = [(seq_a, ">a"), (region, ">m strand=+"), (region, ">n strand=-")]
+    sequences = reducer.pairwise_reduction_merge_sequence(sequences, (longer, ">b"), strand=True)
+    assert sequences[0] == (longer, ">b")
+    # the regions of the members follow the previous representative to the other strand
+    assert sequences[1:3] == [(reverse_complement(region), ">m strand=-"), (reverse_complement(region), ">n strand=+")]
+    assert all(header == ">a strand=-" for _, header in sequences[3:])
+
+    # the k-mers of the representative are computed once for consecutive members
+    assert sketch.reference_kmers(longer, 15) is sketch.reference_kmers(longer, 15)
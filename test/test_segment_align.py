@@ -0,0 +1,56 @@
+#     test_segment_align: Test code for the segmented alignment of long pairs
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import random
+
+from sparkseqreducer import reducer, segment_align, stretcher
+from sparkseqreducer.packed import pack
+
+
+def long_pair(seed=3, length=8000, insert_at=3000, insert_length=600):
+    rnd = random.Random(seed)
+    seq_a = "".join(rnd.choice("ACGT") for _ in range(length))
+    seq_b = list(seq_a)
+    for i in range(0, length, 97):
+        seq_b[i] = rnd.choice("ACGT")
+    seq_b = "".join(seq_b[:insert_at]) + "".join(rnd.choice("ACGT") for _ in range(insert_length)) + \
+        "".join(seq_b[insert_at + insert_length:length - 500])
+    return seq_a, seq_b
+
+
+def test_cut_points_respect_the_budget():
+    seq_a, seq_b = long_pair()
+    cuts = segment_align.cut_points(seq_a, seq_b, 2000)
+    assert cuts[0] == (0, 0) and cuts[-1] == (len(seq_a), len(seq_b))
+    assert all(start[0] <= stop[0] and start[1] <= stop[1] for start, stop in zip(cuts, cuts[1:]))
+    assert max(segment_align._span(start, stop) for start, stop in zip(cuts, cuts[1:])) <= 2000
+    # without anchors the pair is cut along the diagonal
+    assert segment_align.cut_points("A" * 5000, "C" * 2500, 2000) == [(0, 0), (1666, 833), (3333, 1666),
+                                                                      (5000, 2500)]
+
+
+def test_segmented_alignment():
+    seq_a, seq_b = long_pair()
+    segments = segment_align.SegmentedAligner(min_length=5000, max_segment=2000, threads=3)
+    assert segments.applies(seq_a, seq_b) and not segments.applies(seq_a, seq_b[:4000])
+    aligned_a, aligned_b = segments.align(pack(seq_b), seq_a, reducer._cmp_mat_file)
+    assert len(aligned_a) == len(aligned_b)
+    assert aligned_a.replace("-", "") == seq_a and aligned_b.replace("-", "") == seq_b
+    # same unique regions as the alignment of the whole pair
+    assert reducer.find_diff_regions(aligned_a, aligned_b) == \
+        reducer.find_diff_regions(*stretcher.align(seq_a, seq_b, reducer._cmp_mat_file))
+
+    sequences = reducer.align_reduce([(seq_a, ">a")], (seq_a, ">a"), (seq_b, ">b"), segments=segments)
+    assert [header for _, header in sequences] == [">a", ">b", ">b"]
@@ -0,0 +1,85 @@
+#     test_sequence_io: Test code for the fasta writers
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import gzip
+import random
+
+import pytest
+
+from sparkseqreducer import bgzf, sequence_io
+from sparkseqreducer.bgzf import BgzfWriter
+
+records = [(9606, [("ACGT" * 40, ">NC_1.1 human"), ("GGCC" * 5, ">NC_2.1 human")]),
+           (562, [("T" * 70, ">NC_3.1 coli")])]
+
+
+def test_format_reduced():
+    assert sequence_io.format_reduced(*records[0]) == \
+        ">NC_1.1 human, Representative 9606\n" + ("ACGT" * 40)[:70] + "\n" + ("ACGT" * 40)[70:140] + "\n" + \
+        ("ACGT" * 40)[140:] + "\n\n>NC_2.1 human, Unique1\n" + "GGCC" * 5 + "\n\n"
+    assert sequence_io.format_reduced(*records[1]) == ">NC_3.1 coli, Representative 562\n" + "T" * 70 + "\n\n"
+
+
+@pytest.mark.parametrize("compression", [None, "gzip", "bgzf"])
+def test_write_and_merge_parts(tmpdir, compression):
+    out_dir = str(tmpdir.join("parts"))
+    tmpdir.mkdir("parts")
+    part_files = [next(sequence_io.write_fasta_part(i, [record], out_dir, compression))
+                  for i, record in enumerate(records)]
+    merged = sequence_io.merge_fasta_parts(part_files, str(tmpdir.join("merged")), compression)
+    with (open(merged, "rb") if compression is None else gzip.open(merged, "rb")) as f:
+        assert f.read().decode("UTF-8") == "".join(sequence_io.format_reduced(*record) for record in records)
+    assert sorted(tmpdir.join("parts").listdir()) == sorted(tmpdir.join("parts").join(name) for name in
+                                                            ["part-00000" + sequence_io.compressions[compression],
+                                                             "part-00001" + sequence_io.compressions[compression]])
+
+
+def test_parse_fasta_records():
+    records = ["", ">NC_1.1 first\nacgt\nAC GT\r\n\n", "NC_2.1 second\r\nTTTT\n", "\n"]
+    assert list(sequence_io.parse_fasta_records(records)) == [("NC_1.1", [">NC_1.1 first", "ACGTACGT"]),
+                                                               ("NC_2.1", [">NC_2.1 second", "TTTT"])]
+
+
+def test_read_fasta_bgzf_ranges(tmpdir):
+    rnd = random.Random(3)
+    expected = []
+    filename = str(tmpdir.join("input.fasta.gz"))
+    with BgzfWriter(filename) as f:
+        for i in range(400):
+            seq = "".join(rnd.choice("ACGT") for _ in range(rnd.randint(1, 2000)))
+            expected.append(("NC_%d.1" % i, [">NC_%d.1 sequence %d" % (i, i), seq]))
+            f.write((">NC_%d.1 sequence %d\n" % (i, i)).encode())
+            f.write("\n".join(seq[j:j + 60] for j in range(0, len(seq), 60)).encode() + b"\n")
+    assert bgzf.is_bgzf(filename)
+    offsets = bgzf.block_offsets(filename)
+    assert len(offsets) > 5
+    for n_ranges in [1, 2, 3, len(offsets), len(offsets) + 3]:
+        ranges = sequence_io.bgzf_ranges(offsets, n_ranges)
+        records = [record for start, end in ranges for record in sequence_io.read_fasta_range(filename, start, end)]
+        assert list(sequence_io.parse_fasta_records(records)) == expected
+
+
+def test_read_fasta_bgzf_long_record_across_ranges(tmpdir):
+    rnd = random.Random(4)
+    filename = str(tmpdir.join("long.fasta.gz"))
+    records = [("A1.1", "ACGT" * 10), ("B2.1", "".join(rnd.choice("ACGT") for _ in range(400000))), ("C3.1", "GG")]
+    with BgzfWriter(filename) as f:
+        for accession, seq in records:
+            f.write((">%s\n%s\n" % (accession, seq)).encode())
+    offsets = bgzf.block_offsets(filename)
+    assert len(offsets) > 3
+    ranges = sequence_io.bgzf_ranges(offsets, len(offsets))
+    read = [record for start, end in ranges for record in sequence_io.read_fasta_range(filename, start, end)]
+    assert list(sequence_io.parse_fasta_records(read)) == [(a, [">" + a, seq]) for a, seq in records]
@@ -0,0 +1,98 @@
+#     test_taxmap_batch: Test code for batched taxid mapping using accession numbers with a local db
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import gzip
+import os
+import sqlite3
+import tempfile
+
+from sparkseqreducer import taxid_map
+
+
+def create_test_db(path, n=1200):
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE accession_taxid_map (accession TEXT, accession_version TEXT, taxid INTEGER, gi INTEGER)")
+    conn.executemany("INSERT INTO accession_taxid_map VALUES (?, ?, ?, ?)",
+                     [("X%05d" % i, "X%05d.1" % i, i, i) for i in range(n)])
+    conn.commit()
+    conn.close()
+
+
+def test_map_partition_accession_to_taxid():
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "gb.db")
+        create_test_db(db_file)
+        records = [("X%05d.1" % i, [">X%05d.1 test" % i, "ACGT"]) for i in range(0, 2400, 2)]
+        mapped = list(taxid_map.map_partition_accession_to_taxid(0, iter(records), db_file, batch_size=100))
+        assert [x[0] for x in mapped] == [x[0] for x in records]
+        assert mapped[0] == ("X00000.1", ["0", ">X00000.1 test", "ACGT"])
+        assert mapped[10][1][0] == "20"
+        assert sum(1 for x in mapped if x[1][0] == "None") == 600
+
+
+def test_missing_db_maps_to_none():
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "missing.db")
+        mapped = list(taxid_map.map_partition_accession_to_taxid(0, iter([("A1.1", [">A1.1", "AC"])]), db_file))
+        assert mapped == [("A1.1", ["None", ">A1.1", "AC"])]
+        assert not os.path.exists(db_file)
+
+
+def test_resume_refuses_a_corrupt_database():
+    with tempfile.TemporaryDirectory() as tmp:
+        gz_file = os.path.join(tmp, "nucl_gb.accession2taxid.gz")
+        with gzip.open(gz_file, "wt") as f:
+            f.write("accession\taccession.version\ttaxid\tgi\n")
+            for i in range(20000):
+                f.write("X%06d\tX%06d.1\t%d\t0\n" % (i, i, i))
+        db_file = os.path.join(tmp, "gb.db")
+        conn = sqlite3.connect(db_file)
+        assert taxid_map.bulk_create_accession2taxid_db(conn, gz_file, batch_size=1000) == 0
+        conn.close()
+
+        conn = sqlite3.connect(db_file)
+        assert taxid_map.bulk_create_accession2taxid_db(conn, gz_file, resume=True) == 0
+        conn.close()
+
+        # overwrite a page in the middle of the table
+        with open(db_file, "r+b") as f:
+            f.seek(os.path.getsize(db_file) // 2 // 4096 * 4096)
+            f.write(b"\xff" * 4096)
+        conn = sqlite3.connect(db_file)
+        assert taxid_map.bulk_create_accession2taxid_db(conn, gz_file, resume=True) == -1
+        conn.close()
+
+
+class Counter(object):
+    def __init__(self):
+        self.value = 0
+
+    def add(self, n):
+        self.value += n
+
+
+def test_lookups_are_counted_per_batch():
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "gb.db")
+        create_test_db(db_file)
+        records = [("X%05d.1" % i, [">X%05d.1" % i, "ACGT"]) for i in range(0, 2400, 2)]
+        hits, misses = Counter(), Counter()
+        mapped = taxid_map.map_partition_accession_to_taxid(0, iter(records), db_file, batch_size=100, hits=hits,
+                                                            misses=misses)
+        # a partially read partition counts the batches it looked up
+        next(mapped)
+        assert (hits.value, misses.value) == (100, 0)
+        list(mapped)
+        assert (hits.value, misses.value) == (600, 600)
@@ -0,0 +1,73 @@
+#     test_taxonomy: Test code for the array based taxonomy tree
+#     Copyright (C) 2019  ja-pg
+#
+#     This program is free software: you can redistribute it and/or modify
+#     it under the terms of the GNU General Public License as published by
+#     the Free Software Foundation, either version 3 of the License, or
+#     (at your option) any later version.
+#
+#     This program is distributed in the hope that it will be useful,
+#     but WITHOUT ANY WARRANTY; without even the implied warranty of
+#     MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#     GNU General Public License for more details.
+#
+#     You should have received a copy of the GNU General Public License
+#     along with this program.  If not, see <https://www.gnu.org/licenses/>.
+import os
+import tempfile
+
+import numpy as np
+
+from sparkseqreducer import phylogenetic_map, taxonomy
+
+# taxid, parent taxid, rank, scientific name
+nodes = [(1, 1, "no rank", "root"),
+         (2, 131567, "superkingdom", "Bacteria"),
+         (131567, 1, "no rank", "cellular organisms"),
+         (1224, 2, "phylum", "Proteobacteria"),
+         (1236, 1224, "class", "Gammaproteobacteria"),
+         (91347, 1236, "order", "Enterobacterales"),
+         (543, 91347, "family", "Enterobacteriaceae"),
+         (561, 543, "genus", "Escherichia"),
+         (562, 561, "species", "Escherichia coli"),
+         (83333, 562, "strain", "Escherichia coli K-12")]
+
+
+def write_dmp_files(directory):
+    nodes_file = os.path.join(directory, "nodes.dmp")
+    names_file = os.path.join(directory, "names.dmp")
+    with open(nodes_file, "w") as f:
+        for taxid, parent, rank, _ in nodes:
+            f.write("%d\t|\t%d\t|\t%s\t|\t\t|\n" % (taxid, parent, rank))
+    with open(names_file, "w") as f:
+        for taxid, _, _, name in nodes:
+            f.write("%d\t|\t%s\t|\t\t|\tscientific name\t|\n" % (taxid, name))
+            f.write("%d\t|\t%s synonym\t|\t\t|\tsynonym\t|\n" % (taxid, name))
+    return nodes_file, names_file
+
+
+def test_lineage_matches_dict():
+    with tempfile.TemporaryDirectory() as tmp:
+        nodes_file, names_file = write_dmp_files(tmp)
+        dic = phylogenetic_map.generate_dict(nodes_file, names_file)
+        tree = taxonomy.build_taxonomy(nodes_file, names_file)
+        tree.save(os.path.join(tmp, "taxonomy"))
+        assert taxonomy.is_taxonomy(os.path.join(tmp, "taxonomy"))
+        tree = taxonomy.load_taxonomy(os.path.join(tmp, "taxonomy"))
+        assert isinstance(tree.parents, np.memmap)
+        for taxid in [1, 2, 562, 83333, 999, 0]:
+            assert tree.get_lineage(taxid) == phylogenetic_map.get_ascendants_with_ranks_and_names(dic, taxid, True)
+        assert tree.get_lineage("83333")["genus"] == (561, "Escherichia")
+        assert tree.get_lineage(83333, False)["strain"] == (83333, "Escherichia coli K-12")
+        assert tree.get_lineage(999) == {"unknown": (999, "unknown")}
+
+
+def test_rank_projection():
+    with tempfile.TemporaryDirectory() as tmp:
+        nodes_file, names_file = write_dmp_files(tmp)
+        dic = phylogenetic_map.generate_dict(nodes_file, names_file)
+        tree = taxonomy.build_taxonomy(nodes_file, names_file)
+        for tax_tree in [tree, dic]:
+            assert phylogenetic_map.get_rank_taxids(tax_tree, "83333", ["species", "genus"]) == (562, 561)
+            assert phylogenetic_map.get_rank_taxids(tax_tree, "561", ["species", "family"]) == (-1, 543)
+            assert phylogenetic_map.get_rank_taxids(tax_tree, "999", ["species"]) == (-1,)